@@ -0,0 +1,248 @@
+"""Copyright 2014 Google Inc. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+An on-disk cache of annotated modules, keyed by their source text.
+
+Example:
+>>> cache = annotation_cache.AnnotationCache(
+...     os.path.expanduser('~/.cache/py-ast-utils/annotations'))
+>>> module_node = cache.GetAnnotatedModule(text)
+>>> module_node.matcher.GetSource() == text
+True
+
+The first time a text is seen, it is parsed and matched with
+source_match.GetSource, and the annotated module, matchers included, is
+stored in the cache directory as annotation_codec encodes it. After that,
+the module is decoded instead. Entries are keyed by a hash of the text and
+of the library's version, so editing the library invalidates them.
+
+Entries are pickles, and loading one runs whatever code it holds. So each
+entry is signed with a secret key, and entries that aren't signed with it
+are misses, never loaded. The key can be given, to keep it elsewhere, or
+the cache makes a random one in its directory. Either way, the cache
+directory must only be writable by the current user: the cache makes it
+with mode 0700, and refuses to use a directory that another user owns or
+that others can read or write, such as a directory directly in /tmp.
+"""
+
+import _ast
+import ast
+import collections
+import cPickle
+import errno
+import hashlib
+import os
+import stat
+import tempfile
+
+import annotation_codec
+import source_match
+
+
+CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses'])
+
+_SUFFIX = '.annotation'
+
+# The file in the cache directory the secret key is made in, if none is
+# given.
+_SECRET_KEY_FILENAME = 'secret_key'
+_SECRET_KEY_LENGTH = 32
+
+
+class Error(Exception):
+  pass
+
+
+class UnsafeDirectoryError(Error):
+  pass
+
+
+class AnnotationCache(object):
+  """Annotated modules, encoded into files in a directory.
+
+  Several processes of the same user can share a directory; entries are
+  written to a temporary file first and renamed into place.
+  """
+
+  def __init__(self, directory, secret_key=None):
+    """Initializes the cache.
+
+    Args:
+      directory: {str} The cache directory. It is made when the first entry
+          is stored.
+      secret_key: {str} The secret key to sign entries with, or None to make
+          a random one in the cache directory.
+    """
+    self.directory = directory
+    self.secret_key = secret_key
+    self.hits = 0
+    self.misses = 0
+
+  def GetKey(self, text):
+    """Gets the key the annotated module for text is stored under.
+
+    Args:
+      text: {str|SourceBuffer|TokenizedText} The source text. Texts of
+          different types are keyed apart, since they annotate differently.
+
+    Returns:
+      The key, as a hex string.
+    """
+    key_hash = hashlib.sha1()
+    key_hash.update('{}\0{}\0'.format(
+        annotation_codec.GetLibraryVersion(), type(text).__name__))
+    key_hash.update(text)
+    return key_hash.hexdigest()
+
+  def _GetPath(self, key):
+    return os.path.join(self.directory, key + _SUFFIX)
+
+  def GetAnnotatedModule(self, text, filename='<unknown>'):
+    """Gets text parsed into a module and annotated with matchers.
+
+    Args:
+      text: {str|SourceBuffer|TokenizedText} The source text.
+      filename: {str} The filename to report syntax errors with.
+
+    Returns:
+      The annotated _ast.Module, unpickled from the cache if it has it, or
+      annotated and added to the cache otherwise.
+
+    Raises:
+      SyntaxError: If text doesn't parse.
+      source_match.BadlySpecifiedTemplateError: If text doesn't match.
+      UnsafeDirectoryError: If the cache directory isn't owned by the current
+          user, or others can access it.
+      Error: If the secret key file in the cache directory is corrupt.
+    """
+    path = self._GetPath(self.GetKey(text))
+    module_node = None
+    # Nothing is stored yet in a directory that doesn't exist.
+    if self._CheckDirectory():
+      module_node = self._Load(path)
+    if module_node is not None:
+      self.hits += 1
+      return module_node
+    self.misses += 1
+    module_node = ast.parse(text, filename)
+    source_match.GetSource(module_node, text)
+    self._Store(path, module_node)
+    return module_node
+
+  def _GetSecretKey(self, create=False):
+    """Gets the secret key, reading it from the cache directory if needed.
+
+    Args:
+      create: {bool} True to make the key if there isn't one yet.
+
+    Returns:
+      The key, or None if it isn't made yet and create is False.
+    """
+    if self.secret_key is not None:
+      return self.secret_key
+    path = os.path.join(self.directory, _SECRET_KEY_FILENAME)
+    if create:
+      try:
+        file_descriptor = os.open(
+            path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+      except OSError as e:
+        # Another process may have made it in the meantime.
+        if e.errno != errno.EEXIST:
+          raise
+      else:
+        with os.fdopen(file_descriptor, 'wb') as key_file:
+          key_file.write(os.urandom(_SECRET_KEY_LENGTH))
+    try:
+      with open(path, 'rb') as key_file:
+        secret_key = key_file.read()
+    except IOError:
+      return None
+    if len(secret_key) != _SECRET_KEY_LENGTH:
+      raise Error('Secret key file {} is corrupt'.format(path))
+    self.secret_key = secret_key
+    return secret_key
+
+  def _Load(self, path):
+    """Returns the module stored at path, or None if there isn't one."""
+    secret_key = self._GetSecretKey()
+    if secret_key is None:
+      return None
+    try:
+      with open(path, 'rb') as cache_file:
+        module_node = annotation_codec.DecodeNode(
+            cache_file.read(), key=secret_key)
+    except (IOError, annotation_codec.DecodeError):
+      # Missing, corrupt and unsigned entries are all misses. Storing the
+      # module replaces the entry.
+      return None
+    if not isinstance(module_node, _ast.Module):
+      return None
+    return module_node
+
+  def _CheckDirectory(self):
+    """Checks that the cache directory is private, if it exists yet.
+
+    Returns:
+      Whether the directory exists.
+    """
+    try:
+      directory_stat = os.stat(self.directory)
+    except OSError:
+      return False
+    if directory_stat.st_uid != os.getuid():
+      raise UnsafeDirectoryError(
+          'Cache directory {} is not owned by the current user, and its '
+          'entries would be loaded as code'.format(self.directory))
+    if directory_stat.st_mode & (stat.S_IRWXG | stat.S_IRWXO):
+      raise UnsafeDirectoryError(
+          'Cache directory {} has mode {:o}, but it must only be accessible '
+          'by its owner (mode 0700), since its entries are loaded as code'
+          .format(self.directory, stat.S_IMODE(directory_stat.st_mode)))
+    return True
+
+  def _Store(self, path, module_node):
+    """Stores module_node at path, unless it can't be encoded."""
+    if not os.path.isdir(self.directory):
+      try:
+        os.makedirs(self.directory, 0700)
+      except OSError:
+        # Another process may have made it in the meantime.
+        if not os.path.isdir(self.directory):
+          raise
+      self._CheckDirectory()
+    secret_key = self._GetSecretKey(create=True)
+    file_descriptor, temp_path = tempfile.mkstemp(
+        dir=self.directory, suffix='.tmp')
+    try:
+      with os.fdopen(file_descriptor, 'wb') as temp_file:
+        temp_file.write(
+            annotation_codec.EncodeNode(module_node, key=secret_key))
+    except (cPickle.PicklingError, RuntimeError, TypeError):
+      # Trees too deep for the pickler to recurse through aren't cached.
+      os.remove(temp_path)
+      return
+    os.rename(temp_path, path)
+
+  def GetCacheInfo(self):
+    """Returns a CacheInfo with the hits and misses of this object."""
+    return CacheInfo(self.hits, self.misses)
+
+  def Clear(self):
+    """Removes every entry from the cache directory, but not the key."""
+    if not os.path.isdir(self.directory):
+      return
+    for filename in os.listdir(self.directory):
+      if filename.endswith(_SUFFIX):
+        os.remove(os.path.join(self.directory, filename))
@@ -0,0 +1,172 @@
+"""Copyright 2014 Google Inc. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Tests for annotation_cache.py
+"""
+
+import ast
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import annotation_cache
+import annotation_codec
+import source_match
+
+
+class AnnotationCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.cache = annotation_cache.AnnotationCache(
+        os.path.join(self.directory, 'cache'))
+    self.text = (
+        'def f(a,  b):  # comment\n'
+        '\n'
+        '  return (a +\n'
+        '          b)\n')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def testMissThenHit(self):
+    module_node = self.cache.GetAnnotatedModule(self.text)
+    cached_module_node = self.cache.GetAnnotatedModule(self.text)
+    self.assertIsNot(module_node, cached_module_node)
+    self.assertEqual(self.text, cached_module_node.matcher.GetSource())
+    self.assertEqual(ast.dump(module_node), ast.dump(cached_module_node))
+    self.assertEqual((1, 1), self.cache.GetCacheInfo())
+
+  def testHitCanBeChanged(self):
+    self.cache.GetAnnotatedModule(self.text)
+    module_node = self.cache.GetAnnotatedModule(self.text)
+    module_node.body[0].name = 'g'
+    self.assertEqual('def g(a,  b):', module_node.matcher.GetSource()[:13])
+
+  def testHitSharesTextSpecs(self):
+    self.cache.GetAnnotatedModule(self.text)
+    module_node = self.cache.GetAnnotatedModule(self.text)
+    placeholder = [
+        part for part in module_node.body[0].matcher.expected_parts
+        if isinstance(part, source_match.TextPlaceholder)][0]
+    self.assertIs(source_match._GetTextSpec(placeholder.original_regex),
+                  placeholder.spec)
+
+  def testSharedBetweenObjects(self):
+    self.cache.GetAnnotatedModule(self.text)
+    other_cache = annotation_cache.AnnotationCache(self.cache.directory)
+    other_cache.GetAnnotatedModule(self.text)
+    self.assertEqual((1, 0), other_cache.GetCacheInfo())
+
+  def testKeys(self):
+    self.assertEqual(self.cache.GetKey(self.text),
+                     self.cache.GetKey(self.text))
+    self.assertNotEqual(self.cache.GetKey(self.text),
+                        self.cache.GetKey(self.text + '\n'))
+    self.assertNotEqual(
+        self.cache.GetKey(self.text),
+        self.cache.GetKey(source_match.SourceBuffer(self.text)))
+
+  def testLibraryVersionChangesKeys(self):
+    key = self.cache.GetKey(self.text)
+    annotation_codec._library_version = 'other'
+    try:
+      self.assertNotEqual(key, self.cache.GetKey(self.text))
+    finally:
+      annotation_codec._library_version = None
+    self.assertEqual(key, self.cache.GetKey(self.text))
+
+  def testCorruptEntryIsReplaced(self):
+    self.cache.GetAnnotatedModule(self.text)
+    path = self.cache._GetPath(self.cache.GetKey(self.text))
+    with open(path, 'wb') as cache_file:
+      cache_file.write('not an annotation')
+    module_node = self.cache.GetAnnotatedModule(self.text)
+    self.assertEqual(self.text, module_node.matcher.GetSource())
+    self.assertEqual((0, 2), self.cache.GetCacheInfo())
+    self.cache.GetAnnotatedModule(self.text)
+    self.assertEqual((1, 2), self.cache.GetCacheInfo())
+
+  def testUnsignedEntryIsReplaced(self):
+    module_node = self.cache.GetAnnotatedModule(self.text)
+    path = self.cache._GetPath(self.cache.GetKey(self.text))
+    with open(path, 'wb') as cache_file:
+      cache_file.write(annotation_codec.EncodeNode(module_node))
+    self.cache.GetAnnotatedModule(self.text)
+    self.assertEqual((0, 2), self.cache.GetCacheInfo())
+    self.cache.GetAnnotatedModule(self.text)
+    self.assertEqual((1, 2), self.cache.GetCacheInfo())
+
+  def testSecretKeyIsPrivate(self):
+    self.cache.GetAnnotatedModule(self.text)
+    path = os.path.join(self.cache.directory, 'secret_key')
+    self.assertEqual(0600, stat.S_IMODE(os.stat(path).st_mode))
+    self.cache.Clear()
+    self.assertTrue(os.path.exists(path))
+
+  def testGivenSecretKey(self):
+    cache = annotation_cache.AnnotationCache(
+        self.cache.directory, secret_key='a' * 32)
+    cache.GetAnnotatedModule(self.text)
+    self.assertFalse(
+        os.path.exists(os.path.join(self.cache.directory, 'secret_key')))
+    other_cache = annotation_cache.AnnotationCache(
+        self.cache.directory, secret_key='b' * 32)
+    other_cache.GetAnnotatedModule(self.text)
+    self.assertEqual((0, 1), other_cache.GetCacheInfo())
+    cache.GetAnnotatedModule(self.text)
+    self.assertEqual((0, 2), cache.GetCacheInfo())
+
+  def testMissingDirectoryIsAMiss(self):
+    self.cache._Load = lambda path: self.fail('Loaded {}'.format(path))
+    self.cache.GetAnnotatedModule(self.text)
+    self.assertEqual((0, 1), self.cache.GetCacheInfo())
+    self.assertTrue(os.path.isdir(self.cache.directory))
+
+  def testSourceBuffer(self):
+    text = source_match.SourceBuffer(self.text * 10)
+    self.cache.GetAnnotatedModule(text)
+    module_node = self.cache.GetAnnotatedModule(text)
+    self.assertEqual(text, module_node.matcher.GetSource())
+    self.assertIsInstance(module_node.source_buffer, source_match.SourceBuffer)
+
+  def testErrors(self):
+    with self.assertRaises(SyntaxError):
+      self.cache.GetAnnotatedModule('def (:\n')
+    self.assertEqual([], os.listdir(self.directory))
+
+  def testDirectoryIsPrivate(self):
+    self.cache.GetAnnotatedModule(self.text)
+    self.assertEqual(
+        0700, stat.S_IMODE(os.stat(self.cache.directory).st_mode))
+
+  def testSharedDirectoryIsRefused(self):
+    os.chmod(self.directory, 0777)
+    cache = annotation_cache.AnnotationCache(self.directory)
+    with self.assertRaises(annotation_cache.UnsafeDirectoryError):
+      cache.GetAnnotatedModule(self.text)
+    self.assertEqual([], os.listdir(self.directory))
+
+  def testClear(self):
+    self.cache.GetAnnotatedModule(self.text)
+    self.cache.Clear()
+    self.cache.GetAnnotatedModule(self.text)
+    self.assertEqual((0, 2), self.cache.GetCacheInfo())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,173 @@
+"""Copyright 2014 Google Inc. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Compact encoding of annotated trees, for caching them and for sending them
+between processes.
+
+Example:
+>>> data = annotation_codec.EncodeNode(module_node)
+>>> new_module_node = annotation_codec.DecodeNode(data)
+>>> new_module_node.matcher.GetSource() == module_node.matcher.GetSource()
+True
+
+An encoding starts with a header naming the library version it was made
+with. The rest is the tree, with the matchers attached to its nodes, pickled
+and compressed with zlib. Decoding rebuilds the nodes and matchers as they
+were, without matching any source again. Text that was matched from a
+SourceBuffer is kept as one copy of the buffer and offsets into it.
+
+Decoding unpickles, and unpickling runs whatever code the data asks for, so
+data that anyone else could have written can take over the decoding
+process. Only decode data without a key if it comes from a trusted source.
+Given a key, EncodeNode signs the encoding with an HMAC of it, and
+DecodeNode checks the signature before unpickling anything:
+>>> data = annotation_codec.EncodeNode(module_node, key=secret_key)
+>>> new_module_node = annotation_codec.DecodeNode(data, key=secret_key)
+"""
+
+import cPickle
+import gc
+import hashlib
+import hmac
+import os
+import sys
+import zlib
+
+import create_node
+import node_tree_util
+import source_match
+
+
+# Bump this when the encoding changes in a way the library's source doesn't
+# show.
+_FORMAT_VERSION = 1
+
+_MAGIC = 'pyastutils-annotation'
+
+# zlib's fastest level; higher ones take several times as long to compress
+# pickles for about a fifth less size.
+_COMPRESSION_LEVEL = 1
+
+_LIBRARY_MODULES = (create_node, node_tree_util, source_match)
+
+# The hash function of signatures, and the length of its digests.
+_SIGNATURE_HASH = hashlib.sha256
+_SIGNATURE_LENGTH = _SIGNATURE_HASH().digest_size
+
+# The hash of the library's source, as computed by GetLibraryVersion.
+_library_version = None
+
+
+class Error(Exception):
+  pass
+
+
+class DecodeError(Error):
+  pass
+
+
+def GetLibraryVersion():
+  """Returns a hash of the library's source and of the Python version.
+
+  The library has no version number, so this stands in for one: encodings
+  and caches made with one version are no good with another.
+  """
+  global _library_version
+  if _library_version is None:
+    version_hash = hashlib.sha1()
+    version_hash.update('{}\0{}\0'.format(_FORMAT_VERSION, sys.version))
+    for module in _LIBRARY_MODULES:
+      path = os.path.splitext(module.__file__)[0] + '.py'
+      with open(path, 'rb') as source_file:
+        version_hash.update(source_file.read())
+    _library_version = version_hash.hexdigest()
+  return _library_version
+
+
+def _GetHeader():
+  return '{} {}\n'.format(_MAGIC, GetLibraryVersion())
+
+
+def _GetSignature(key, payload):
+  return hmac.new(key, payload, _SIGNATURE_HASH).digest()
+
+
+def EncodeNode(node, key=None):
+  """Encodes an annotated tree as a string.
+
+  Args:
+    node: {_ast.AST} The root of the tree, usually an _ast.Module.
+    key: {str} A secret key to sign the encoding with, or None to leave it
+        unsigned.
+
+  Returns:
+    The encoding, as a string.
+
+  Raises:
+    cPickle.PicklingError: If the tree holds objects that can't be pickled.
+    RuntimeError: If the tree is too deep to pickle.
+  """
+  payload = zlib.compress(
+      cPickle.dumps(node, cPickle.HIGHEST_PROTOCOL), _COMPRESSION_LEVEL)
+  if key is not None:
+    payload = _GetSignature(key, payload) + payload
+  return _GetHeader() + payload
+
+
+def DecodeNode(data, key=None):
+  """Decodes a tree that EncodeNode encoded.
+
+  Without a key, data is unpickled as it is, which runs any code it asks
+  for. Only leave out the key for data from a trusted source.
+
+  Args:
+    data: {str} The encoding.
+    key: {str} The secret key the encoding was signed with, or None if it
+        isn't signed.
+
+  Returns:
+    The root of a new tree, equal to the one that was encoded.
+
+  Raises:
+    DecodeError: If data is not an encoding made with this library version,
+        or with a key, if it isn't signed with the key.
+  """
+  header = _GetHeader()
+  if not data.startswith(header):
+    raise DecodeError(
+        'Data does not start with {!r}, so it was not encoded with this '
+        'version of the library'.format(header))
+  start = len(header)
+  if key is not None:
+    start += _SIGNATURE_LENGTH
+    signature = data[len(header):start]
+    if not hmac.compare_digest(
+        signature, _GetSignature(key, buffer(data, start))):
+      raise DecodeError('Data is not signed with the key')
+  try:
+    pickled_node = zlib.decompress(buffer(data, start))
+  except zlib.error as e:
+    raise DecodeError('Data is corrupt: {}'.format(e))
+  # Trees are made of many small objects, which otherwise set off
+  # collections over and over while they are loaded.
+  gc_was_enabled = gc.isenabled()
+  gc.disable()
+  try:
+    return cPickle.loads(pickled_node)
+  except Exception as e:  # pylint: disable=broad-except
+    raise DecodeError('Data is corrupt: {!r}'.format(e))
+  finally:
+    if gc_was_enabled:
+      gc.enable()
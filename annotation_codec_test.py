@@ -0,0 +1,131 @@
+"""Copyright 2014 Google Inc. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Tests for annotation_codec.py
+"""
+
+import ast
+import cPickle
+import gc
+import multiprocessing
+import unittest
+
+import annotation_codec
+import create_node
+import source_match
+
+
+def _EncodeMatchedModule(text):
+  module_node = ast.parse(text)
+  source_match.GetSource(module_node, text)
+  return annotation_codec.EncodeNode(module_node)
+
+
+class AnnotationCodecTest(unittest.TestCase):
+
+  def setUp(self):
+    self.text = (
+        '"""Doc."""\n'
+        '\n'
+        'def f(a,  b=(1, 2)):  # comment\n'
+        '  return [a,\n'
+        '          b]  # another\n')
+    self.module_node = ast.parse(self.text)
+    source_match.GetSource(self.module_node, self.text)
+
+  def testRoundTrip(self):
+    new_node = annotation_codec.DecodeNode(
+        annotation_codec.EncodeNode(self.module_node))
+    self.assertIsNot(self.module_node, new_node)
+    self.assertEqual(ast.dump(self.module_node), ast.dump(new_node))
+    self.assertEqual(self.text, new_node.matcher.GetSource())
+    self.assertIsInstance(new_node.body[1], create_node.SyntaxFreeLine)
+
+  def testDecodedTreeCanBeChanged(self):
+    new_node = annotation_codec.DecodeNode(
+        annotation_codec.EncodeNode(self.module_node))
+    new_node.body[2].body[0].value.elts[0].id = 'c'
+    self.assertIn('  return [c,\n', new_node.matcher.GetSource())
+    self.assertEqual(self.text, self.module_node.matcher.GetSource())
+
+  def testSmallerThanPickle(self):
+    text = self.text * 50
+    module_node = ast.parse(text)
+    source_match.GetSource(module_node, text)
+    self.assertLess(len(annotation_codec.EncodeNode(module_node)) * 3,
+                    len(cPickle.dumps(module_node, cPickle.HIGHEST_PROTOCOL)))
+
+  def testSourceBuffer(self):
+    text = source_match.SourceBuffer(self.text + '#' * 200 + '\n')
+    module_node = ast.parse(text)
+    source_match.GetSource(module_node, text)
+    new_node = annotation_codec.DecodeNode(
+        annotation_codec.EncodeNode(module_node))
+    self.assertEqual(text, new_node.matcher.GetSource())
+    self.assertIsInstance(new_node.source_buffer, source_match.SourceBuffer)
+
+  def testEncodeSubtree(self):
+    function_node = self.module_node.body[2]
+    new_node = annotation_codec.DecodeNode(
+        annotation_codec.EncodeNode(function_node))
+    self.assertEqual(function_node.matcher.GetSource(),
+                     new_node.matcher.GetSource())
+
+  def testAcrossProcesses(self):
+    pool = multiprocessing.Pool(1)
+    try:
+      data = pool.apply(_EncodeMatchedModule, (self.text,))
+    finally:
+      pool.terminate()
+      pool.join()
+    new_node = annotation_codec.DecodeNode(data)
+    self.assertEqual(self.text, new_node.matcher.GetSource())
+
+  def testOtherVersion(self):
+    data = annotation_codec.EncodeNode(self.module_node)
+    annotation_codec._library_version = 'other'
+    try:
+      with self.assertRaises(annotation_codec.DecodeError):
+        annotation_codec.DecodeNode(data)
+    finally:
+      annotation_codec._library_version = None
+
+  def testCorruptData(self):
+    data = annotation_codec.EncodeNode(self.module_node)
+    with self.assertRaises(annotation_codec.DecodeError):
+      annotation_codec.DecodeNode(data[:len(data) // 2])
+    self.assertTrue(gc.isenabled())
+    with self.assertRaises(annotation_codec.DecodeError):
+      annotation_codec.DecodeNode('not an annotation')
+
+
+  def testSigned(self):
+    data = annotation_codec.EncodeNode(self.module_node, key='key')
+    new_node = annotation_codec.DecodeNode(data, key='key')
+    self.assertEqual(self.text, new_node.matcher.GetSource())
+    with self.assertRaises(annotation_codec.DecodeError):
+      annotation_codec.DecodeNode(data, key='other key')
+    with self.assertRaises(annotation_codec.DecodeError):
+      annotation_codec.DecodeNode(data[:-1] + chr(ord(data[-1]) ^ 1),
+                                  key='key')
+
+  def testUnsignedDataIsRefusedWithKey(self):
+    data = annotation_codec.EncodeNode(self.module_node)
+    with self.assertRaises(annotation_codec.DecodeError):
+      annotation_codec.DecodeNode(data, key='key')
+
+
+if __name__ == '__main__':
+  unittest.main()
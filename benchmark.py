@@ -0,0 +1,378 @@
+"""Copyright 2014 Google Inc. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Benchmarks for source_match, create_node and node_tree_util.
+
+Every benchmark runs on generated input, so runs are reproducible, and in a
+process of its own, so the peak memory of one doesn't hide another's. Times
+are the best of --repeat runs.
+
+Usage:
+  python benchmark.py [--scale N] [--repeat N] [--json FILE]
+                      [--compare FILE] [benchmark ...]
+"""
+
+import argparse
+import ast
+import collections
+import functools
+import gc
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+import time
+
+import create_node
+import node_tree_util
+import source_match
+
+
+def DeepExpressions(scale):
+  """Statements with long chains of binary operations."""
+  return ''.join(
+      'x{} = {}\n'.format(i, ' + '.join('a{}'.format(j) for j in xrange(100)))
+      for i in xrange(scale))
+
+
+def WideModule(scale):
+  """Many small module level statements."""
+  return ''.join(
+      'def f{0}(a, b=1):\n'
+      '  return a + b\n'
+      'x{0} = f{0}(1)\n'
+      'import os{0}\n'.format(i)
+      for i in xrange(10 * scale))
+
+
+def LongStrings(scale):
+  """Long docstrings and implicitly concatenated strings with escapes."""
+  return ''.join(
+      'def f{}():\n'
+      '  """{}"""\n'
+      '  return ("{}"\n'
+      '          \'{}\')\n'.format(
+          i, 'A \\"quoted\\" docstring line.\n  ' * 20, 'x\\"y' * 50,
+          'z\\\'w' * 50)
+      for i in xrange(scale))
+
+
+def HeavyComments(scale):
+  """Comments between statements and inside brackets."""
+  comment = '  # A comment about the line below.\n'
+  return ''.join(
+      'def f{}(a,  # first\n'
+      '      b):  # second\n'.format(i) + comment * 5 +
+      '  x = [a,  # element\n' + comment * 3 +
+      '       b]\n' + comment * 5 +
+      '  return x\n'
+      for i in xrange(scale))
+
+
+def ManyParens(scale):
+  """Redundant parentheses around expressions and statements' parts."""
+  return ''.join(
+      'x{} = ((a) + ((b) * (c)))\n'
+      'if ((x) and (y)):\n'
+      '  f(((a)), (b), ((c, d)))\n'.format(i)
+      for i in xrange(5 * scale))
+
+
+def NestedTuples(scale):
+  """Unparenthesized tuples, with tuples nested in them, in assignments."""
+  nested = 'a'
+  for i in xrange(8):
+    nested = '(b{0}, {1}, c{0})'.format(i, nested)
+  return ''.join(
+      'x{0}, y{0} = {1}, z{0}\n'
+      'for i{0}, (j{0}, k{0}) in {1}, z{0}:\n'
+      '  yield i{0}, {1}\n'.format(i, nested)
+      for i in xrange(5 * scale))
+
+
+def BannerComments(scale):
+  """Comments made of runs of '#' inside parenthesized expressions.
+
+  The regexes skipping comments backtrack exponentially in the number of '#'
+  in a comment when the match after it fails, which TokenizedText avoids.
+  """
+  return ''.join(
+      'x{} = (a  # {}\n'
+      '      + b)\n'.format(i, '#' * 10)
+      for i in xrange(5 * scale))
+
+
+CORPORA = collections.OrderedDict([
+    ('deep_expressions', DeepExpressions),
+    ('wide_module', WideModule),
+    ('long_strings', LongStrings),
+    ('heavy_comments', HeavyComments),
+    ('many_parens', ManyParens),
+    ('nested_tuples', NestedTuples),
+    ('banner_comments', BannerComments),
+])
+
+
+def _GetMaxRssKb():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _Time(function, repeat):
+  """Returns the shortest time function takes, and what it returned then."""
+  best_seconds = None
+  for _ in xrange(repeat):
+    start_time = time.time()
+    result = function()
+    seconds = time.time() - start_time
+    if best_seconds is None or seconds < best_seconds:
+      best_seconds = seconds
+  return best_seconds, result
+
+
+def _Annotate(text):
+  module_node = ast.parse(text)
+  source_match.GetSource(module_node, text)
+  return module_node
+
+
+def BenchmarkCorpus(name, scale, repeat):
+  """Benchmarks annotating and getting the source of a generated corpus.
+
+  Args:
+    name: {str} The key of the corpus in CORPORA.
+    scale: {int} How big to make the corpus.
+    repeat: {int} How many times to time each step.
+
+  Returns:
+    A dict of what was measured:
+      lines, nodes: The size of the corpus.
+      annotate_seconds: The time GetSource(module, text) takes, without
+          parsing.
+      get_source_seconds: The time module.matcher.GetSource() then takes.
+      lazy_annotate_seconds: The time GetSource(module, text, lazy=True)
+          takes, without parsing.
+      tokenized_annotate_seconds: The time GetSource takes with the text as
+          a TokenizedText, including tokenizing it, without parsing.
+      peak_memory_kb: How much the peak RSS grew while annotating once.
+      objects_per_node: The objects tracked by the garbage collector that
+          annotation adds, per node. CPython doesn't count allocations
+          outside of debug builds, so this counts the ones that are kept.
+  """
+  text = CORPORA[name](scale)
+  module_node = ast.parse(text)
+  num_nodes = sum(1 for _ in ast.walk(module_node))
+  sys.setrecursionlimit(max(sys.getrecursionlimit(), 20000))
+
+  gc.collect()
+  num_objects = len(gc.get_objects())
+  max_rss_kb = _GetMaxRssKb()
+  source_match.GetSource(module_node, text)
+  peak_memory_kb = _GetMaxRssKb() - max_rss_kb
+  gc.collect()
+  objects_per_node = float(len(gc.get_objects()) - num_objects) / num_nodes
+  if module_node.matcher.GetSource() != text:
+    raise AssertionError('{} does not round trip'.format(name))
+  del module_node
+
+  def Annotate():
+    module_node = ast.parse(text)
+    start_time = time.time()
+    source_match.GetSource(module_node, text)
+    return time.time() - start_time, module_node
+  annotate_seconds, module_node = min(
+      Annotate() for _ in xrange(repeat))
+  get_source_seconds, _ = _Time(module_node.matcher.GetSource, repeat)
+
+  def AnnotateLazily():
+    module_node = ast.parse(text)
+    start_time = time.time()
+    source_match.GetSource(module_node, text, lazy=True)
+    return time.time() - start_time
+  lazy_annotate_seconds = min(AnnotateLazily() for _ in xrange(repeat))
+
+  def AnnotateTokenized():
+    module_node = ast.parse(text)
+    start_time = time.time()
+    source_match.GetSource(module_node, source_match.TokenizedText(text))
+    return time.time() - start_time
+  tokenized_annotate_seconds = min(
+      AnnotateTokenized() for _ in xrange(repeat))
+  return {
+      'lines': text.count('\n'),
+      'nodes': num_nodes,
+      'annotate_seconds': annotate_seconds,
+      'get_source_seconds': get_source_seconds,
+      'lazy_annotate_seconds': lazy_annotate_seconds,
+      'tokenized_annotate_seconds': tokenized_annotate_seconds,
+      'peak_memory_kb': peak_memory_kb,
+      'objects_per_node': objects_per_node,
+  }
+
+
+def BenchmarkCreateNode(scale, repeat):
+  """Benchmarks creating functions with create_node and their default source.
+
+  Returns:
+    A dict with the number of nodes created, create_seconds and
+    get_source_seconds.
+  """
+  def Create():
+    return create_node.Module(*[
+        create_node.FunctionDef(
+            'f{}'.format(i), ('a', 'b'), body=[
+                create_node.Assign(
+                    'x', create_node.BinOp('a', create_node.Add(), 'b')),
+                create_node.If(
+                    create_node.Compare('x', '>', 'b'),
+                    body=[create_node.Return(
+                        create_node.Call('g', args=('x',)))]),
+                create_node.Return(create_node.List('a', 'b'))])
+        for i in xrange(scale)])
+  create_seconds, module_node = _Time(Create, repeat)
+
+  def GetDefaultSource():
+    module_node = Create()
+    for node in ast.walk(module_node):
+      node.module_node = module_node
+    start_time = time.time()
+    source_match.GetSource(module_node)
+    return time.time() - start_time
+  return {
+      'nodes': sum(1 for _ in ast.walk(module_node)),
+      'create_seconds': create_seconds,
+      'get_source_seconds': min(GetDefaultSource() for _ in xrange(repeat)),
+  }
+
+
+def BenchmarkNodeTreeUtil(scale, repeat):
+  """Benchmarks copying and looking up nodes in an annotated module.
+
+  Returns:
+    A dict with the number of nodes, and the times NodeCopy takes with and
+    without copying matchers, building a TreeIndex takes, and looking up the
+    indent level of every node takes with the TreeIndex.
+  """
+  text = WideModule(scale)
+  module_node = _Annotate(text)
+  nodes = list(ast.walk(module_node))
+  copy_seconds, _ = _Time(
+      lambda: node_tree_util.NodeCopy(module_node), repeat)
+  copy_matchers_seconds, _ = _Time(
+      lambda: node_tree_util.NodeCopy(module_node, copy_matchers=True),
+      repeat)
+  tree_index_seconds, tree_index = _Time(
+      lambda: node_tree_util.TreeIndex(module_node), repeat)
+  indexed_nodes = [node for node in nodes if node in tree_index]
+  indent_level_seconds, _ = _Time(
+      lambda: [tree_index.GetIndentLevel(node) for node in indexed_nodes],
+      repeat)
+  return {
+      'nodes': len(nodes),
+      'node_copy_seconds': copy_seconds,
+      'node_copy_matchers_seconds': copy_matchers_seconds,
+      'tree_index_seconds': tree_index_seconds,
+      'indent_level_seconds': indent_level_seconds,
+  }
+
+
+BENCHMARKS = collections.OrderedDict(
+    [(name, functools.partial(BenchmarkCorpus, name)) for name in CORPORA] +
+    [('create_node', BenchmarkCreateNode),
+     ('node_tree_util', BenchmarkNodeTreeUtil)])
+
+
+def _RunBenchmark(name, scale, repeat):
+  return BENCHMARKS[name](scale, repeat)
+
+
+def RunBenchmarks(names, scale, repeat):
+  """Runs benchmarks, each in a new process.
+
+  Args:
+    names: {[str]} Keys of BENCHMARKS.
+    scale: {int} How big to make the input of the benchmarks.
+    repeat: {int} How many times to time each step.
+
+  Returns:
+    An OrderedDict of name: the dict of what the benchmark measured.
+  """
+  results = collections.OrderedDict()
+  for name in names:
+    pool = multiprocessing.Pool(1)
+    try:
+      results[name] = pool.apply(_RunBenchmark, (name, scale, repeat))
+    finally:
+      pool.terminate()
+      pool.join()
+  return results
+
+
+def _FormatResults(results, baseline=None):
+  """Formats results as a table, with the ratios to baseline if given."""
+  lines = []
+  for name, measurements in results.iteritems():
+    lines.append(name)
+    baseline_measurements = (baseline or {}).get(name, {})
+    for key, value in sorted(measurements.iteritems()):
+      line = '  {:<28}{:>14.4f}'.format(key, value)
+      baseline_value = baseline_measurements.get(key)
+      if baseline_value:
+        line += '  {:>7.2f}x'.format(float(value) / baseline_value)
+      lines.append(line)
+  return '\n'.join(lines)
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(
+      description='Benchmarks source_match, create_node and node_tree_util.')
+  parser.add_argument(
+      'benchmarks', nargs='*', metavar='benchmark',
+      help='The benchmarks to run, out of {}. Defaults to all of them.'
+      .format(', '.join(BENCHMARKS)))
+  parser.add_argument('--scale', type=int, default=50,
+                      help='How big to make the input of the benchmarks.')
+  parser.add_argument('--repeat', type=int, default=3,
+                      help='How many times to time each step.')
+  parser.add_argument('--json', metavar='FILE',
+                      help='Write the results to FILE as JSON.')
+  parser.add_argument('--compare', metavar='FILE',
+                      help='Show ratios to the results in FILE, as written '
+                      'by --json.')
+  args = parser.parse_args(argv)
+  names = args.benchmarks or list(BENCHMARKS)
+  for name in names:
+    if name not in BENCHMARKS:
+      parser.error('Unknown benchmark {}'.format(name))
+
+  results = RunBenchmarks(names, args.scale, args.repeat)
+  baseline = None
+  if args.compare:
+    with open(args.compare) as baseline_file:
+      baseline = json.load(baseline_file)['results']
+  print _FormatResults(results, baseline)
+  if args.json:
+    with open(args.json, 'w') as json_file:
+      json.dump({
+          'python': platform.python_version(),
+          'scale': args.scale,
+          'repeat': args.repeat,
+          'results': results,
+      }, json_file, indent=2)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,54 @@
+"""Copyright 2014 Google Inc. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Tests for benchmark.py
+"""
+
+import ast
+import unittest
+
+import benchmark
+
+
+class BenchmarkTest(unittest.TestCase):
+
+  def testCorporaParse(self):
+    for corpus in benchmark.CORPORA.itervalues():
+      text = corpus(2)
+      self.assertGreater(len(ast.parse(text).body), 1)
+
+  def testBenchmarks(self):
+    for name, function in benchmark.BENCHMARKS.iteritems():
+      results = function(1, 1)
+      self.assertGreater(results['nodes'], 1, name)
+      for value in results.itervalues():
+        self.assertGreaterEqual(value, 0)
+
+  def testRunBenchmarks(self):
+    results = benchmark.RunBenchmarks(['wide_module'], 1, 1)
+    self.assertEqual(['wide_module'], results.keys())
+    self.assertEqual(40, results['wide_module']['lines'])
+
+  def testFormatResults(self):
+    self.assertEqual(
+        'a\n'
+        '  x                                   2.0000     0.50x\n'
+        '  y                                   1.0000',
+        benchmark._FormatResults({'a': {'x': 2.0, 'y': 1}},
+                                 {'a': {'x': 4.0}}))
+
+
+if __name__ == '__main__':
+  unittest.main()
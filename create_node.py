@@ -826,6 +826,9 @@ def Subscript(value, upper=None, lower=None, step=None, ctx=CtxEnum.STORE):
       value=value, slice=Slice(upper, lower, step), ctx=GetCtx(ctx))
 
 
+_SYNTAX_FREE_LINE_RE = re.compile('([ \t]*)(?:|(#)([ \t]*)(.*))\n')
+
+
 class SyntaxFreeLine(_ast.stmt):
   """Class defining a new node that has no syntax (only optional comments)."""
 
@@ -845,8 +848,8 @@ class SyntaxFreeLine(_ast.stmt):
     return ''
 
   @classmethod
-  def MatchesStart(cls, text):
-    return re.match('^([ \t]*)(?:|(#)([ \t]*)(.*))\n', text)
+  def MatchesStart(cls, text, pos=0):
+    return _SYNTAX_FREE_LINE_RE.match(text, pos)
 
   def SetFromSrcLine(self, line):
     match = self.MatchesStart(line)
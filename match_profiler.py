@@ -0,0 +1,257 @@
+"""Copyright 2014 Google Inc. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Profiling of source_match, by node type and by TextPlaceholder regex.
+
+Example:
+>>> profiler = match_profiler.Profiler()
+>>> with profiler:
+...   source_match.GetSource(module_node, some_code)
+>>> print profiler.FormatReport()
+
+While a Profiler is running, the matchers' MatchAt, GetSource and WriteSource
+methods, GetMatcher and MatchTextSpecAt are replaced by wrappers that record
+what they do. They are put back when it stops, so nothing is
+slowed down when no Profiler is running.
+"""
+
+import collections
+import timeit
+
+import source_match
+
+
+# What is recorded: how many calls there were, the time they took in total
+# and apart from nested calls that are recorded too, and how many characters
+# they matched or returned.
+ProfileStats = collections.namedtuple(
+    'ProfileStats', ['calls', 'seconds', 'self_seconds', 'num_chars'])
+
+# The kinds of calls that are recorded, and what their stats are keyed by.
+MATCH = 'match'  # Matcher MatchAt, by node type.
+GET_SOURCE = 'get_source'  # Matcher GetSource or WriteSource, by node type.
+GET_MATCHER = 'get_matcher'  # GetMatcher, by node type.
+REGEX = 'regex'  # MatchTextSpecAt, by original regex.
+KINDS = (MATCH, GET_SOURCE, GET_MATCHER, REGEX)
+
+
+class Error(Exception):
+  pass
+
+
+def _GetMatcherClasses():
+  """Returns SourceMatcher and its subclasses, wherever they are defined."""
+  classes = [source_match.SourceMatcher]
+  for cls in classes:
+    classes.extend(subclass for subclass in cls.__subclasses__()
+                   if subclass not in classes)
+  return classes
+
+
+class Profiler(object):
+  """Records calls into source_match while it is running.
+
+  Only one Profiler can run at a time. A Profiler can be started and stopped
+  more than once, and adds up what it records.
+  """
+
+  # The Profiler that is running, if any.
+  _running = None
+
+  def __init__(self):
+    # A mapping of (kind, key): [calls, seconds, self_seconds, num_chars].
+    self._stats = {}
+    # [object, seconds spent in nested recorded calls] for each recorded call
+    # in progress, innermost last.
+    self._stack = []
+    # (owner, name, original value) for each replaced attribute.
+    self._originals = []
+
+  def __enter__(self):
+    self.Start()
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self.Stop()
+
+  def Start(self):
+    """Starts recording.
+
+    Raises:
+      Error: If a Profiler is running already.
+    """
+    if Profiler._running is not None:
+      raise Error('A Profiler is running already')
+    Profiler._running = self
+    for cls in _GetMatcherClasses():
+      for name, kind in (('MatchAt', MATCH), ('GetSource', GET_SOURCE)):
+        if name in vars(cls):
+          self._Replace(cls, name, self._WrapMatcherMethod(
+              vars(cls)[name], kind))
+      if 'WriteSource' in vars(cls):
+        self._Replace(cls, 'WriteSource', self._WrapWriteSource(
+            vars(cls)['WriteSource']))
+    self._Replace(source_match, 'GetMatcher',
+                  self._WrapGetMatcher(source_match.GetMatcher))
+    self._Replace(source_match, 'MatchTextSpecAt',
+                  self._WrapMatchTextSpecAt(source_match.MatchTextSpecAt))
+
+  def Stop(self):
+    """Stops recording, and puts back the functions that were replaced."""
+    if Profiler._running is not self:
+      return
+    for owner, name, original in reversed(self._originals):
+      setattr(owner, name, original)
+    self._originals = []
+    del self._stack[:]
+    Profiler._running = None
+
+  def _Replace(self, owner, name, value):
+    self._originals.append((owner, name, vars(owner)[name]))
+    setattr(owner, name, value)
+
+  def _Record(self, kind, key, seconds, self_seconds, num_chars):
+    stats = self._stats.get((kind, key))
+    if stats is None:
+      stats = self._stats[(kind, key)] = [0, 0.0, 0.0, 0]
+    stats[0] += 1
+    stats[1] += seconds
+    stats[2] += self_seconds
+    stats[3] += num_chars
+
+  def _CallAndRecord(self, kind, key, function, args, kwargs, pos=None,
+                     num_chars_written=None):
+    """Calls function with args and kwargs, recording the call.
+
+    Args:
+      kind: {str} One of KINDS.
+      key: The key to record the call under.
+      function: The function to call.
+      args: {tuple} The positional arguments, starting with the object the
+          call is for.
+      kwargs: {dict} The keyword arguments.
+      pos: {int} For calls that match text, the offset the match starts at.
+          They return the offset the match ends at, or -1 if there is no
+          match.
+      num_chars_written: {[int]} For calls that write source, a list holding
+          the number of characters they write, counted as they write them.
+
+    Returns:
+      What function returned.
+    """
+    stack = self._stack
+    stack.append([args[0], 0.0])
+    start_time = timeit.default_timer()
+    num_chars = 0
+    try:
+      result = function(*args, **kwargs)
+      if pos is not None:
+        num_chars = max(result - pos, 0)
+      elif num_chars_written is not None:
+        num_chars = num_chars_written[0]
+      elif isinstance(result, basestring):
+        num_chars = len(result)
+      return result
+    finally:
+      seconds = timeit.default_timer() - start_time
+      nested_seconds = stack.pop()[1]
+      if stack:
+        stack[-1][1] += seconds
+      self._Record(kind, key, seconds, seconds - nested_seconds, num_chars)
+
+  def _WrapMatcherMethod(self, method, kind):
+    stack = self._stack
+
+    def Wrapper(matcher, *args, **kwargs):
+      # Methods calling the method they override aren't recorded twice.
+      if stack and stack[-1][0] is matcher:
+        return method(matcher, *args, **kwargs)
+      return self._CallAndRecord(
+          kind, type(matcher.node), method, (matcher,) + args, kwargs,
+          pos=args[1] if kind == MATCH else None)
+    return Wrapper
+
+  def _WrapWriteSource(self, write_source):
+    stack = self._stack
+
+    def Wrapper(matcher, write):
+      if stack and stack[-1][0] is matcher:
+        return write_source(matcher, write)
+      num_chars_written = [0]
+
+      def CountingWrite(fragment):
+        num_chars_written[0] += len(fragment)
+        write(fragment)
+      return self._CallAndRecord(
+          GET_SOURCE, type(matcher.node), write_source,
+          (matcher, CountingWrite), {}, num_chars_written=num_chars_written)
+    return Wrapper
+
+  def _WrapGetMatcher(self, get_matcher):
+
+    def Wrapper(node, *args, **kwargs):
+      return self._CallAndRecord(
+          GET_MATCHER, type(node), get_matcher, (node,) + args, kwargs)
+    return Wrapper
+
+  def _WrapMatchTextSpecAt(self, match_text_spec_at):
+
+    def Wrapper(spec, text, pos):
+      return self._CallAndRecord(
+          REGEX, spec.original_regex, match_text_spec_at, (spec, text, pos),
+          {}, pos=pos)
+    return Wrapper
+
+  def GetStats(self, kind):
+    """Gets what was recorded for a kind of call.
+
+    Args:
+      kind: {str} One of KINDS.
+
+    Returns:
+      A dict of key: ProfileStats, where the key is the node type or regex.
+    """
+    return dict((key, ProfileStats(*stats))
+                for (stats_kind, key), stats in self._stats.iteritems()
+                if stats_kind == kind)
+
+  def Clear(self):
+    """Forgets what was recorded so far."""
+    self._stats.clear()
+
+  def FormatReport(self, limit=20):
+    """Formats what was recorded as tables, one for each kind of call.
+
+    Args:
+      limit: {int} How many of the keys with the most self time to show in
+          each table.
+
+    Returns:
+      The report, as a string.
+    """
+    lines = []
+    for kind in KINDS:
+      stats = sorted(self.GetStats(kind).iteritems(),
+                     key=lambda item: item[1].self_seconds, reverse=True)
+      if not stats:
+        continue
+      lines.append('{:<32}{:>9}{:>11}{:>11}{:>12}'.format(
+          kind, 'calls', 'seconds', 'self', 'chars'))
+      for key, key_stats in stats[:limit]:
+        name = key.__name__ if isinstance(key, type) else repr(key)
+        lines.append('  {:<30}{:>9}{:>11.4f}{:>11.4f}{:>12}'.format(
+            name[:30], key_stats.calls, key_stats.seconds,
+            key_stats.self_seconds, key_stats.num_chars))
+    return '\n'.join(lines)
@@ -0,0 +1,125 @@
+"""Copyright 2014 Google Inc. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Tests for match_profiler.py
+"""
+
+import _ast
+import ast
+import cStringIO
+import unittest
+
+import match_profiler
+import source_match
+
+
+class ProfilerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.string = 'def f(a, b):\n  return a + b\n'
+    self.module_node = ast.parse(self.string)
+    self.profiler = match_profiler.Profiler()
+
+  def tearDown(self):
+    self.profiler.Stop()
+
+  def testRecordsMatchesByNodeType(self):
+    with self.profiler:
+      source_match.GetSource(self.module_node, self.string)
+    match_stats = self.profiler.GetStats(match_profiler.MATCH)
+    self.assertEqual(1, match_stats[_ast.FunctionDef].calls)
+    self.assertEqual(len(self.string),
+                     match_stats[_ast.FunctionDef].num_chars)
+    # The arguments are Name nodes too.
+    self.assertEqual(4, match_stats[_ast.Name].calls)
+    self.assertEqual(4, match_stats[_ast.Name].num_chars)
+    function_stats = match_stats[_ast.FunctionDef]
+    self.assertLessEqual(function_stats.self_seconds, function_stats.seconds)
+    get_matcher_stats = self.profiler.GetStats(match_profiler.GET_MATCHER)
+    self.assertEqual(1, get_matcher_stats[_ast.BinOp].calls)
+
+  def testRecordsRegexes(self):
+    with self.profiler:
+      source_match.GetSource(self.module_node, self.string)
+    regex_stats = self.profiler.GetStats(match_profiler.REGEX)
+    self.assertEqual(1, regex_stats[r'\s*,\s*'].calls)
+    self.assertEqual(2, regex_stats[r'\s*,\s*'].num_chars)
+
+  def testRecordsParenRegexes(self):
+    string = 'x = (a)\n'
+    module_node = ast.parse(string)
+    with self.profiler:
+      source_match.GetSource(module_node, string)
+    regex_stats = self.profiler.GetStats(match_profiler.REGEX)
+    self.assertEqual(1, regex_stats[r'\(\s*'].num_chars)
+    self.assertEqual(1, regex_stats[r'\s*\)'].num_chars)
+
+  def testRecordsGetSource(self):
+    source_match.GetSource(self.module_node, self.string)
+    with self.profiler:
+      self.module_node.matcher.GetSource()
+    get_source_stats = self.profiler.GetStats(match_profiler.GET_SOURCE)
+    self.assertEqual(1, get_source_stats[_ast.Module].calls)
+    self.assertEqual(len(self.string),
+                     get_source_stats[_ast.Module].num_chars)
+    self.assertFalse(self.profiler.GetStats(match_profiler.MATCH))
+
+  def testRecordsWriteSource(self):
+    source_match.GetSource(self.module_node, self.string)
+    output = cStringIO.StringIO()
+    with self.profiler:
+      source_match.WriteSource(self.module_node, output)
+    get_source_stats = self.profiler.GetStats(match_profiler.GET_SOURCE)
+    self.assertEqual(1, get_source_stats[_ast.Module].calls)
+    self.assertEqual(len(self.string),
+                     get_source_stats[_ast.Module].num_chars)
+    self.assertEqual(self.string, output.getvalue())
+
+  def testRecordsFailedMatches(self):
+    node = ast.parse('a + b').body[0].value
+    with self.profiler:
+      with self.assertRaises(source_match.BadlySpecifiedTemplateError):
+        source_match.GetSource(node, 'a - b')
+    self.assertEqual(
+        1, self.profiler.GetStats(match_profiler.MATCH)[_ast.BinOp].calls)
+
+  def testStopPutsBackFunctions(self):
+    get_matcher = source_match.GetMatcher
+    match_at = vars(source_match.DefaultSourceMatcher)['MatchAt']
+    with self.profiler:
+      self.assertIsNot(get_matcher, source_match.GetMatcher)
+    self.assertIs(get_matcher, source_match.GetMatcher)
+    self.assertIs(match_at, vars(source_match.DefaultSourceMatcher)['MatchAt'])
+    source_match.GetSource(self.module_node, self.string)
+    self.assertFalse(self.profiler.GetStats(match_profiler.MATCH))
+
+  def testOnlyOneProfilerRuns(self):
+    with self.profiler:
+      with self.assertRaises(match_profiler.Error):
+        match_profiler.Profiler().Start()
+
+  def testFormatReport(self):
+    with self.profiler:
+      source_match.GetSource(self.module_node, self.string)
+    report = self.profiler.FormatReport(limit=2)
+    lines = report.splitlines()
+    self.assertTrue(lines[0].startswith('match'))
+    self.assertEqual(4 * 3, len(lines))
+    self.profiler.Clear()
+    self.assertEqual('', self.profiler.FormatReport())
+
+
+if __name__ == '__main__':
+  unittest.main()
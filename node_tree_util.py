@@ -22,6 +22,8 @@ import ast
 import collections
 import copy
 
+import create_node
+
 
 # TODO: Handle TryExcept better
 TYPE_TO_INDENT_FIELD = {
@@ -49,99 +51,363 @@ class IndentLevelVisitor(ast.NodeVisitor):
     """Called if no explicit visitor function exists for a node."""
     if node == self.node_to_check:
       self.final_indent = self.current_indent
+    indent_level = self.current_indent
     for field, value in ast.iter_fields(node):
-      if (isinstance(node, tuple(TYPE_TO_INDENT_FIELD.keys())) and
-          field in TYPE_TO_INDENT_FIELD[node.__class__]):
-        self.current_indent += 1
+      self.current_indent = _GetChildIndentLevel(node, field, indent_level)
       if isinstance(value, list):
         for item in value:
           if isinstance(item, _ast.AST):
             self.visit(item)
       elif isinstance(value, _ast.AST):
         self.visit(value)
-      if (isinstance(node, tuple(TYPE_TO_INDENT_FIELD.keys())) and
-          field in TYPE_TO_INDENT_FIELD[node.__class__]):
-        self.current_indent -= 1
+    self.current_indent = indent_level
     return node
 
-  def visit_With(self, node):
-    if hasattr(node, 'matcher') and node.matcher.is_compound_with:
-      self.current_indent -= 1
-    self.generic_visit(node)
-    return node
+
+def _IsCompoundWith(node):
+  """Returns whether node is a with statement with more than one item.
+
+  The parser turns "with a, b:" into a with statement for a whose body is
+  just a with statement for b. Once node is matched, its matcher knows which
+  it was. Before that, it is recognized by b being on the same line, so a
+  with statement continued onto another line before b is taken to be two
+  nested ones.
+  """
+  if not (isinstance(node, _ast.With) and len(node.body) == 1 and
+          isinstance(node.body[0], _ast.With)):
+    return False
+  is_compound_with = getattr(getattr(node, 'matcher', None),
+                             'is_compound_with', None)
+  if is_compound_with is not None:
+    return is_compound_with
+  lineno = getattr(node, 'lineno', None)
+  return lineno is not None and lineno == getattr(node.body[0], 'lineno', None)
+
+
+def _GetChildIndentLevel(node, field_name, indent_level):
+  """Returns the indent level of the nodes in a field of node."""
+  if field_name not in TYPE_TO_INDENT_FIELD.get(type(node), ()):
+    return indent_level
+  # The body of a compound with statement is the with statement for its
+  # next item, which is at the same level.
+  if _IsCompoundWith(node):
+    return indent_level
+  return indent_level + 1
+
+
+def _GetPathToNode(root, node_to_find):
+  """Finds node_to_find in the tree under root.
+
+  The tree is searched depth first with an explicit stack, so deeply nested
+  trees don't hit the recursion limit, and the search stops at the first
+  occurrence of node_to_find.
+
+  Args:
+    root: {_ast.AST} The root of the tree to search.
+    node_to_find: {_ast.AST} The node to search for.
+
+  Returns:
+    A list of (ancestor, field_name) pairs from root down to the parent of
+    node_to_find, where field_name is the field of the ancestor that the
+    path continues in, or None if node_to_find isn't in the tree.
+  """
+  path = []
+  stack = [(root, None, 0)]
+  while stack:
+    node, field_name, depth = stack.pop()
+    del path[depth:]
+    if depth:
+      path[depth - 1] = (path[depth - 1][0], field_name)
+    if node is node_to_find:
+      return path
+    path.append((node, None))
+    children = []
+    for child_field_name, value in ast.iter_fields(node):
+      if isinstance(value, list):
+        for item in value:
+          if isinstance(item, _ast.AST):
+            children.append((item, child_field_name, depth + 1))
+      elif isinstance(value, _ast.AST):
+        children.append((value, child_field_name, depth + 1))
+    stack.extend(reversed(children))
+  return None
 
 
 def GetIndentLevel(module_node, node_to_check):
-  visitor = IndentLevelVisitor(node_to_check)
-  visitor.visit(module_node)
-  if visitor.final_indent is None:
+  """Returns the indent level of node_to_check, in levels rather than spaces.
+
+  In a compound with statement, like "with a, b:", the with statement for b
+  is at the same level as the one for a. The matcher of a matched with
+  statement says whether it is compound; in a tree that isn't matched, one
+  is recognized by b being on the same line, so one continued onto another
+  line before b is taken for two nested ones.
+
+  Raises:
+    ValueError: If node_to_check isn't in module_node.
+  """
+  path = _GetPathToNode(module_node, node_to_check)
+  if path is None:
     raise ValueError('node is not in module.')
-  return visitor.final_indent
+  indent_level = 0
+  for ancestor, field_name in path:
+    indent_level = _GetChildIndentLevel(ancestor, field_name, indent_level)
+  return indent_level
 
 
-class _WrappingStmtVisitor(ast.NodeVisitor):
+def GetWrappingStmtNode(module_node, node_in_stmt):
+  """Returns the innermost statement containing node_in_stmt.
 
-  def __init__(self, node_to_check):
-    self.node_to_check = node_to_check
-    self.current_stmt = None
-    self.correct_stmt = None
+  Args:
+    module_node: {_ast.AST} The root of the tree to search.
+    node_in_stmt: {_ast.AST} The node to get the statement of.
 
-  def generic_visit(self, node):
-    """Called if no explicit visitor function exists for a node."""
-    if isinstance(node, _ast.stmt):
-      self.current_stmt = node
-    if node == self.node_to_check:
-      self.correct_stmt = self.current_stmt
-    return super(_WrappingStmtVisitor, self).generic_visit(node)
+  Returns:
+    node_in_stmt if it is a statement itself, otherwise the innermost
+    statement it is in, or None if there is no such statement.
+  """
+  path = _GetPathToNode(module_node, node_in_stmt)
+  if path is None:
+    return None
+  if isinstance(node_in_stmt, _ast.stmt):
+    return node_in_stmt
+  for ancestor, unused_field_name in reversed(path):
+    if isinstance(ancestor, _ast.stmt):
+      return ancestor
+  return None
 
 
-def GetWrappingStmtNode(module_node, node_in_stmt):
-  visitor = _WrappingStmtVisitor(node_in_stmt)
-  visitor.visit(module_node)
-  return visitor.correct_stmt
+def GetParentNode(module_node, node_in_stmt):
+  path = _GetPathToNode(module_node, node_in_stmt)
+  if not path:
+    return None
+  return path[-1][0]
 
 
-class _ParentVisitor(ast.NodeVisitor):
+def _CopyValue(value, copies, nodes_to_fill):
+  """Copies a field value, leaving the fields of new nodes to be filled in."""
+  if isinstance(value, _ast.AST):
+    if id(value) not in copies:
+      if isinstance(value, create_node.SyntaxFreeLine):
+        new_node = create_node.SyntaxFreeLine(
+            value.comment, value.col_offset, value.comment_indent)
+      else:
+        new_node = type(value)()
+      copies[id(value)] = new_node
+      nodes_to_fill.append(value)
+    return copies[id(value)]
+  elif isinstance(value, list):
+    return [_CopyValue(item, copies, nodes_to_fill) for item in value]
+  elif isinstance(value, basestring):
+    return value
+  elif isinstance(value, collections.Iterable):
+    raise NotImplementedError(
+        'Unrecognized iterable {}. Please add support'.format(value))
+  else:
+    return copy.copy(value)
 
-  def __init__(self, node_to_check):
-    self.node_to_check = node_to_check
-    self.parent_stack = []
-    self.correct_parent = None
 
-  def generic_visit(self, node):
-    """Called if no explicit visitor function exists for a node."""
-    if self.correct_parent:
-      return node
-    if node == self.node_to_check:
-      self.correct_parent = self.parent_stack.pop()
-    self.parent_stack.append(node)
-    super(_ParentVisitor, self).generic_visit(node)
-    self.parent_stack.pop()
+def NodeCopy(node_to_copy, copy_attributes=False, copy_matchers=False):
+  """Copies the node by copying its fields, and the nodes in them.
 
+  The tree is copied without recursion, so deep trees can be copied.
 
-def GetParentNode(module_node, node_in_stmt):
-  visitor = _ParentVisitor(node_in_stmt)
-  visitor.visit(module_node)
-  return visitor.correct_parent
-
-
-def NodeCopy(node_to_copy):
-  """Copies the node by recursively copying its fields."""
-  if not isinstance(node_to_copy, _ast.AST):
-    if isinstance(node_to_copy, list):
-      new_list = []
-      for child in node_to_copy:
-        new_list.append(NodeCopy(child))
-      return new_list
-    elif isinstance(node_to_copy, str):
-      return node_to_copy
-    elif isinstance(node_to_copy, collections.Iterable):
-      raise NotImplementedError(
-          'Unrecognized iterable {}. Please add support'.format(node_to_copy))
+  Args:
+    node_to_copy: {_ast.AST|list} The node (or list of nodes) to copy.
+    copy_attributes: {bool} Whether to copy the attributes of the nodes, like
+        lineno and col_offset, as well.
+    copy_matchers: {bool} Whether to copy the .matcher of the nodes as well.
+        The copied matchers refer to the copied nodes, so the copy keeps the
+        formatting of the original without being matched again.
+
+  Returns:
+    The copy.
+  """
+  copies = {}
+  nodes_to_fill = []
+  new_value = _CopyValue(node_to_copy, copies, nodes_to_fill)
+  index = 0
+  while index < len(nodes_to_fill):
+    node = nodes_to_fill[index]
+    new_node = copies[id(node)]
+    index += 1
+    if not isinstance(node, create_node.SyntaxFreeLine):
+      for field_name in node._fields:
+        setattr(new_node, field_name, _CopyValue(
+            getattr(node, field_name), copies, nodes_to_fill))
+    if copy_attributes:
+      for attribute_name in node._attributes:
+        if hasattr(node, attribute_name):
+          setattr(new_node, attribute_name, getattr(node, attribute_name))
+
+  if copy_matchers:
+    # Everything in the matchers that refers to an original node refers to
+    # its copy instead, since the memo of deepcopy starts out with them.
+    memo = dict(copies)
+    for node in nodes_to_fill:
+      matcher = getattr(node, 'matcher', None)
+      if matcher:
+        new_matcher = copy.deepcopy(matcher, memo)
+        # The copy isn't part of any SourceCache the original is in.
+        new_matcher.cached_source = None
+        copies[id(node)].matcher = new_matcher
+  return new_value
+
+
+# Instances of these are shared between nodes by the parser, so they don't
+# have a single parent and aren't indexed by TreeIndex.
+_SHARED_NODE_TYPES = (_ast.expr_context, _ast.boolop, _ast.operator,
+                      _ast.unaryop, _ast.cmpop)
+
+
+class _NodeLocation(object):
+  """Where a node is in the tree, as recorded by TreeIndex."""
+
+  __slots__ = ('parent', 'field_name', 'index', 'depth', 'indent_level',
+               'wrapping_stmt')
+
+  def __init__(self, parent, field_name, index, depth, indent_level,
+               wrapping_stmt):
+    self.parent = parent
+    self.field_name = field_name
+    self.index = index
+    self.depth = depth
+    self.indent_level = indent_level
+    self.wrapping_stmt = wrapping_stmt
+
+
+def _GetChildLocation(parent, parent_location, field_name, index, child):
+  if isinstance(child, _ast.stmt):
+    wrapping_stmt = child
+  else:
+    wrapping_stmt = parent_location.wrapping_stmt
+  return _NodeLocation(
+      parent, field_name, index, parent_location.depth + 1,
+      _GetChildIndentLevel(parent, field_name, parent_location.indent_level),
+      wrapping_stmt)
+
+
+class TreeIndex(object):
+  """Records the parent, indent level etc. of every node in a tree.
+
+  Building the index walks the tree once, after which each lookup takes
+  constant time, where GetParentNode, GetIndentLevel and GetWrappingStmtNode
+  walk the module for every lookup. Changes to the tree are only reflected
+  if they are made through InsertNode, RemoveNode and ReplaceNode. Since
+  source_match adds SyntaxFreeLine nodes to the tree while matching, build
+  the index after matching. Indent levels are the same as GetIndentLevel's,
+  and likewise only depend on the tree.
+
+  If the index of a module is stored as module_node.tree_index, source_match
+  uses it to find the indentation of new statements.
+  """
+
+  def __init__(self, root):
+    self.root = root
+    self._locations = {}
+    if isinstance(root, _ast.stmt):
+      wrapping_stmt = root
     else:
-      return copy.copy(node_to_copy)
-  new_node = type(node_to_copy)()
-  for field_name in node_to_copy._fields:
-    setattr(new_node, field_name, NodeCopy(getattr(node_to_copy, field_name)))
-  return new_node
+      wrapping_stmt = None
+    self._AddNode(root, _NodeLocation(None, None, None, 0, 0, wrapping_stmt))
+
+  def __contains__(self, node):
+    return node in self._locations
+
+  def _AddNode(self, node, location):
+    """Indexes node at location, along with the nodes it contains."""
+    stack = [(node, location)]
+    while stack:
+      node, location = stack.pop()
+      self._locations[node] = location
+      for field_name, value in ast.iter_fields(node):
+        if isinstance(value, list):
+          for index, child in enumerate(value):
+            if (isinstance(child, _ast.AST) and
+                not isinstance(child, _SHARED_NODE_TYPES)):
+              stack.append((child, _GetChildLocation(
+                  node, location, field_name, index, child)))
+        elif (isinstance(value, _ast.AST) and
+              not isinstance(value, _SHARED_NODE_TYPES)):
+          stack.append((value, _GetChildLocation(
+              node, location, field_name, None, value)))
 
+  def _RemoveNode(self, node):
+    for descendant in ast.walk(node):
+      self._locations.pop(descendant, None)
+
+  def _UpdateIndices(self, nodes, start):
+    for index in xrange(start, len(nodes)):
+      location = self._locations.get(nodes[index])
+      if location:
+        location.index = index
+
+  def _GetLocation(self, node):
+    try:
+      return self._locations[node]
+    except KeyError:
+      raise ValueError('node {} is not in the index.'.format(node))
+
+  def GetParentNode(self, node):
+    return self._GetLocation(node).parent
+
+  def GetIndentLevel(self, node):
+    return self._GetLocation(node).indent_level
+
+  def GetWrappingStmtNode(self, node):
+    """Returns the innermost statement containing node, or node if a stmt."""
+    return self._GetLocation(node).wrapping_stmt
+
+  def GetDepth(self, node):
+    return self._GetLocation(node).depth
+
+  def GetField(self, node):
+    """Gets the field of its parent that node is in.
+
+    Args:
+      node: {_ast.AST} The node to look up.
+
+    Returns:
+      A tuple of the field name and the index of node in the field, which is
+      None if the field isn't a list.
+
+    Raises:
+      ValueError: If node isn't in the index.
+    """
+    location = self._GetLocation(node)
+    return location.field_name, location.index
+
+  def InsertNode(self, parent, field_name, index, node):
+    """Inserts node in the list field_name of parent at index."""
+    children = getattr(parent, field_name)
+    children.insert(index, node)
+    index = children.index(node)
+    self._UpdateIndices(children, index + 1)
+    self._AddNode(node, _GetChildLocation(
+        parent, self._GetLocation(parent), field_name, index, node))
+
+  def RemoveNode(self, node):
+    """Removes node from the field of its parent that it is in."""
+    location = self._GetLocation(node)
+    if location.parent is None:
+      raise ValueError('Cannot remove the root of the tree.')
+    if location.index is None:
+      setattr(location.parent, location.field_name, None)
+    else:
+      children = getattr(location.parent, location.field_name)
+      del children[location.index]
+      self._UpdateIndices(children, location.index)
+    self._RemoveNode(node)
+
+  def ReplaceNode(self, old_node, new_node):
+    """Puts new_node in the place of old_node in its parent."""
+    location = self._GetLocation(old_node)
+    if location.parent is None:
+      raise ValueError('Cannot replace the root of the tree.')
+    if location.index is None:
+      setattr(location.parent, location.field_name, new_node)
+    else:
+      getattr(location.parent, location.field_name)[location.index] = new_node
+    self._RemoveNode(old_node)
+    self._AddNode(new_node, _GetChildLocation(
+        location.parent, self._GetLocation(location.parent),
+        location.field_name, location.index, new_node))
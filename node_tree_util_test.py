@@ -0,0 +1,335 @@
+"""Copyright 2014 Google Inc. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Tests for node_tree_util.py
+"""
+
+import ast
+import unittest
+
+import create_node
+import node_tree_util
+import source_match
+
+
+def GetMatchedModule(string):
+  module_node = ast.parse(string)
+  source_match.GetSource(module_node, string)
+  return module_node
+
+
+class LookupTest(unittest.TestCase):
+
+  def setUp(self):
+    self.module_node = GetMatchedModule(
+        '@decorator\n'
+        'def f(a):\n'
+        '  with a, b:\n'
+        '    return a + 1\n'
+        '  c = 2\n')
+    self.function_node = self.module_node.body[0]
+    self.with_node = self.function_node.body[0]
+    self.return_node = self.with_node.body[0].body[0]
+
+  def testGetIndentLevel(self):
+    self.assertEqual(0, node_tree_util.GetIndentLevel(
+        self.module_node, self.function_node))
+    self.assertEqual(2, node_tree_util.GetIndentLevel(
+        self.module_node, self.return_node.value.left))
+
+  def testGetIndentLevelCompoundWith(self):
+    self.assertEqual(1, node_tree_util.GetIndentLevel(
+        self.module_node, self.with_node))
+    self.assertEqual(1, node_tree_util.GetIndentLevel(
+        self.module_node, self.with_node.body[0]))
+    self.assertEqual(1, node_tree_util.GetIndentLevel(
+        self.module_node, self.function_node.body[1]))
+
+  def testGetIndentLevelCompoundWithBeforeMatching(self):
+    module_node = ast.parse(
+        'with a, b:\n'
+        '  with c:\n'
+        '    pass\n')
+    outer_with_node = module_node.body[0]
+    inner_with_node = outer_with_node.body[0].body[0]
+    self.assertEqual(0, node_tree_util.GetIndentLevel(
+        module_node, outer_with_node.body[0]))
+    self.assertEqual(1, node_tree_util.GetIndentLevel(
+        module_node, inner_with_node))
+    self.assertEqual(2, node_tree_util.GetIndentLevel(
+        module_node, inner_with_node.body[0]))
+    index = node_tree_util.TreeIndex(module_node)
+    for node in (outer_with_node.body[0], inner_with_node,
+                 inner_with_node.body[0]):
+      self.assertEqual(
+          node_tree_util.GetIndentLevel(module_node, node),
+          index.GetIndentLevel(node))
+
+  def testGetIndentLevelContinuedCompoundWith(self):
+    module_node = GetMatchedModule(
+        'def f():\n'
+        '  with a, \\\n'
+        '       b:\n'
+        '    pass\n')
+    with_node = module_node.body[0].body[0]
+    index = node_tree_util.TreeIndex(module_node)
+    for node, indent_level in ((with_node, 1), (with_node.body[0], 1),
+                               (with_node.body[0].body[0], 2)):
+      self.assertEqual(
+          indent_level, node_tree_util.GetIndentLevel(module_node, node))
+      self.assertEqual(indent_level, index.GetIndentLevel(node))
+      visitor = node_tree_util.IndentLevelVisitor(node)
+      visitor.visit(module_node)
+      self.assertEqual(indent_level, visitor.final_indent)
+
+  def testGetIndentLevelNotInModule(self):
+    with self.assertRaises(ValueError):
+      node_tree_util.GetIndentLevel(self.module_node, create_node.Name('a'))
+
+  def testGetWrappingStmtNode(self):
+    self.assertIs(self.return_node, node_tree_util.GetWrappingStmtNode(
+        self.module_node, self.return_node.value.left))
+    self.assertIs(self.return_node, node_tree_util.GetWrappingStmtNode(
+        self.module_node, self.return_node))
+    self.assertIsNone(node_tree_util.GetWrappingStmtNode(
+        self.module_node, create_node.Name('a')))
+
+  def testGetWrappingStmtNodeOfDecorator(self):
+    self.assertIs(self.function_node, node_tree_util.GetWrappingStmtNode(
+        self.module_node, self.function_node.decorator_list[0]))
+
+  def testGetParentNode(self):
+    self.assertIs(self.return_node, node_tree_util.GetParentNode(
+        self.module_node, self.return_node.value))
+    self.assertIsNone(node_tree_util.GetParentNode(
+        self.module_node, self.module_node))
+
+  def testDeeplyNestedExpression(self):
+    module_node = ast.parse('x = ' + ' + '.join(['a'] * 5000) + '\n')
+    node = module_node.body[0].value
+    while isinstance(node, ast.BinOp):
+      parent = node
+      node = node.left
+    self.assertEqual(0, node_tree_util.GetIndentLevel(module_node, node))
+    self.assertIs(parent, node_tree_util.GetParentNode(module_node, node))
+    self.assertIs(module_node.body[0],
+                  node_tree_util.GetWrappingStmtNode(module_node, node))
+
+
+class TreeIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    self.module_node = GetMatchedModule(
+        'def f(a):\n'
+        '  if a:\n'
+        '    return a + 1\n'
+        '  b = 2\n')
+    self.function_node = self.module_node.body[0]
+    self.if_node = self.function_node.body[0]
+    self.return_node = self.if_node.body[0]
+    self.binop_node = self.return_node.value
+    self.index = node_tree_util.TreeIndex(self.module_node)
+
+  def testGetParentNode(self):
+    self.assertIsNone(self.index.GetParentNode(self.module_node))
+    self.assertIs(self.index.GetParentNode(self.return_node), self.if_node)
+    self.assertIs(self.index.GetParentNode(self.binop_node.left),
+                  self.binop_node)
+
+  def testGetIndentLevel(self):
+    self.assertEqual(0, self.index.GetIndentLevel(self.function_node))
+    self.assertEqual(1, self.index.GetIndentLevel(self.if_node))
+    self.assertEqual(1, self.index.GetIndentLevel(self.if_node.test))
+    self.assertEqual(2, self.index.GetIndentLevel(self.binop_node.right))
+
+  def testGetIndentLevelAgreesWithVisitor(self):
+    for node in ast.walk(self.module_node):
+      if node in self.index:
+        self.assertEqual(
+            node_tree_util.GetIndentLevel(self.module_node, node),
+            self.index.GetIndentLevel(node))
+
+  def testGetIndentLevelCompoundWith(self):
+    module_node = GetMatchedModule(
+        'def f():\n'
+        '  with a, b:\n'
+        '    pass\n'
+        '  c = 1\n')
+    index = node_tree_util.TreeIndex(module_node)
+    with_node = module_node.body[0].body[0]
+    self.assertEqual(1, index.GetIndentLevel(with_node))
+    self.assertEqual(1, index.GetIndentLevel(with_node.body[0]))
+    self.assertEqual(2, index.GetIndentLevel(with_node.body[0].body[0]))
+    self.assertEqual(1, index.GetIndentLevel(module_node.body[0].body[1]))
+
+  def testGetWrappingStmtNode(self):
+    self.assertIsNone(self.index.GetWrappingStmtNode(self.module_node))
+    self.assertIs(self.index.GetWrappingStmtNode(self.binop_node.left),
+                  self.return_node)
+    self.assertIs(self.index.GetWrappingStmtNode(self.if_node.test),
+                  self.if_node)
+    self.assertIs(self.index.GetWrappingStmtNode(self.if_node), self.if_node)
+
+  def testGetDepth(self):
+    self.assertEqual(0, self.index.GetDepth(self.module_node))
+    self.assertEqual(3, self.index.GetDepth(self.return_node))
+
+  def testGetField(self):
+    self.assertEqual(('body', 0), self.index.GetField(self.if_node))
+    self.assertEqual(('value', None), self.index.GetField(self.binop_node))
+
+  def testNodeNotInIndex(self):
+    with self.assertRaises(ValueError):
+      self.index.GetParentNode(create_node.Name('a'))
+
+  def testSharedNodesArentIndexed(self):
+    self.assertNotIn(self.binop_node.op, self.index)
+    self.assertNotIn(self.binop_node.left.ctx, self.index)
+
+  def testInsertNode(self):
+    assign_node = self.function_node.body[1]
+    new_node = create_node.Assign('c', 3)
+    self.index.InsertNode(self.function_node, 'body', 1, new_node)
+    self.assertIs(self.function_node.body[1], new_node)
+    self.assertIs(self.index.GetParentNode(new_node), self.function_node)
+    self.assertEqual(1, self.index.GetIndentLevel(new_node))
+    self.assertIs(self.index.GetWrappingStmtNode(new_node.targets[0]),
+                  new_node)
+    self.assertEqual(('body', 1), self.index.GetField(new_node))
+    self.assertEqual(('body', 2), self.index.GetField(assign_node))
+
+  def testRemoveNode(self):
+    assign_node = self.function_node.body[1]
+    self.index.RemoveNode(self.if_node)
+    self.assertNotIn(self.if_node, self.function_node.body)
+    self.assertNotIn(self.if_node, self.index)
+    self.assertNotIn(self.return_node, self.index)
+    self.assertEqual(('body', 0), self.index.GetField(assign_node))
+
+  def testReplaceNode(self):
+    new_node = create_node.Name('b')
+    self.index.ReplaceNode(self.binop_node.left, new_node)
+    self.assertIs(self.binop_node.left, new_node)
+    self.assertIs(self.index.GetParentNode(new_node), self.binop_node)
+    self.assertEqual(2, self.index.GetIndentLevel(new_node))
+
+  def testRemoveRoot(self):
+    with self.assertRaises(ValueError):
+      self.index.RemoveNode(self.module_node)
+
+  def testNewStatementIndentation(self):
+    self.module_node.tree_index = self.index
+    new_node = create_node.Assign('c', 3)
+    new_node.module_node = self.module_node
+    self.index.InsertNode(self.if_node, 'body', 1, new_node)
+    self.assertEqual(
+        'def f(a):\n'
+        '  if a:\n'
+        '    return a + 1\n'
+        '    c = 3\n'
+        '  b = 2\n',
+        source_match.GetSource(self.module_node))
+
+
+class NodeCopyTest(unittest.TestCase):
+
+  def setUp(self):
+    self.string = (
+        'def f(a,  b=1):  # comment\n'
+        '  """Doc."""\n'
+        '\n'
+        '  return [a, (b)]\n')
+    self.module_node = GetMatchedModule(self.string)
+    self.function_node = self.module_node.body[0]
+
+  def testCopy(self):
+    new_node = node_tree_util.NodeCopy(self.function_node)
+    self.assertIsNot(new_node, self.function_node)
+    self.assertEqual(ast.dump(self.function_node), ast.dump(new_node))
+    self.assertIsNot(new_node.body[-1], self.function_node.body[-1])
+    self.assertFalse(hasattr(new_node, 'lineno'))
+    self.assertFalse(hasattr(new_node, 'matcher'))
+
+  def testCopyList(self):
+    new_body = node_tree_util.NodeCopy(self.function_node.body)
+    self.assertEqual(len(self.function_node.body), len(new_body))
+    self.assertIsNot(new_body[-1], self.function_node.body[-1])
+
+  def testCopySyntaxFreeLine(self):
+    new_body = node_tree_util.NodeCopy(self.function_node.body)
+    self.assertIsInstance(new_body[1], create_node.SyntaxFreeLine)
+    self.assertEqual(self.function_node.body[1].full_line,
+                     new_body[1].full_line)
+
+  def testCopyAttributes(self):
+    new_node = node_tree_util.NodeCopy(
+        self.function_node, copy_attributes=True)
+    self.assertEqual(1, new_node.lineno)
+    self.assertEqual(4, new_node.body[-1].lineno)
+
+  def testCopyMatchers(self):
+    new_node = node_tree_util.NodeCopy(
+        self.function_node, copy_matchers=True)
+    self.assertEqual(self.string, new_node.matcher.GetSource())
+    new_node.name = 'g'
+    new_node.body[-1].value.elts[0].id = 'c'
+    self.assertEqual(
+        'def g(a,  b=1):  # comment\n'
+        '  """Doc."""\n'
+        '\n'
+        '  return [c, (b)]\n',
+        new_node.matcher.GetSource())
+    self.assertEqual(self.string, self.function_node.matcher.GetSource())
+
+  def testCopyMatchersNotInSourceCache(self):
+    cache = source_match.SourceCache(self.module_node)
+    cache.GetSource()
+    new_node = node_tree_util.NodeCopy(
+        self.function_node, copy_matchers=True)
+    new_node.name = 'g'
+    self.assertEqual('def g', new_node.matcher.GetSource()[:5])
+
+  def testCopyMatcherWithoutSlots(self):
+
+    class NameMatcher(source_match.SourceMatcher):
+
+      def __init__(self, node, starting_parens=None):
+        super(NameMatcher, self).__init__(node, starting_parens)
+        self.text = None
+
+      def MatchAt(self, text, pos):
+        self.text = text[pos:pos + len(self.node.id)]
+        return pos + len(self.text)
+
+      def GetSource(self):
+        return self.text
+
+    name_node = create_node.Name('a')
+    name_node.matcher = NameMatcher(name_node)
+    name_node.matcher.Match('a')
+    new_node = node_tree_util.NodeCopy(name_node, copy_matchers=True)
+    self.assertIsNot(name_node.matcher, new_node.matcher)
+    self.assertIs(new_node, new_node.matcher.node)
+    self.assertEqual('a', new_node.matcher.GetSource())
+
+  def testCopyDeepTree(self):
+    module_node = ast.parse('x = ' + ' + '.join(['a'] * 5000) + '\n')
+    new_node = node_tree_util.NodeCopy(module_node)
+    self.assertEqual([type(node) for node in ast.walk(module_node)],
+                     [type(node) for node in ast.walk(new_node)])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -16,9 +16,24 @@ limitations under the License.
 Module for annotating an AST with .matcher objects. See README.
 """
 
+import __future__
 import _ast
+import argparse
+import ast
+import bisect
+import collections
+import copy
+import cStringIO
+import itertools
+import mmap
+import multiprocessing
+import os
 import pprint
+import Queue
 import re
+import sys
+import time
+import tokenize
 
 import create_node
 import node_tree_util
@@ -28,61 +43,203 @@ class Error(Exception):
   pass
 
 
+# How much of the text that failed to match a BadlySpecifiedTemplateError
+# quotes in its message.
+_MAX_QUOTED_TEXT_LENGTH = 200
+
+
 class BadlySpecifiedTemplateError(Error):
-  pass
+  """Raised when text doesn't match what a template expects.
+
+  Matches fail routinely, and the text can be a whole file, so the error only
+  keeps what failed and where. Its message, which quotes a bounded part of
+  the text, is only put together when the error is turned into a string.
+
+  Attributes:
+    description: {str} What failed to match.
+    text: {str} The text being matched, if there is one.
+    pos: {int} The offset in text where matching failed.
+    node: {_ast.AST} The node being matched, if known.
+    placeholder: {Placeholder} The placeholder that failed to match, if any.
+    matchers: {[(SourceMatcher, int)]} The matchers the error was raised
+        through, innermost first, with the offsets they started matching at.
+  """
+
+  def __init__(self, description, text=None, pos=0, node=None,
+               placeholder=None):
+    super(BadlySpecifiedTemplateError, self).__init__(description)
+    self.description = description
+    self.text = text
+    self.pos = pos
+    self.node = node
+    self.placeholder = placeholder
+    self.matchers = []
+
+  def __str__(self):
+    lines = [self.description]
+    if self.text is not None:
+      line_number = self.text.count('\n', 0, self.pos) + 1
+      column = self.pos - self.text.rfind('\n', 0, self.pos) - 1
+      quoted_text = self.text[self.pos:self.pos + _MAX_QUOTED_TEXT_LENGTH]
+      if self.pos + _MAX_QUOTED_TEXT_LENGTH < len(self.text):
+        quoted_text += '...'
+      lines.append('At line {}, column {}: "{}"'.format(
+          line_number, column, quoted_text))
+    if self.node is not None:
+      lines.append('In node {}'.format(type(self.node).__name__))
+    if self.placeholder is not None:
+      lines.append('With {!r}'.format(self.placeholder))
+    for matcher, pos in self.matchers:
+      lines.append('While matching {} from offset {}'.format(
+          type(matcher.node).__name__, pos))
+    return '\n'.join(lines)
+
+  def __repr__(self):
+    return '{}({!r})'.format(type(self).__name__, str(self))
 
 
 def GetDefaultQuoteType():
   return '"'
 
 
-def GetSource(field, text=None, starting_parens=None, assume_no_indent=False):
+def GetSource(field, text=None, starting_parens=None, assume_no_indent=False,
+              lazy=False):
   """Gets the source corresponding with a given field.
 
   If the node is not a string or a node with a .matcher function,
   this will get the matcher for the node, attach the matcher, and
   match the text provided. If no text is provided, it will rely on defaults.
 
+  With lazy, a module's statements aren't matched yet. Each one gets a
+  LazyStatementMatcher, which writes its text as is until MatchLazyStatement
+  is called on it. Call it before changing anything inside a statement;
+  only changes to the statement's own fields are caught otherwise.
+
   Args:
     field: {str|_ast.AST} The field we want the source from.
-    text: {str} The text to match if a matcher doesn't exist.
+    text: {str|SourceBuffer|TokenizedText|MappedText} The text to match if a
+        matcher doesn't exist.
     starting_parens: {[TextPlaceholder]} The list of parens that the field
         starts with.
     assume_no_indent: {bool} True if we can assume the node isn't indented.
         Used for things like new nodes that aren't yet in a module.
+    lazy: {bool} True to only split the statements of a module, field, by
+        their line numbers rather than match them against text.
 
   Returns:
     A string, representing the source code for the node.
 
   Raises:
     ValueError: When passing in a stmt node that has no string or module_node.
-        This is an error because we have no idea how much to indent it.
+        This is an error because we have no idea how much to indent it. Also
+        when lazy is set for anything but a module and its text.
   """
   if field is None:
     return ''
-  if starting_parens is None:
-    starting_parens = []
   if isinstance(field, str):
     return field
   if isinstance(field, int):
     return str(field)
   if hasattr(field, 'matcher') and field.matcher:
-    return field.matcher.GetSource()
+    return field.matcher.GetCachedSource()
+  if lazy:
+    _AttachLazyMatchers(field, text)
+  else:
+    _AttachMatcher(field, text, starting_parens, assume_no_indent)
+  return field.matcher.GetSource()
+
+
+def WriteSource(field, fileobj, text=None, assume_no_indent=False):
+  """Writes the source corresponding with a given field to a file.
+
+  This is GetSource, except that the source is written out piece by piece as
+  the tree is walked rather than joined into one string, so writing a large
+  module takes little memory beyond the tree itself.
+
+  Args:
+    field: {str|_ast.AST} The field we want the source from.
+    fileobj: {file} The file to write to. Anything with a write method that
+        takes a str will do, such as a cStringIO.StringIO.
+    text: {str|SourceBuffer|TokenizedText|MappedText} The text to match if a
+        matcher doesn't exist.
+    assume_no_indent: {bool} True if we can assume the node isn't indented.
+
+  Raises:
+    ValueError: When passing in a stmt node that has no string or module_node.
+  """
+  _WriteSource(field, fileobj.write, text=text,
+               assume_no_indent=assume_no_indent)
+
+
+def _WriteSource(field, write, text=None, starting_parens=None,
+                 assume_no_indent=False):
+  """Like WriteSource, but writes with the function write."""
+  if field is None:
+    return
+  if isinstance(field, str):
+    write(field)
+  elif isinstance(field, int):
+    write(str(field))
   else:
-    field.matcher = GetMatcher(field, starting_parens)
-    if text:
-      field.matcher.Match(text)
-    # TODO: Fix this to work with lambdas
-    elif isinstance(field, _ast.stmt) and not assume_no_indent:
-      if not hasattr(field, 'module_node'):
-        raise ValueError(
-            'No text was provided, and we try to get source from node {} which'
-            'is a statement, so it must have a .module_node field defined. '
-            'To add this automatically, call ast_annotate.AddBasicAnnotations'
-            .format(field))
-      FixSourceIndentation(field.module_node, field)
-
-    return field.matcher.GetSource()
+    if not (hasattr(field, 'matcher') and field.matcher):
+      _AttachMatcher(field, text, starting_parens, assume_no_indent)
+    field.matcher.WriteCachedSource(write)
+
+
+def _AttachMatcher(field, text, starting_parens, assume_no_indent):
+  """Attaches a matcher to field, matching it against text if there is any."""
+  if starting_parens is None:
+    starting_parens = []
+  field.matcher = GetMatcher(field, starting_parens)
+  if text:
+    if isinstance(text, (SourceBuffer, MappedText)):
+      field.source_buffer = text
+    try:
+      field.matcher.MatchAt(text, 0)
+    except BadlySpecifiedTemplateError as e:
+      e.matchers.append((field.matcher, 0))
+      raise
+  # TODO: Fix this to work with lambdas
+  elif isinstance(field, _ast.stmt) and not assume_no_indent:
+    if not hasattr(field, 'module_node'):
+      raise ValueError(
+          'No text was provided, and we try to get source from node {} which'
+          'is a statement, so it must have a .module_node field defined. '
+          'To add this automatically, call ast_annotate.AddBasicAnnotations'
+          .format(field))
+    FixSourceIndentation(field.module_node, field)
+
+
+def MatchFieldAt(field, text, pos, starting_parens=None):
+  """Matches a field against text at pos, attaching matchers as needed.
+
+  This is the offset based counterpart of GetSource(field, text): rather than
+  returning the source of the field, it returns how far into text the field
+  extends, so callers can keep walking the same text without slicing it.
+
+  Args:
+    field: {str|_ast.AST} The field to match.
+    text: {str} The full text being matched.
+    pos: {int} The offset in text where the field should start.
+    starting_parens: {[TextPlaceholder]} The list of parens that the field
+        starts with.
+
+  Returns:
+    The offset in text just past the end of the field.
+  """
+  if field is None:
+    return pos
+  if starting_parens is None:
+    starting_parens = []
+  if isinstance(field, (str, int)) or (
+      hasattr(field, 'matcher') and field.matcher):
+    return ValidateStart(text, GetSource(field), pos)
+  field.matcher = GetMatcher(field, starting_parens)
+  try:
+    return field.matcher.MatchAt(text, pos)
+  except BadlySpecifiedTemplateError as e:
+    e.matchers.append((field.matcher, pos))
+    raise
 
 
 def FixSourceIndentation(
@@ -91,19 +248,42 @@ def FixSourceIndentation(
     starting_parens = []
   default_source = node_to_fix.matcher.GetSource()
   node_to_fix.matcher = GetMatcher(node_to_fix, starting_parens)
-  starting_indent = '  ' * node_tree_util.GetIndentLevel(
-      module_node, node_to_fix)
+  tree_index = getattr(module_node, 'tree_index', None)
+  if tree_index is not None and node_to_fix in tree_index:
+    indent_level = tree_index.GetIndentLevel(node_to_fix)
+  else:
+    indent_level = node_tree_util.GetIndentLevel(module_node, node_to_fix)
+  starting_indent = '  ' * indent_level
   node_to_fix.matcher.Match(starting_indent + default_source)
 
 
-def ValidateStart(full_string, starting_string):
-  stripped_full = StripStartParens(full_string)
+def ValidateStart(full_string, starting_string, pos=0):
+  """Checks that full_string continues with starting_string at pos.
+
+  Leading parens are ignored on both sides, since those are matched by the
+  matchers themselves.
+
+  Args:
+    full_string: {str} The text being matched.
+    starting_string: {str} The text expected at pos.
+    pos: {int} The offset in full_string to check at.
+
+  Returns:
+    The offset in full_string just past starting_string.
+
+  Raises:
+    BadlySpecifiedTemplateError: If full_string doesn't continue with
+      starting_string.
+  """
+  if not starting_string:
+    return pos
   stripped_start = StripStartParens(starting_string)
-  if not stripped_full.startswith(stripped_start):
+  start_pos = SkipStartParens(full_string, pos)
+  if not full_string.startswith(stripped_start, start_pos):
     raise BadlySpecifiedTemplateError(
-        'String "{}" should have started with string "{}"'
-        .format(stripped_full, stripped_start))
-  return True
+        'Text should have started with "{}"'.format(stripped_start),
+        full_string, start_pos)
+  return start_pos + len(stripped_start)
 
 
 def _GetListDefault(l, index, default):
@@ -113,86 +293,86 @@ def _GetListDefault(l, index, default):
     return default.Copy()
 
 
-# TODO: Consolidate with StringParser
 def MatchPlaceholder(string, node, placeholder):
-  """Match a placeholder against a string."""
-  matched_text = placeholder.Match(node, string)
-  if not matched_text:
-    return string
-  ValidateStart(string, matched_text)
-  if not isinstance(placeholder, TextPlaceholder):
-    matched_text = StripStartParens(matched_text)
-  before, after = string.split(matched_text, 1)
-  if StripStartParens(before):
-    raise BadlySpecifiedTemplateError(
-        'string "{}" should have started with placeholder "{}"'
-        .format(string, placeholder))
-  return after
+  """Match a placeholder against a string, returning the remaining string."""
+  return string[placeholder.MatchAt(node, string, 0):]
 
 
 def MatchPlaceholderList(string, node, placeholders, starting_parens=None):
-  remaining_string = string
+  return string[
+      MatchPlaceholderListAt(string, 0, node, placeholders, starting_parens):]
+
+
+def MatchPlaceholderListAt(text, pos, node, placeholders, starting_parens=None):
+  """Matches placeholders one after the other, starting at pos in text.
+
+  Args:
+    text: {str} The full text being matched.
+    pos: {int} The offset in text to start matching at.
+    node: {_ast.AST} The node the placeholders belong to.
+    placeholders: {[Placeholder]} The placeholders to match, in order.
+    starting_parens: {[TextPlaceholder]} The parens the first placeholder
+        may start with.
+
+  Returns:
+    The offset in text just past the last placeholder.
+  """
+  start = pos
   for placeholder in placeholders:
-    if remaining_string == string:
+    if pos == start:
       placeholder.SetStartingParens(starting_parens)
-    remaining_string = MatchPlaceholder(
-        remaining_string, node, placeholder)
-  return remaining_string
+    pos = placeholder.MatchAt(node, text, pos)
+  return pos
 
 
 def StripStartParens(string):
-  remaining_string = string
-  while remaining_string.startswith('('):
-    matcher = GetStartParenMatcher()
-    matched_text = matcher.Match(None, remaining_string)
-    remaining_string = remaining_string[len(matched_text):]
-  return remaining_string
+  return string[SkipStartParens(string, 0):]
+
+
+def SkipStartParens(text, pos):
+  """Returns the offset in text past any parens starting at pos."""
+  spec = _GetTextSpec(_START_PAREN_REGEX)
+  while text.startswith('(', pos):
+    pos = MatchTextSpecAt(spec, text, pos)
+  return pos
 
 
 class StringParser(object):
-  """Class encapsulating parsing a string while matching placeholders."""
+  """Class encapsulating parsing a string while matching placeholders.
 
-  def __init__(self, string, elements, starting_parens=None):
+  The string is never sliced while parsing; self.pos tracks how far into
+  self.string the elements have matched.
+  """
+
+  __slots__ = ('starting_parens', 'string', 'start_pos', 'pos', 'elements')
+
+  def __init__(self, string, elements, starting_parens=None, pos=0):
     if not starting_parens:
       starting_parens = []
     self.starting_parens = starting_parens
     self.string = string
-    self.before_string = None
-    self.remaining_string = string
+    self.start_pos = pos
+    self.pos = pos
     self.elements = elements
-    self.matched_substrings = []
     self.Parse()
 
-  def _ProcessSubstring(self, substring):
-    """Process a substring, validating its state and calculating remaining."""
-    if not substring:
-      return
-    stripped_substring = StripStartParens(substring)
-    stripped_remaining = StripStartParens(self.remaining_string)
-    if not stripped_remaining.startswith(stripped_substring):
-      raise BadlySpecifiedTemplateError(
-          'string "{}" should be in string "{}"'
-          .format(stripped_substring, stripped_remaining))
-    self.remaining_string = self.remaining_string.split(
-        stripped_substring, 1)[1]
+  @property
+  def remaining_string(self):
+    return self.string[self.pos:]
 
   def _MatchTextPlaceholder(self, element):
-    if self.remaining_string == self.string:
+    if self.pos == self.start_pos:
       element.SetStartingParens(self.starting_parens)
-    matched_text = element.Match(None, self.remaining_string)
-    self._ProcessSubstring(matched_text)
-    self.matched_substrings.append(matched_text)
+    self.pos = element.MatchAt(None, self.string, self.pos)
 
   def _MatchNode(self, node):
     starting_parens = []
-    if self.remaining_string == self.string:
+    if self.pos == self.start_pos:
       starting_parens = self.starting_parens
-    node_src = GetSource(node, self.remaining_string, starting_parens)
-    self._ProcessSubstring(node_src)
-    self.matched_substrings.append(node_src)
+    self.pos = MatchFieldAt(node, self.string, self.pos, starting_parens)
 
   def GetMatchedText(self):
-    return ''.join(self.matched_substrings)
+    return self.string[self.start_pos:self.pos]
 
   def Parse(self):
     """Parses the string, handling nodes and TextPlaceholders."""
@@ -203,59 +383,439 @@ class StringParser(object):
         self._MatchNode(element)
 
 
+# A mapping of class: the names of the slots of the class and its bases.
+_slot_names = {}
+
+
+def _GetSlotNames(cls):
+  try:
+    return _slot_names[cls]
+  except KeyError:
+    slot_names = tuple(name for base in cls.__mro__
+                       for name in base.__dict__.get('__slots__', ()))
+    _slot_names[cls] = slot_names
+    return slot_names
+
+
+def _DeepCopySlots(obj, memo):
+  """Deep copies an object which keeps its state in __slots__.
+
+  This is several times faster than the generic way copy.deepcopy copies
+  objects, through __reduce_ex__. Subclasses that don't declare __slots__,
+  such as matchers registered with RegisterMatcherClass, also have their
+  __dict__ copied.
+  """
+  new_obj = object.__new__(type(obj))
+  memo[id(obj)] = new_obj
+  for name in _GetSlotNames(type(obj)):
+    try:
+      value = getattr(obj, name)
+    except AttributeError:
+      continue
+    if type(value) not in _IMMUTABLE_TYPES:
+      value = _DeepCopyValue(value, memo)
+    setattr(new_obj, name, value)
+  obj_dict = getattr(obj, '__dict__', None)
+  if obj_dict:
+    for name, value in obj_dict.iteritems():
+      new_obj.__dict__[name] = _DeepCopyValue(value, memo)
+  return new_obj
+
+
+def _DeepCopyValue(value, memo):
+  """Deep copies the value of a slot, going through copy.deepcopy sparingly."""
+  if type(value) in _IMMUTABLE_TYPES:
+    return value
+  try:
+    return memo[id(value)]
+  except KeyError:
+    pass
+  if isinstance(value, (Placeholder, SourceMatcher)):
+    return _DeepCopySlots(value, memo)
+  if isinstance(value, list):
+    new_list = []
+    memo[id(value)] = new_list
+    new_list.extend(_DeepCopyValue(item, memo) for item in value)
+    return new_list
+  if isinstance(value, tuple) and not value:
+    return value
+  return copy.deepcopy(value, memo)
+
+
 class Placeholder(object):
   """Base class for other placeholder objects."""
 
+  __slots__ = ('starting_parens',)
+
   def __init__(self):
-    self.starting_parens = []
+    self.starting_parens = ()
+
+  def __deepcopy__(self, memo):
+    return _DeepCopySlots(self, memo)
 
   def Match(self, node, string):
+    """Matches the start of string, returning the matched text."""
+    return string[:self.MatchAt(node, string, 0)]
+
+  def MatchAt(self, node, text, pos):
+    """Matches text starting at pos, returning the offset past the match."""
     raise NotImplementedError
 
   def GetSource(self, node):
     raise NotImplementedError
 
+  def WriteSource(self, node, write):
+    """Writes the source GetSource returns with the function write."""
+    write(self.GetSource(node))
+
   def SetStartingParens(self, starting_parens):
     self.starting_parens = starting_parens
 
+  def Instantiate(self):
+    """Returns an unmatched placeholder for a new node, given a prototype.
+
+    Prototypes live in an ExpectedPartsTemplate and are never matched
+    themselves. Whatever doesn't change while matching is shared with the
+    prototype rather than copied.
+    """
+    raise NotImplementedError
+
+
+def _InstantiateOrNone(placeholder):
+  if placeholder is None:
+    return None
+  return placeholder.Instantiate()
+
 
 class NodePlaceholder(Placeholder):
   """Placeholder to wrap an AST node."""
 
+  __slots__ = ('node',)
+
   def __init__(self, node):
     super(NodePlaceholder, self).__init__()
     self.node = node
 
-  def Match(self, unused_node, string):
-    node_src = GetSource(self.node, string, self.starting_parens)
-    ValidateStart(string, node_src)
-    return node_src
+  def MatchAt(self, unused_node, text, pos):
+    return MatchFieldAt(self.node, text, pos, self.starting_parens)
 
   def GetSource(self, unused_node):
     return GetSource(self.node)
 
+  def WriteSource(self, unused_node, write):
+    _WriteSource(self.node, write)
+
+
+def _TransformRegex(regex):
+  """Makes whitespace and linebreaks in regex also match comments etc."""
+  non_whitespace_parts = regex.split(r'\s*')
+  regex = r'\s*(\\\s*|#.*\s*)*'.join(non_whitespace_parts)
+  non_linebreak_parts = regex.split(r'\n')
+  regex = r'( *#.*\n| *;| *\n)'.join(non_linebreak_parts)
+  return regex
+
+
+RegexCacheInfo = collections.namedtuple(
+    'RegexCacheInfo', ['hits', 'misses', 'size'])
+
+
+class TextSpec(collections.namedtuple(
+    'TextSpec', ['original_regex', 'regex', 'pattern', 'token_parts'])):
+  """The immutable part of a TextPlaceholder.
+
+  It is shared by every TextPlaceholder created with the same regex, including
+  deep copies of them. token_parts is what _GetTokenParts returns for the
+  regex.
+  """
+
+  __slots__ = ()
+
+  def __deepcopy__(self, unused_memo):
+    return self
+
+  def __reduce__(self):
+    # Unpickled specs come from the cache too, rather than recompiling.
+    return _GetTextSpec, (self.original_regex,)
+
+
+# Matches a part of a regex which only matches literal text, where some
+# characters may be optional, so it can be matched without the whitespace and
+# comments around it.
+_TOKEN_PART_RE = re.compile(r'(?:(?:\\[^\w\s]|[\w,.:=~{}])\??)*$')
+
+
+def _GetTokenParts(regex):
+  """Splits a regex at its whitespace, for matching against TokenizedText.
+
+  Args:
+    regex: {str} The regex, before _TransformRegex.
+
+  Returns:
+    A tuple of the compiled parts of regex in between its \\s*, with None for
+    empty parts, or None if some part isn't plain enough to match on its own.
+  """
+  parts = regex.split(r'\s*')
+  if not all(_TOKEN_PART_RE.match(part) for part in parts):
+    return None
+  return tuple(re.compile(part) if part else None for part in parts)
+
+
+# A mapping of original regex: TextSpec.
+_regex_cache = {}
+_regex_cache_stats = {'hits': 0, 'misses': 0}
+
+
+def _GetTextSpec(regex):
+  """Gets the TextSpec, with transformed and compiled regex, for a regex."""
+  try:
+    spec = _regex_cache[regex]
+  except KeyError:
+    _regex_cache_stats['misses'] += 1
+    transformed_regex = _TransformRegex(regex)
+    spec = TextSpec(regex, transformed_regex, re.compile(transformed_regex),
+                    _GetTokenParts(regex))
+    _regex_cache[regex] = spec
+    return spec
+  _regex_cache_stats['hits'] += 1
+  return spec
+
+
+def GetRegexCacheInfo():
+  """Returns a RegexCacheInfo describing the TextPlaceholder regex cache."""
+  return RegexCacheInfo(_regex_cache_stats['hits'],
+                        _regex_cache_stats['misses'],
+                        len(_regex_cache))
+
+
+def ClearRegexCache():
+  """Empties the TextPlaceholder regex cache and resets its counters."""
+  _regex_cache.clear()
+  _regex_cache_stats['hits'] = 0
+  _regex_cache_stats['misses'] = 0
+
+
+class SourceBuffer(str):
+  """Source text that matched placeholders may refer into instead of copying.
+
+  Passing a SourceBuffer rather than a plain string as the text to GetSource
+  makes long matched sections be stored as SourceSpans over the buffer. The
+  buffer is attached to the root node as node.source_buffer.
+  """
+
+  __slots__ = ()
+
+  def __deepcopy__(self, unused_memo):
+    return self
+
+
+class MappedText(mmap.mmap):
+  """The text of a file, mapped into memory rather than read.
+
+  Passing a MappedText as the text to GetSource matches against the mapped
+  file directly, without a copy of it as a string, and makes long matched
+  sections be stored as SourceSpans over it, as with SourceBuffer. The
+  mapping is attached to the root node as node.source_buffer, and ast.parse
+  can parse it directly too.
+
+  It has the methods of str that matching needs, on top of those of
+  mmap.mmap. Slicing it gives strings.
+
+  Raises:
+    ValueError: If the file is empty, since empty files can't be mapped.
+  """
+
+  def __new__(cls, path):
+    with open(path, 'rb') as source_file:
+      return super(MappedText, cls).__new__(
+          cls, source_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+  def __deepcopy__(self, unused_memo):
+    return self
+
+  def __reduce__(self):
+    # Mappings can't be pickled, so pickles hold a copy of the text.
+    return SourceBuffer, (self[:],)
+
+  def startswith(self, prefix, start=0):
+    return self[start:start + len(prefix)] == prefix
+
+  def index(self, sub, start=0, end=None):
+    if end is None:
+      end = len(self)
+    pos = self.find(sub, start, end)
+    if pos == -1:
+      raise ValueError('substring not found')
+    return pos
+
+  def count(self, sub, start=0, end=None):
+    return self[start:end].count(sub)
+
+
+class SourceSpan(object):
+  """The section [start, end) of a SourceBuffer or MappedText."""
+
+  __slots__ = ('buffer', 'start', 'end')
+
+  def __init__(self, buffer, start, end):
+    self.buffer = buffer
+    self.start = start
+    self.end = end
+
+  def GetText(self):
+    return self.buffer[self.start:self.end]
+
+
+# A SourceSpan and its two offsets take about as much memory as a string of
+# this length, so shorter matches are cheaper to keep as copies.
+_MIN_SPAN_LENGTH = 80
+
+
+def GetMatchedText(text, start, end):
+  """Gets the section of text to store for a match from start to end.
+
+  Args:
+    text: {str} The text that was matched.
+    start: {int} The offset the match starts at.
+    end: {int} The offset the match ends at.
+
+  Returns:
+    A SourceSpan if text is a SourceBuffer or MappedText and the match is
+    long enough, otherwise the matched string.
+  """
+  if (isinstance(text, (SourceBuffer, MappedText)) and
+      end - start >= _MIN_SPAN_LENGTH):
+    return SourceSpan(text, start, end)
+  return text[start:end]
+
+
+class TokenizedText(str):
+  """Source text along with the offsets of its tokens.
+
+  Passing a TokenizedText rather than a plain string as the text to GetSource
+  tokenizes it once up front. Whitespace, comments and line continuations in
+  between tokens are then skipped by looking up the next token, rather than
+  by the regexes _TransformRegex makes, which backtrack a lot on failed
+  matches and exponentially on comments like '#####...'. Placeholders whose
+  regex is more than plain text separated by whitespace still use the regex.
+
+  A plain string is the default, and is faster on most code: tokenizing and
+  looking up tokens cost more than the regexes save. A TokenizedText is worth
+  it for code with comments made of runs of '#' inside brackets, as in
+  benchmark.py's banner_comments corpus, or for text of unknown origin that
+  may have them.
+
+  Raises:
+    tokenize.TokenError: If text can't be tokenized.
+  """
+
+  def __new__(cls, text):
+    self = super(TokenizedText, cls).__new__(cls, text)
+    line_offsets = [0]
+    line_offsets.extend(match.end() for match in re.finditer('\n', text))
+    # Offsets where tokens, other than comments and newlines, start and end.
+    self.token_starts = []
+    self.token_ends = []
+    readline = cStringIO.StringIO(text).readline
+    for token_type, token_string, start, end, _ in tokenize.generate_tokens(
+        readline):
+      if token_type == tokenize.COMMENT or not token_string.strip():
+        continue
+      self.token_starts.append(line_offsets[start[0] - 1] + start[1])
+      self.token_ends.append(line_offsets[end[0] - 1] + end[1])
+    return self
+
+  def SkipTrivia(self, pos):
+    """Returns the offset of the next token, or pos if it is inside a token."""
+    index = bisect.bisect_right(self.token_starts, pos) - 1
+    if index >= 0 and pos < self.token_ends[index]:
+      return pos
+    if index + 1 < len(self.token_starts):
+      return self.token_starts[index + 1]
+    return len(self)
+
+  def MatchTokenParts(self, token_parts, pos):
+    """Matches token_parts at pos, skipping trivia in between them.
+
+    Args:
+      token_parts: {(re.RegexObject|None)} Parts as made by _GetTokenParts.
+      pos: {int} The offset to start matching at.
+
+    Returns:
+      The offset where the match ends, or -1 if it doesn't match.
+    """
+    for index, part in enumerate(token_parts):
+      if index:
+        pos = self.SkipTrivia(pos)
+      if part is not None:
+        match = part.match(self, pos)
+        if not match:
+          return -1
+        pos = match.end()
+    return pos
+
+
+def MatchTextSpecAt(spec, text, pos):
+  """Matches the regex of a TextSpec in text at pos.
+
+  Args:
+    spec: {TextSpec} The spec to match.
+    text: {str|SourceBuffer|TokenizedText} The text to match.
+    pos: {int} The offset to start matching at.
+
+  Returns:
+    The offset where the match ends, or -1 if it doesn't match.
+  """
+  token_parts = spec.token_parts
+  if token_parts is not None and isinstance(text, TokenizedText):
+    return text.MatchTokenParts(token_parts, pos)
+  match = spec.pattern.match(text, pos)
+  if not match:
+    return -1
+  return match.end()
+
+
+# Types of slot values that deep copies of placeholders can share.
+_IMMUTABLE_TYPES = frozenset([type(None), bool, int, long, float, str, unicode,
+                              SourceBuffer, MappedText, SourceSpan, TextSpec])
+
 
 class TextPlaceholder(Placeholder):
   """Placeholder for text (non-field). For example, 'def (' in FunctionDef."""
 
+  __slots__ = ('spec', 'default', '_matched_text')
+
   def __init__(self, regex, default=None):
     super(TextPlaceholder, self).__init__()
-    self.original_regex = regex
-    self.regex = self._TransformRegex(regex)
+    self.spec = _GetTextSpec(regex)
     if default is None:
       self.default = regex
     else:
       self.default = default
     self.matched_text = None
 
-  def _TransformRegex(self, regex):
-    non_whitespace_parts = regex.split(r'\s*')
-    regex = r'\s*(\\\s*|#.*\s*)*'.join(non_whitespace_parts)
-    non_linebreak_parts = regex.split(r'\n')
-    regex = r'( *#.*\n| *;| *\n)'.join(non_linebreak_parts)
-    return regex
+  @property
+  def original_regex(self):
+    return self.spec.original_regex
+
+  @property
+  def regex(self):
+    return self.spec.regex
+
+  @property
+  def pattern(self):
+    return self.spec.pattern
+
+  @property
+  def matched_text(self):
+    if isinstance(self._matched_text, SourceSpan):
+      return self._matched_text.GetText()
+    return self._matched_text
 
-  def Match(self, unused_node, string, dotall=False):
+  @matched_text.setter
+  def matched_text(self, matched_text):
+    self._matched_text = matched_text
+
+  def Match(self, unused_node, string):
     """Attempts to match string against self.regex.
 
     Saves the matched section for use in GetSource.
@@ -263,7 +823,6 @@ class TextPlaceholder(Placeholder):
     Args:
       unused_node: unused.
       string: The string we attempt to match a substring of.
-      dotall: Whether to apply re.DOTALL to the match.
 
     Raises:
       BadlySpecifiedTemplateError: If the regex doesn't match anywhere.
@@ -271,25 +830,36 @@ class TextPlaceholder(Placeholder):
     Returns:
       The substring of string that matches.
     """
-    if dotall:
-      match_attempt = re.match(self.regex, string, re.DOTALL)
-    else:
-      match_attempt = re.match(self.regex, string)
-    if not match_attempt:
-      raise BadlySpecifiedTemplateError(
-          'string "{}" does not match regex "{}" (technically, "{}")'
-          .format(string, self.original_regex, self.regex))
-    self.matched_text = match_attempt.group(0)
+    self.MatchAt(unused_node, string, 0)
     return self.matched_text
 
+  def MatchAt(self, unused_node, text, pos):
+    """Like Match, but matches text at pos and returns the end offset."""
+    end = self.TryMatchAt(unused_node, text, pos)
+    if end == -1:
+      raise BadlySpecifiedTemplateError(
+          'Text does not match regex "{}"'.format(self.original_regex),
+          text, pos, placeholder=self)
+    return end
+
+  def TryMatchAt(self, unused_node, text, pos):
+    """Like MatchAt, but returns -1 rather than raising if it doesn't match."""
+    end = MatchTextSpecAt(self.spec, text, pos)
+    if end != -1:
+      self.matched_text = GetMatchedText(text, pos, end)
+    return end
+
   def GetSource(self, unused_node):
     """Returns self.matched_text if it exists, or self.default otherwise."""
-    if self.matched_text is None:
+    if self._matched_text is None:
       return self.default
     return self.matched_text
 
   def Copy(self):
-    return TextPlaceholder(self.regex, self.default)
+    return TextPlaceholder(self.original_regex, self.default)
+
+  def Instantiate(self):
+    return self.Copy()
 
   def __repr__(self):
     return 'TextPlaceholder with regex "{}" ("{}") and default "{}"'.format(
@@ -299,16 +869,24 @@ class TextPlaceholder(Placeholder):
 class CompositePlaceholder(Placeholder):
   """Node which wraps one or more other nodes."""
 
-  def Match(self, node, string):
-    """Makes sure node.(self.field_name) is in string."""
+  __slots__ = ()
+
+  def MatchAt(self, node, text, pos):
+    """Makes sure node.(self.field_name) is in text at pos."""
     self.Validate(node)
     parser = StringParser(
-        string, self.GetElements(node), starting_parens=self.starting_parens)
-    return parser.GetMatchedText()
+        text, self.GetElements(node), starting_parens=self.starting_parens,
+        pos=pos)
+    return parser.pos
 
   def GetSource(self, node):
-    return ''.join(
-        element.GetSource(node) for element in self.GetElements(node))
+    source_list = []
+    self.WriteSource(node, source_list.append)
+    return ''.join(source_list)
+
+  def WriteSource(self, node, write):
+    for element in self.GetElements(node):
+      element.WriteSource(node, write)
 
   def Validate(self, unused_node):
     return True
@@ -317,12 +895,18 @@ class CompositePlaceholder(Placeholder):
 class FieldPlaceholder(CompositePlaceholder):
   """Placeholder for a field."""
 
+  __slots__ = ('field_name', 'before_placeholder')
+
   def __init__(
       self, field_name, before_placeholder=None):
     super(FieldPlaceholder, self).__init__()
     self.field_name = field_name
     self.before_placeholder = before_placeholder
 
+  def Instantiate(self):
+    return FieldPlaceholder(
+        self.field_name, _InstantiateOrNone(self.before_placeholder))
+
   def GetElements(self, node):
     field_value = getattr(node, self.field_name)
     if not field_value:
@@ -338,8 +922,9 @@ class FieldPlaceholder(CompositePlaceholder):
     field_value = getattr(node, self.field_name)
     if isinstance(field_value, (list, tuple)):
       raise BadlySpecifiedTemplateError(
-          'Field {} of node {} is a list. please use a ListFieldPlaceholder'
-          'instead of a FieldPlaceholder'.format(self.field_name, node))
+          'Field {} is a list. please use a ListFieldPlaceholder '
+          'instead of a FieldPlaceholder'.format(self.field_name),
+          node=node, placeholder=self)
 
   def __repr__(self):
     return 'FieldPlaceholder for field "{}"'.format(
@@ -349,6 +934,10 @@ class FieldPlaceholder(CompositePlaceholder):
 class ListFieldPlaceholder(CompositePlaceholder):
   """Placeholder for a field which is a list of child nodes."""
 
+  __slots__ = ('field_name', 'prefix_placeholder', 'before_placeholder',
+               'after_placeholder', 'exclude_first_before',
+               'matched_before', 'matched_after')
+
   def __init__(self, field_name,
                before_placeholder=None, after_placeholder=None,
                prefix_placeholder=None,
@@ -372,13 +961,27 @@ class ListFieldPlaceholder(CompositePlaceholder):
     self.before_placeholder = before_placeholder
     self.after_placeholder = after_placeholder
     self.exclude_first_before = exclude_first_before
-    self.matched_before = []
-    self.matched_after = []
+    # Like the other lists of matched placeholders, these are only allocated
+    # once something is added to them.
+    self.matched_before = ()
+    self.matched_after = ()
+
+  def Instantiate(self):
+    # before_placeholder and after_placeholder are only ever copied, so they
+    # can be shared with the prototype.
+    return ListFieldPlaceholder(
+        self.field_name,
+        before_placeholder=self.before_placeholder,
+        after_placeholder=self.after_placeholder,
+        prefix_placeholder=_InstantiateOrNone(self.prefix_placeholder),
+        exclude_first_before=self.exclude_first_before)
 
   def _GetBeforePlaceholder(self, index):
     if index < len(self.matched_before):
       return self.matched_before[index]
     new_placeholder = self.before_placeholder.Copy()
+    if not self.matched_before:
+      self.matched_before = []
     self.matched_before.append(new_placeholder)
     return new_placeholder
 
@@ -386,22 +989,48 @@ class ListFieldPlaceholder(CompositePlaceholder):
     if index < len(self.matched_after):
       return self.matched_after[index]
     new_placeholder = self.after_placeholder.Copy()
+    if not self.matched_after:
+      self.matched_after = []
     self.matched_after.append(new_placeholder)
     return new_placeholder
 
-  def GetValueAtIndex(self, values, index):
-    """Gets the set of node in values at index, including before and after."""
+  def GetValueAtIndex(self, values, index, node_index=None):
+    """Gets the set of node in values at index, including before and after.
+
+    Args:
+      values: {list} The value of the field.
+      index: {int} The index of the value in values.
+      node_index: {int} The index of the value among the values that aren't
+          SyntaxFreeLines, which the before and after placeholders are kept
+          by, so that they stay with their node when SyntaxFreeLines are
+          added while matching. Defaults to index.
+
+    Returns:
+      The placeholders for the value.
+    """
     elements = []
     child_value = values[index]
     if isinstance(child_value, create_node.SyntaxFreeLine):
       return [NodePlaceholder(child_value)]
+    if node_index is None:
+      node_index = index
     if (self.before_placeholder and
-        not (self.exclude_first_before and index == 0)):
-      before_index = index-1 if self.exclude_first_before else index
+        not (self.exclude_first_before and node_index == 0)):
+      before_index = node_index-1 if self.exclude_first_before else node_index
       elements.append(self._GetBeforePlaceholder(before_index))
     elements.append(NodePlaceholder(child_value))
     if self.after_placeholder:
-      elements.append(self._GetAfterPlaceholder(index))
+      elements.append(self._GetAfterPlaceholder(node_index))
+    return elements
+
+  def _GetValuePlaceholders(self, values):
+    """Gets the placeholders for each of the values, in order."""
+    elements = []
+    node_index = 0
+    for index, child_value in enumerate(values):
+      elements.extend(self.GetValueAtIndex(values, index, node_index))
+      if not isinstance(child_value, create_node.SyntaxFreeLine):
+        node_index += 1
     return elements
 
   def GetElements(self, node):
@@ -409,16 +1038,16 @@ class ListFieldPlaceholder(CompositePlaceholder):
     elements = []
     if self.prefix_placeholder and field_value:
       elements.append(self.prefix_placeholder)
-    for i in xrange(len(field_value)):
-      elements.extend(self.GetValueAtIndex(field_value, i))
+    elements.extend(self._GetValuePlaceholders(field_value))
     return elements
 
   def Validate(self, node):
     field_value = getattr(node, self.field_name)
     if field_value and not isinstance(field_value, (list, tuple)):
       raise BadlySpecifiedTemplateError(
-          'Field {} of node {} is a not list, so please use a FieldPlaceholder'
-          'instead of a ListFieldPlaceholder'.format(self.field_name, node))
+          'Field {} is a not list, so please use a FieldPlaceholder '
+          'instead of a ListFieldPlaceholder'.format(self.field_name),
+          node=node, placeholder=self)
 
   def __repr__(self):
     return ('ListFieldPlaceholder for field "{}" with before placeholder "{}"'
@@ -429,11 +1058,17 @@ class ListFieldPlaceholder(CompositePlaceholder):
 
 class SeparatedListFieldPlaceholder(ListFieldPlaceholder):
 
+  __slots__ = ()
+
   def __init__(self, field_name, separator_placeholder):
     super(SeparatedListFieldPlaceholder, self).__init__(
         field_name, before_placeholder=separator_placeholder,
         exclude_first_before=True)
 
+  def Instantiate(self):
+    return SeparatedListFieldPlaceholder(
+        self.field_name, self.before_placeholder)
+
 
 class ArgsDefaultsPlaceholder(CompositePlaceholder):
   """Placeholder to handle args and defaults for _ast.argument.
@@ -443,17 +1078,28 @@ class ArgsDefaultsPlaceholder(CompositePlaceholder):
   a custom placeholder.
   """
 
+  __slots__ = ('arg_separator_placeholder', 'kwarg_separator_placeholder',
+               'arg_separators', 'kwarg_separators')
+
   def __init__(self, arg_separator_placeholder, kwarg_separator_placeholder):
     super(ArgsDefaultsPlaceholder, self).__init__()
     self.arg_separator_placeholder = arg_separator_placeholder
     self.kwarg_separator_placeholder = kwarg_separator_placeholder
-    self.arg_separators = []
-    self.kwarg_separators = []
+    self.arg_separators = ()
+    self.kwarg_separators = ()
+
+  def Instantiate(self):
+    # The separator placeholders are only ever copied, so they can be shared
+    # with the prototype.
+    return type(self)(
+        self.arg_separator_placeholder, self.kwarg_separator_placeholder)
 
   def _GetArgSeparator(self, index):
     if index < len(self.arg_separators):
       return self.arg_separators[index]
     new_placeholder = self.arg_separator_placeholder.Copy()
+    if not self.arg_separators:
+      self.arg_separators = []
     self.arg_separators.append(new_placeholder)
     return new_placeholder
 
@@ -461,6 +1107,8 @@ class ArgsDefaultsPlaceholder(CompositePlaceholder):
     if index < len(self.kwarg_separators):
       return self.kwarg_separators[index]
     new_placeholder = self.kwarg_separator_placeholder.Copy()
+    if not self.kwarg_separators:
+      self.kwarg_separators = []
     self.kwarg_separators.append(new_placeholder)
     return new_placeholder
 
@@ -499,12 +1147,16 @@ class ArgsDefaultsPlaceholder(CompositePlaceholder):
 
 class KeysValuesPlaceholder(ArgsDefaultsPlaceholder):
 
+  __slots__ = ()
+
   def _GetArgsKwargs(self, node):
     return [], zip(node.keys, node.values)
 
 
 class ArgsKeywordsPlaceholder(ArgsDefaultsPlaceholder):
 
+  __slots__ = ('stararg_separator',)
+
   def __init__(self, arg_separator_placeholder, kwarg_separator_placeholder):
     super(ArgsKeywordsPlaceholder, self).__init__(
         arg_separator_placeholder, kwarg_separator_placeholder)
@@ -537,6 +1189,8 @@ class ArgsKeywordsPlaceholder(ArgsDefaultsPlaceholder):
 
 class OpsComparatorsPlaceholder(ArgsDefaultsPlaceholder):
 
+  __slots__ = ()
+
   def _GetArgsKwargs(self, node):
     return [], zip(node.ops, node.comparators)
 
@@ -544,49 +1198,61 @@ class OpsComparatorsPlaceholder(ArgsDefaultsPlaceholder):
 class BodyPlaceholder(ListFieldPlaceholder):
   """Placeholder for a "body" field. Handles adding SyntaxFreeLine nodes."""
 
+  __slots__ = ('match_after',)
+
   def __init__(self, *args, **kwargs):
     self.match_after = kwargs.pop('match_after', False)
     super(BodyPlaceholder, self).__init__(*args, **kwargs)
 
+  def Instantiate(self):
+    return BodyPlaceholder(
+        self.field_name,
+        before_placeholder=self.before_placeholder,
+        after_placeholder=self.after_placeholder,
+        prefix_placeholder=_InstantiateOrNone(self.prefix_placeholder),
+        exclude_first_before=self.exclude_first_before,
+        match_after=self.match_after)
+
   def MatchSyntaxFreeLine(self, remaining_string):
-    line, remaining_string = remaining_string.split('\n', 1)
+    pos, syntax_free_node = self.MatchSyntaxFreeLineAt(remaining_string, 0)
+    return remaining_string[pos:], syntax_free_node
+
+  def MatchSyntaxFreeLineAt(self, text, pos):
+    """Matches the SyntaxFreeLine at pos, returning the new offset and node."""
+    line_end = text.index('\n', pos) + 1
+    line = text[pos:line_end]
     syntax_free_node = create_node.SyntaxFreeLine()
-    line += '\n'
     syntax_free_node.SetFromSrcLine(line)
     GetSource(syntax_free_node, text=line)
-    return remaining_string, syntax_free_node
+    return line_end, syntax_free_node
 
-  def Match(self, node, string):
-    remaining_string = string
+  def MatchAt(self, node, text, pos):
     new_node = []
     field_value = getattr(node, self.field_name)
     if not field_value:
-      return ''
+      return pos
     if self.prefix_placeholder:
-      remaining_string = MatchPlaceholder(
-          remaining_string, node, self.prefix_placeholder)
+      pos = self.prefix_placeholder.MatchAt(node, text, pos)
     field_value = getattr(node, self.field_name)
+    node_index = 0
     for index, child in enumerate(field_value):
-      while create_node.SyntaxFreeLine.MatchesStart(remaining_string):
-        remaining_string, syntax_free_node = self.MatchSyntaxFreeLine(
-            remaining_string)
+      while create_node.SyntaxFreeLine.MatchesStart(text, pos):
+        pos, syntax_free_node = self.MatchSyntaxFreeLineAt(text, pos)
         new_node.append(syntax_free_node)
       new_node.append(child)
-      indent_level = ' ' * (len(remaining_string) -
-                            len(remaining_string.lstrip()))
-      remaining_string = MatchPlaceholderList(
-          remaining_string, node, self.GetValueAtIndex(field_value, index))
-
-    while (create_node.SyntaxFreeLine.MatchesStart(remaining_string) and
-           (remaining_string.startswith(indent_level) or self.match_after)):
-      remaining_string, syntax_free_node = self.MatchSyntaxFreeLine(
-          remaining_string)
+      indent_level = ' ' * (SkipWhitespace(text, pos) - pos)
+      pos = MatchPlaceholderListAt(
+          text, pos, node,
+          self.GetValueAtIndex(field_value, index, node_index))
+      if not isinstance(child, create_node.SyntaxFreeLine):
+        node_index += 1
+
+    while (create_node.SyntaxFreeLine.MatchesStart(text, pos) and
+           (text.startswith(indent_level, pos) or self.match_after)):
+      pos, syntax_free_node = self.MatchSyntaxFreeLineAt(text, pos)
       new_node.append(syntax_free_node)
     setattr(node, self.field_name, new_node)
-    matched_string = string
-    if remaining_string:
-      matched_string = string[:-len(remaining_string)]
-    return matched_string
+    return pos
 
   def GetElements(self, node):
     field_value = getattr(node, self.field_name)
@@ -595,17 +1261,325 @@ class BodyPlaceholder(ListFieldPlaceholder):
       return elements
     if self.prefix_placeholder:
       elements.append(self.prefix_placeholder)
-    for index, unused_child in enumerate(field_value):
-      elements.extend(self.GetValueAtIndex(field_value, index))
+    elements.extend(self._GetValuePlaceholders(field_value))
     return elements
 
 
+_WHITESPACE_RE = re.compile(r'\s*')
+
+
+def SkipWhitespace(text, pos):
+  """Returns the offset of the first non-whitespace character from pos."""
+  return _WHITESPACE_RE.match(text, pos).end()
+
+
+_START_PAREN_REGEX = r'\(\s*'
+_END_PAREN_REGEX = r'\s*\)'
+
+
 def GetStartParenMatcher():
-  return TextPlaceholder(r'\(\s*', '')
+  return TextPlaceholder(_START_PAREN_REGEX, '')
 
 
 def GetEndParenMatcher():
-  return TextPlaceholder(r'\s*\)', '')
+  return TextPlaceholder(_END_PAREN_REGEX, '')
+
+
+# The cached_source of a matcher in a SourceCache whose source has to be
+# regenerated.
+_DIRTY = object()
+
+
+class SourceCache(object):
+  """Memoizes the source of every node in a tree until it is marked changed.
+
+  Once a SourceCache is created for a tree, GetSource returns the source of
+  each node from the last time it was generated. After changing a node (its
+  fields, its matcher, or the lists of child nodes it holds), call MarkChanged
+  on it, which also invalidates all the nodes containing it. Regenerating the
+  source then only re-renders the path from the root to the changed node.
+  """
+
+  def __init__(self, root):
+    self.root = root
+    self._parents = {}
+    self.Track(root)
+
+  def Track(self, node):
+    """Starts caching the source of node and the nodes it contains."""
+    for descendant in ast.walk(node):
+      for child in ast.iter_child_nodes(descendant):
+        self._parents[child] = descendant
+      matcher = getattr(descendant, 'matcher', None)
+      if matcher:
+        matcher.cached_source = _DIRTY
+
+  def Untrack(self, node):
+    """Forgets about node and the nodes it contains, once they are removed."""
+    for descendant in ast.walk(node):
+      self._parents.pop(descendant, None)
+
+  def MarkChanged(self, node):
+    """Invalidates the cached source of node and all nodes containing it."""
+    for child in ast.iter_child_nodes(node):
+      self._parents[child] = node
+    while node is not None:
+      matcher = getattr(node, 'matcher', None)
+      if matcher:
+        matcher.cached_source = _DIRTY
+      node = self._parents.get(node)
+
+  def GetSource(self):
+    return self.root.matcher.GetCachedSource()
+
+
+def _IsFutureImport(node):
+  return isinstance(node, _ast.ImportFrom) and node.module == '__future__'
+
+
+def _GetFutureFlags(module_node):
+  """Returns the compiler flags for the __future__ imports of a module."""
+  flags = 0
+  for node in module_node.body:
+    if _IsFutureImport(node):
+      for alias in node.names:
+        flags |= getattr(__future__, alias.name).compiler_flag
+  return flags
+
+
+def _MatchSyntaxFreeLines(text):
+  """Matches text made up of SyntaxFreeLines, returning the new nodes.
+
+  Raises:
+    BadlySpecifiedTemplateError: If text has any other lines.
+  """
+  body_placeholder = BodyPlaceholder('body')
+  nodes = []
+  pos = 0
+  while create_node.SyntaxFreeLine.MatchesStart(text, pos):
+    pos, syntax_free_node = body_placeholder.MatchSyntaxFreeLineAt(text, pos)
+    nodes.append(syntax_free_node)
+  if pos != len(text):
+    raise BadlySpecifiedTemplateError(
+        'Text is not made up of syntax free lines', text, pos)
+  return nodes
+
+
+def _MatchStatements(text, flags):
+  """Parses and matches text as a sequence of module level statements.
+
+  Returns:
+    The list of new module body nodes, or None if text doesn't parse or
+    match on its own.
+  """
+  try:
+    new_module = compile(text, '<unknown>', 'exec', ast.PyCF_ONLY_AST | flags)
+    if not new_module.body:
+      return _MatchSyntaxFreeLines(text)
+    GetSource(new_module, text)
+  except (SyntaxError, Error):
+    return None
+  if new_module.matcher.GetSource() != text:
+    return None
+  return new_module.body
+
+
+def _WidenToLazyStatements(body, first, last):
+  """Widens body[first:last + 1] to whole groups of lazily matched statements.
+
+  The text of a group is all written by its first statement, so the group
+  can only be parsed again as a whole.
+  """
+  first_matcher = getattr(body[first], 'matcher', None)
+  if isinstance(first_matcher, LazyStatementMatcher):
+    first = body.index(first_matcher.statements.nodes[0])
+  last_matcher = getattr(body[last], 'matcher', None)
+  if isinstance(last_matcher, LazyStatementMatcher):
+    last = body.index(last_matcher.statements.nodes[-1])
+  return first, last
+
+
+def ApplyTextEdit(module_node, start, end, replacement, source_cache=None):
+  """Updates a matched module after replacing part of its source.
+
+  Only the module level statements (and syntax free lines) that the edit
+  touches are parsed and matched again, and the new nodes take their place in
+  module_node.body. If the edited statements don't parse on their own, for
+  example because the edit leaves a bracket open or changes the indentation
+  of a statement, the whole module is parsed and matched again instead. Of a
+  module matched lazily, the statements are parsed again in whole groups.
+
+  Line numbers of the nodes following the edited statements are not updated.
+
+  Args:
+    module_node: {_ast.Module} A module whose source was matched.
+    start: {int} The offset in the module source where the edit starts.
+    end: {int} The offset in the module source where the edit ends.
+    replacement: {str} The text replacing the source from start to end.
+    source_cache: {SourceCache} The SourceCache of module_node, if there is
+        one. It is updated with the new nodes, and spares regenerating the
+        sources of the statements to find the ones that were edited.
+
+  Returns:
+    A list of the nodes that were added to module_node.body.
+
+  Raises:
+    SyntaxError: If the edited module source doesn't parse.
+    ValueError: If start and end aren't a range in the module source.
+    Error: If statements of a lazily matched module were changed or moved
+        before they were matched.
+  """
+  body = module_node.body
+  sources = [None] * len(body)
+  _WriteBodySources(body, sources.__setitem__)
+  offsets = [0]
+  for source in sources:
+    offsets.append(offsets[-1] + len(source))
+  if not 0 <= start <= end <= offsets[-1]:
+    raise ValueError('Edit range {}-{} is not within the module source, which '
+                     'is {} characters long'.format(start, end, offsets[-1]))
+  first = min(bisect.bisect_right(offsets, start) - 1, len(body) - 1)
+  last = max(first, bisect.bisect_left(offsets, end) - 1)
+  if body:
+    first, last = _WidenToLazyStatements(body, first, last)
+
+  new_nodes = None
+  if body and not any(_IsFutureImport(child) for child in body[first:last + 1]):
+    old_text = ''.join(sources[first:last + 1])
+    new_text = (old_text[:start - offsets[first]] + replacement +
+                old_text[end - offsets[first]:])
+    # Unless the edited statements are the last ones, the next statement has
+    # to start on a new line for them to be independent of it.
+    if last == len(body) - 1 or new_text.endswith('\n'):
+      new_nodes = _MatchStatements(new_text, _GetFutureFlags(module_node))
+    if new_nodes and any(_IsFutureImport(node) for node in new_nodes):
+      new_nodes = None
+
+  if new_nodes is None:
+    text = ''.join(sources)
+    text = text[:start] + replacement + text[end:]
+    new_body = ast.parse(text).body
+    if source_cache:
+      source_cache.Untrack(module_node)
+    module_node.body = new_body
+    module_node.matcher = None
+    GetSource(module_node, text)
+    if source_cache:
+      source_cache.Track(module_node)
+    return module_node.body
+
+  line_offset = ''.join(sources[:first]).count('\n')
+  for node in new_nodes:
+    for descendant in ast.walk(node):
+      if hasattr(descendant, 'lineno'):
+        descendant.lineno += line_offset
+  if source_cache:
+    for node in body[first:last + 1]:
+      source_cache.Untrack(node)
+    for node in new_nodes:
+      source_cache.Track(node)
+  body[first:last + 1] = new_nodes
+  if source_cache:
+    source_cache.MarkChanged(module_node)
+  return new_nodes
+
+
+AnnotationResult = collections.namedtuple(
+    'AnnotationResult',
+    ['path', 'round_trip_ok', 'num_lines', 'seconds', 'error'])
+
+# Errors from matching include the text that failed to match, so they are cut
+# short before being sent back from the worker processes.
+_MAX_ERROR_LENGTH = 500
+
+# Any timeout will do for Queue.get to be interruptible; none is reached.
+_MAX_WAIT_SECONDS = 1e9
+
+
+def _AnnotateFile(path):
+  """Annotates the file at path, for AnnotateFiles."""
+  start_time = time.time()
+  num_lines = 0
+  error = None
+  try:
+    with open(path) as source_file:
+      text = source_file.read()
+    num_lines = text.count('\n')
+    module_node = ast.parse(text, path)
+    round_trip_ok = GetSource(module_node, text) == text
+  except Exception as e:  # pylint: disable=broad-except
+    round_trip_ok = False
+    error = repr(e)[:_MAX_ERROR_LENGTH]
+  return AnnotationResult(
+      path, round_trip_ok, num_lines, time.time() - start_time, error)
+
+
+def _AnnotateFileChunk(paths):
+  """Annotates the files at paths, for AnnotateFiles."""
+  return [_AnnotateFile(path) for path in paths]
+
+
+# How many chunks of paths AnnotateFiles keeps in flight per worker process,
+# so that workers don't wait for the next chunk to be sent.
+_CHUNKS_IN_FLIGHT_PER_PROCESS = 2
+
+
+def AnnotateFiles(paths, processes=None, chunksize=8):
+  """Annotates many files, in parallel across worker processes.
+
+  Each file is parsed, matched with GetSource and checked to round trip. The
+  annotated trees stay in the worker processes; only the results come back.
+
+  Paths are read from paths a chunk at a time, as workers are ready for
+  them, so a lazy iterator over many files isn't held in memory at once.
+  (multiprocessing.Pool's imap would read all of it up front.)
+
+  Args:
+    paths: {iterable(str)} The paths of the files. It may be a lazy iterator.
+    processes: {int} The number of worker processes, or None for one per CPU.
+        With 1, the files are annotated in this process instead.
+    chunksize: {int} How many paths are sent to a worker process at a time.
+
+  Yields:
+    An AnnotationResult for each file, a chunk at a time, in the order the
+    chunks are done in.
+  """
+  if processes == 1:
+    for path in paths:
+      yield _AnnotateFile(path)
+    return
+  if processes is None:
+    processes = multiprocessing.cpu_count()
+  paths = iter(paths)
+  pool = multiprocessing.Pool(processes)
+  # The callbacks run on a thread of the pool, which puts the results of
+  # each chunk here as it is done.
+  done_chunks = Queue.Queue()
+
+  def SubmitChunk():
+    chunk = list(itertools.islice(paths, chunksize))
+    if not chunk:
+      return False
+    pool.apply_async(_AnnotateFileChunk, (chunk,),
+                     callback=done_chunks.put)
+    return True
+
+  try:
+    num_in_flight = 0
+    while (num_in_flight < processes * _CHUNKS_IN_FLIGHT_PER_PROCESS and
+           SubmitChunk()):
+      num_in_flight += 1
+    while num_in_flight:
+      # Waiting with a timeout lets KeyboardInterrupt through.
+      results = done_chunks.get(True, _MAX_WAIT_SECONDS)
+      num_in_flight -= 1
+      if SubmitChunk():
+        num_in_flight += 1
+      for result in results:
+        yield result
+  finally:
+    pool.terminate()
+    pool.join()
 
 
 class SourceMatcher(object):
@@ -614,62 +1588,106 @@ class SourceMatcher(object):
   These are designed to match the source that corresponds to a given node.
   """
 
+  __slots__ = ('node', 'end_paren_matchers', 'paren_wrapped',
+               'start_paren_matchers', 'cached_source')
+
   def __init__(self, node, stripped_parens=None):
     self.node = node
-    self.end_paren_matchers = []
+    # The paren lists are only allocated once a paren is matched. Starting
+    # parens are shared with the parent matcher, which is how a child that
+    # is wrapped in its parent's parens can claim them.
+    self.end_paren_matchers = ()
     self.paren_wrapped = False
-    if not stripped_parens:
-      stripped_parens = []
-    self.start_paren_matchers = stripped_parens
+    self.start_paren_matchers = stripped_parens or ()
+    # None unless the matcher is part of a SourceCache.
+    self.cached_source = None
+
+  def __deepcopy__(self, memo):
+    return _DeepCopySlots(self, memo)
 
   def Match(self, string):
+    """Matches the start of string, returning the matched text."""
+    return string[:self.MatchAt(string, 0)]
+
+  def MatchAt(self, text, pos):
+    """Matches text starting at pos, returning the offset past the match."""
     raise NotImplementedError
 
   def GetSource(self):
-    raise NotImplementedError
+    """Returns the source for the node.
 
-  def MatchStartParens(self, string):
-    """Matches the starting parens in a string."""
-    remaining_string = string
-    matched_parts = []
-    try:
-      while True:
-        start_paren_matcher = GetStartParenMatcher()
-        remaining_string = MatchPlaceholder(
-            remaining_string, None, start_paren_matcher)
-        self.start_paren_matchers.append(start_paren_matcher)
-        matched_parts.append(start_paren_matcher.matched_text)
-    except BadlySpecifiedTemplateError:
-      pass
-    return remaining_string
-
-  def MatchEndParen(self, string):
-    """Matches the ending parens in a string."""
+    Subclasses override either this or WriteSource; each defaults to the
+    other.
+    """
+    source_list = []
+    self.WriteSource(source_list.append)
+    return ''.join(source_list)
+
+  def WriteSource(self, write):
+    """Writes the source for the node in pieces with the function write."""
+    write(self.GetSource())
+
+  def GetCachedSource(self):
+    """Returns GetSource(), memoized if the matcher is in a SourceCache."""
+    if self.cached_source is None:
+      return self.GetSource()
+    if self.cached_source is _DIRTY:
+      self.cached_source = self.GetSource()
+    return self.cached_source
+
+  def WriteCachedSource(self, write):
+    """Like WriteSource, but writes the memoized source if there is one."""
+    if self.cached_source is None:
+      self.WriteSource(write)
+    else:
+      write(self.GetCachedSource())
+
+  def MatchStartParens(self, text, pos):
+    """Matches the starting parens in text at pos, returning the new offset."""
+    # A start paren can't match anywhere but at a '(', so other text is
+    # turned down without building a matcher. A matcher is only built once
+    # a paren has matched.
+    spec = _GetTextSpec(_START_PAREN_REGEX)
+    while text.startswith('(', pos):
+      end = MatchTextSpecAt(spec, text, pos)
+      if end == -1:
+        break
+      start_paren_matcher = GetStartParenMatcher()
+      start_paren_matcher.matched_text = GetMatchedText(text, pos, end)
+      pos = end
+      if not self.start_paren_matchers:
+        self.start_paren_matchers = []
+      self.start_paren_matchers.append(start_paren_matcher)
+    return pos
+
+  def MatchEndParen(self, text, pos):
+    """Matches the ending parens in text at pos, returning the new offset."""
     if not self.start_paren_matchers:
-      return
-    remaining_string = string
-    matched_parts = []
-    try:
-      for unused_i in xrange(len(self.start_paren_matchers)):
-        end_paren_matcher = GetEndParenMatcher()
-        remaining_string = MatchPlaceholder(
-            remaining_string, None, end_paren_matcher)
-        self.end_paren_matchers.append(end_paren_matcher)
-        matched_parts.append(end_paren_matcher.matched_text)
-        self.paren_wrapped = True
-    except BadlySpecifiedTemplateError:
-      pass
+      return pos
+    spec = _GetTextSpec(_END_PAREN_REGEX)
+    for unused_i in xrange(len(self.start_paren_matchers)):
+      end = MatchTextSpecAt(spec, text, pos)
+      if end == -1:
+        break
+      end_paren_matcher = GetEndParenMatcher()
+      end_paren_matcher.matched_text = GetMatchedText(text, pos, end)
+      pos = end
+      if not self.end_paren_matchers:
+        self.end_paren_matchers = []
+      self.end_paren_matchers.append(end_paren_matcher)
+      self.paren_wrapped = True
 
     new_end_matchers = []
     new_start_matchers = []
     min_size = min(len(self.start_paren_matchers), len(self.end_paren_matchers))
     if min_size == 0:
-      return
+      return pos
     for end_matcher in self.end_paren_matchers[:min_size]:
       new_start_matchers.append(self.start_paren_matchers.pop())
       new_end_matchers.append(end_matcher)
     self.start_paren_matchers = new_start_matchers[::-1]
     self.end_paren_matchers = new_end_matchers
+    return pos
 
   def GetStartParenText(self):
     if self.paren_wrapped:
@@ -687,6 +1705,8 @@ class SourceMatcher(object):
 class DefaultSourceMatcher(SourceMatcher):
   """Class to generate the source for a node."""
 
+  __slots__ = ('expected_parts', 'matched')
+
   def __init__(self, node, expected_parts, starting_parens=None):
     super(DefaultSourceMatcher, self).__init__(node, starting_parens)
     previous_was_string = False
@@ -704,8 +1724,8 @@ class DefaultSourceMatcher(SourceMatcher):
     self.expected_parts = expected_parts
     self.matched = False
 
-  def Match(self, string):
-    """Matches the string against self.expected_parts.
+  def MatchAt(self, text, pos):
+    """Matches the text at pos against self.expected_parts.
 
     Note that this is slightly peculiar in that it first matches fields,
     then goes back to match text before them. This is because currently we
@@ -715,47 +1735,30 @@ class DefaultSourceMatcher(SourceMatcher):
     '.*' TextSeparators.
 
     Args:
-      string: {str} The string to match.
+      text: {str} The text to match.
+      pos: {int} The offset in text to start matching at.
 
     Returns:
-      The matched text.
+      The offset in text just past the match.
 
     Raises:
       BadlySpecifiedTemplateError: If there is a mismatch between the
         expected_parts and the string.
       ValueError: If there is more than one TextPlaceholder in a rwo
     """
-    remaining_string = self.MatchStartParens(string)
-
-    try:
-      remaining_string = MatchPlaceholderList(
-          remaining_string, self.node, self.expected_parts,
-          self.start_paren_matchers)
-      self.MatchEndParen(remaining_string)
-
-    except BadlySpecifiedTemplateError as e:
-      raise BadlySpecifiedTemplateError(
-          'When attempting to match string "{}" with {}, this '
-          'error resulted:\n\n{}'
-          .format(string, self, e.message))
-    matched_string = string
-    if remaining_string:
-      matched_string = string[:-len(remaining_string)]
-    return (self.GetStartParenText() +
-            matched_string +
-            self.GetEndParenText())
+    pos = self.MatchStartParens(text, pos)
+    pos = MatchPlaceholderListAt(
+        text, pos, self.node, self.expected_parts,
+        self.start_paren_matchers)
+    return self.MatchEndParen(text, pos)
 
-  def GetSource(self):
-    source_list = []
+  def WriteSource(self, write):
+    if self.paren_wrapped:
+      write(self.GetStartParenText())
     for part in self.expected_parts:
-      source_list.append(part.GetSource(self.node))
-    source = ''.join(source_list)
+      part.WriteSource(self.node, write)
     if self.paren_wrapped:
-      source = '{}{}{}'.format(
-          self.GetStartParenText(),
-          source,
-          self.GetEndParenText())
-    return source
+      write(self.GetEndParenText())
 
   def __repr__(self):
     return ('DefaultSourceMatcher "{}" for node "{}" expecting to match "{}"'
@@ -764,29 +1767,319 @@ class DefaultSourceMatcher(SourceMatcher):
                     pprint.pformat(self.expected_parts)))
 
 
+def _GetFieldValues(nodes):
+  """Returns the fields of nodes, to tell if any of them is changed.
+
+  Only the nodes' own fields are looked at, not the nodes they hold, so this
+  is cheap and doesn't recurse however deep the nodes are. Lists are copied,
+  so that adding to or removing from them shows too.
+  """
+  return [tuple(tuple(value) if isinstance(value, list) else value
+                for unused_name, value in ast.iter_fields(node))
+          for node in nodes]
+
+
+class _LazyStatements(object):
+  """Module level statements that are matched together, once needed.
+
+  These are the statements from one line starting a statement to the next,
+  along with any syntax free lines after them. Statements on the same line,
+  and statements starting with a string on more than one line, whose line
+  numbers are where the string ends, can't be told apart by line numbers,
+  so they share a group.
+
+  Until they are matched, the module writes the text of the group as it was.
+  So that changes aren't silently lost, the group keeps the fields of its
+  statements, and refuses to be written or matched once they differ. Only
+  the statements' own fields are kept, so changes to the nodes inside them
+  go unnoticed: call MatchLazyStatement on a statement before changing it.
+  """
+
+  __slots__ = ('module_node', 'nodes', 'text', 'start', 'end', 'field_values')
+
+  def __init__(self, module_node, text, start):
+    self.module_node = module_node
+    self.nodes = []
+    self.text = text
+    self.start = start
+    self.end = start
+    self.field_values = None
+
+  def GetText(self):
+    return self.text[self.start:self.end]
+
+  def CheckUnchanged(self, body, index):
+    """Checks that the statements are unchanged, and at body[index:].
+
+    Raises:
+      Error: If any of the statements was changed, moved or removed.
+    """
+    if body[index:index + len(self.nodes)] != self.nodes:
+      raise Error(
+          'The statements from line {} were moved or removed before they '
+          'were matched. Call MatchLazyStatement on them first.'.format(
+              self.nodes[0].lineno))
+    if _GetFieldValues(self.nodes) != self.field_values:
+      raise Error(
+          'The statements from line {} were changed before they were '
+          'matched. Call MatchLazyStatement on them first.'.format(
+              self.nodes[0].lineno))
+
+  def Match(self):
+    """Matches the statements, replacing them in the module's body.
+
+    Returns:
+      The nodes that replaced the statements, with the syntax free lines.
+
+    Raises:
+      BadlySpecifiedTemplateError: If the statements don't match their text.
+      Error: If any of the statements was changed, moved or removed.
+    """
+    body = self.module_node.body
+    first = next((index for index, node in enumerate(body)
+                  if node is self.nodes[0]), len(body))
+    self.CheckUnchanged(body, first)
+    lazy_matchers = [node.matcher for node in self.nodes]
+    for node in self.nodes:
+      node.matcher = None
+    holder = _ast.Module(body=list(self.nodes))
+    try:
+      # The syntax free lines up to the next group all belong to this one.
+      end = BodyPlaceholder('body', match_after=True).MatchAt(
+          holder, self.text, self.start)
+      if end != self.end:
+        raise BadlySpecifiedTemplateError(
+            'Statements should have ended at offset {}'.format(self.end),
+            self.text, end)
+    except Error:
+      for node, matcher in zip(self.nodes, lazy_matchers):
+        node.matcher = matcher
+      raise
+    body[first:first + len(self.nodes)] = holder.body
+    return holder.body
+
+
+class LazyStatementMatcher(SourceMatcher):
+  """Stands in for the matcher of a module level statement not matched yet.
+
+  Getting the source of the statement matches it, along with the rest of its
+  group. The module writes the text of the group as it was, without
+  matching it.
+  """
+
+  __slots__ = ('statements',)
+
+  def __init__(self, node, statements):
+    super(LazyStatementMatcher, self).__init__(node)
+    self.statements = statements
+
+  def WriteSource(self, write):
+    if self.node.matcher is self:
+      self.statements.Match()
+    self.node.matcher.WriteSource(write)
+
+  def __repr__(self):
+    return 'LazyStatementMatcher for node "{}" at offset {}'.format(
+        self.node, self.statements.start)
+
+
+def _WriteBodySources(body, write):
+  """Writes the source of each node of body, with write(index, source).
+
+  Statements that aren't matched yet are written as their group's text, as
+  the source of the first statement of the group.
+
+  Raises:
+    Error: If statements that aren't matched yet were changed or moved.
+  """
+  index = 0
+  while index < len(body):
+    node = body[index]
+    matcher = getattr(node, 'matcher', None)
+    if isinstance(matcher, LazyStatementMatcher):
+      statements = matcher.statements
+      statements.CheckUnchanged(body, index)
+      write(index, statements.GetText())
+      for offset in xrange(1, len(statements.nodes)):
+        write(index + offset, '')
+      index += len(statements.nodes)
+    else:
+      write(index, GetSource(node))
+      index += 1
+
+
+class LazyModuleSourceMatcher(SourceMatcher):
+  """Source matcher for a module matched with GetSource(..., lazy=True)."""
+
+  __slots__ = ()
+
+  def WriteSource(self, write):
+    _WriteBodySources(
+        self.node.body, lambda unused_index, source: write(source))
+
+
+def _AttachLazyMatchers(module_node, text):
+  """Splits the statements of module_node into _LazyStatements of text."""
+  if not (isinstance(module_node, _ast.Module) and text):
+    raise ValueError('Only a module with text can be matched lazily, not {}'
+                     .format(module_node))
+  if not module_node.body:
+    _AttachMatcher(module_node, text, None, False)
+    return
+  if isinstance(text, (SourceBuffer, MappedText)):
+    module_node.source_buffer = text
+  module_node.matcher = LazyModuleSourceMatcher(module_node)
+  statements = _LazyStatements(module_node, text, 0)
+  groups = [statements]
+  line = 1
+  line_start = 0
+  for node in module_node.body:
+    # A statement starting in the first column starts its line, unless it's
+    # the first one. The column of a string on more than one line is -1.
+    if statements.nodes and node.col_offset == 0 and node.lineno > line:
+      while line < node.lineno:
+        line_start = text.index('\n', line_start) + 1
+        line += 1
+      statements.end = line_start
+      statements = _LazyStatements(module_node, text, line_start)
+      groups.append(statements)
+    statements.nodes.append(node)
+    node.matcher = LazyStatementMatcher(node, statements)
+  statements.end = len(text)
+  for statements in groups:
+    statements.field_values = _GetFieldValues(statements.nodes)
+
+
+def MatchLazyStatement(node, source_cache=None):
+  """Matches a statement of a module matched with GetSource(..., lazy=True).
+
+  The statements grouped with node are matched along with it, and the syntax
+  free lines among them are added to the module's body, as GetSource would
+  have. Nothing is done for a statement that is already matched.
+
+  Args:
+    node: {_ast.stmt} A module level statement.
+    source_cache: {SourceCache} The SourceCache of the module, if there is
+        one. It is updated with the newly matched nodes.
+
+  Raises:
+    BadlySpecifiedTemplateError: If the statements don't match their text.
+    Error: If any of the statements was changed, moved or removed since the
+        module was split.
+  """
+  matcher = getattr(node, 'matcher', None)
+  if not isinstance(matcher, LazyStatementMatcher):
+    return
+  new_nodes = matcher.statements.Match()
+  if source_cache:
+    for new_node in new_nodes:
+      source_cache.Track(new_node)
+    source_cache.MarkChanged(matcher.statements.module_node)
+
+
+class ExpectedPartsTemplate(object):
+  """The expected parts for a node type, built once and shared by all nodes.
+
+  The placeholders returned by get_expected_parts are kept as prototypes,
+  which are never matched themselves. Each matcher gets its own placeholders
+  from Instantiate(), which only allocates what matching a node changes.
+  """
+
+  __slots__ = ('get_expected_parts', 'parts')
+
+  def __init__(self, get_expected_parts):
+    self.get_expected_parts = get_expected_parts
+    self.parts = tuple(get_expected_parts())
+
+  def Instantiate(self):
+    return [part.Instantiate() for part in self.parts]
+
+  def GetMatcher(self, node, starting_parens):
+    return DefaultSourceMatcher(node, self.Instantiate(), starting_parens)
+
+
+# A mapping of node_type: a function taking a node of that type and its
+# starting parens, and returning a matcher for the node. This is either a
+# SourceMatcher subclass or ExpectedPartsTemplate.GetMatcher.
+_matcher_factories = {}
+
+# Like _matcher_factories, for node types without an entry there whose base
+# classes have one. Filled in as such node types are seen.
+_inherited_matcher_factories = {}
+
+
+def RegisterMatcherClass(node_type, matcher_class):
+  """Makes GetMatcher return a matcher_class for nodes of node_type.
+
+  This applies to subclasses of node_type too, unless they are registered
+  themselves.
+
+  Args:
+    node_type: {type} The class of the nodes.
+    matcher_class: {type} A SourceMatcher subclass, which is constructed with
+        the node and the parens it starts with.
+
+  Raises:
+    ValueError: If matcher_class isn't a SourceMatcher subclass.
+  """
+  if not (isinstance(matcher_class, type) and
+          issubclass(matcher_class, SourceMatcher)):
+    raise ValueError(
+        '{} is not a SourceMatcher subclass'.format(matcher_class))
+  _matcher_factories[node_type] = matcher_class
+  _inherited_matcher_factories.clear()
+
+
+def RegisterExpectedParts(node_type, get_expected_parts):
+  """Makes GetMatcher match nodes of node_type against expected parts.
+
+  This applies to subclasses of node_type too, unless they are registered
+  themselves.
+
+  Args:
+    node_type: {type} The class of the nodes.
+    get_expected_parts: {function} Returns the list of placeholders that
+        nodes of node_type consist of, for a DefaultSourceMatcher. It is
+        called once, here, and the placeholders are kept as prototypes.
+  """
+  _matcher_factories[node_type] = ExpectedPartsTemplate(
+      get_expected_parts).GetMatcher
+  _inherited_matcher_factories.clear()
+
+
+def _GetInheritedMatcherFactory(node_type):
+  try:
+    return _inherited_matcher_factories[node_type]
+  except KeyError:
+    pass
+  for base in node_type.__mro__[1:]:
+    factory = _matcher_factories.get(base)
+    if factory is not None:
+      _inherited_matcher_factories[node_type] = factory
+      return factory
+  raise KeyError('No matcher is registered for {}'.format(node_type))
+
+
 def GetMatcher(node, starting_parens=None):
   """Gets an initialized matcher for the given node (doesnt call .Match).
 
-  If there is no corresponding matcher in _matchers, this will return a
-  default matcher, which starts with a placeholder for the first field, ends
-  with a placeholder for the last field, and includes TextPlaceholders
-  with '.*' regexes between.
-
   Args:
     node: The node to get a matcher for.
     starting_parens: The parens the matcher may start with.
 
   Returns:
-    A matcher corresponding to that node, or the default matcher (see above).
+    The matcher registered for the type of the node, or for the closest of
+    its base classes.
+
+  Raises:
+    KeyError: If no matcher is registered for the node.
   """
   if starting_parens is None:
     starting_parens = []
-  parts_or_matcher = _matchers[node.__class__]
-  try:
-    parts = parts_or_matcher()
-    return DefaultSourceMatcher(node, parts, starting_parens)
-  except TypeError:
-    return parts_or_matcher(node, starting_parens)
+  factory = _matcher_factories.get(node.__class__)
+  if factory is None:
+    factory = _GetInheritedMatcherFactory(node.__class__)
+  return factory(node, starting_parens)
 
 
 # TODO: Add an indent placeholder that respects col_offset
@@ -893,6 +2186,8 @@ def get_BitXor_expected_parts():
 class BoolOpSourceMatcher(SourceMatcher):
   """Class to generate the source for an _ast.BoolOp node."""
 
+  __slots__ = ('separator_placeholder', 'matched_placeholders')
+
   def __init__(self, node, starting_parens=None):
     super(BoolOpSourceMatcher, self).__init__(node, starting_parens)
     self.separator_placeholder = TextPlaceholder(r'\s*', ' ')
@@ -903,8 +2198,8 @@ class BoolOpSourceMatcher(SourceMatcher):
     self.matched_placeholders.append(copy)
     return copy
 
-  def Match(self, string):
-    remaining_string = self.MatchStartParens(string)
+  def MatchAt(self, text, pos):
+    pos = self.MatchStartParens(text, pos)
 
     elements = [self.node.values[0]]
     for value in self.node.values[1:]:
@@ -913,36 +2208,29 @@ class BoolOpSourceMatcher(SourceMatcher):
       elements.append(self.GetSeparatorCopy())
       elements.append(value)
 
-    parser = StringParser(remaining_string, elements, self.start_paren_matchers)
-    matched_text = ''.join(parser.matched_substrings)
-    remaining_string = parser.remaining_string
-
-    self.MatchEndParen(remaining_string)
-
-    return self.GetStartParenText() + matched_text + self.GetEndParenText()
+    parser = StringParser(text, elements, self.start_paren_matchers, pos=pos)
+    return self.MatchEndParen(text, parser.pos)
 
-  def GetSource(self):
-    source_list = []
+  def WriteSource(self, write):
     if self.paren_wrapped:
-      source_list.append(self.GetStartParenText())
-    source_list.append(GetSource(self.node.values[0]))
+      write(self.GetStartParenText())
+    _WriteSource(self.node.values[0], write)
     index = 0
     for value in self.node.values[1:]:
-      source_list.append(_GetListDefault(
+      write(_GetListDefault(
           self.matched_placeholders,
           index,
           self.separator_placeholder).GetSource(None))
-      source_list.append(GetSource(self.node.op))
+      _WriteSource(self.node.op, write)
       index += 1
-      source_list.append(_GetListDefault(
+      write(_GetListDefault(
           self.matched_placeholders,
           index,
           self.separator_placeholder).GetSource(None))
-      source_list.append(GetSource(value))
+      _WriteSource(value, write)
       index += 1
     if self.paren_wrapped:
-      source_list.append(self.GetEndParenText())
-    return ''.join(source_list)
+      write(self.GetEndParenText())
 
 
 def get_Break_expected_parts():
@@ -1127,9 +2415,32 @@ def get_GtE_expected_parts():
   return [TextPlaceholder(r'>=', '>=')]
 
 
+class _ElifWriter(object):
+  """Writes the source of an If node with "el" put before its "if"."""
+
+  __slots__ = ('write', 'wrote_elif')
+
+  def __init__(self, write):
+    self.write = write
+    self.wrote_elif = False
+
+  def __call__(self, fragment):
+    if not self.wrote_elif:
+      stripped_fragment = fragment.lstrip()
+      if stripped_fragment:
+        indent = len(fragment) - len(stripped_fragment)
+        fragment = fragment[:indent] + 'el' + stripped_fragment
+        self.wrote_elif = True
+    self.write(fragment)
+
+
 class IfSourceMatcher(SourceMatcher):
   """Class to generate the source for an _ast.If node."""
 
+  __slots__ = ('if_placeholder', 'test_placeholder', 'if_colon_placeholder',
+               'body_placeholder', 'else_placeholder', 'orelse_placeholder',
+               'is_elif', 'if_indent')
+
   def __init__(self, node, starting_parens=None):
     super(IfSourceMatcher, self).__init__(node, starting_parens)
     self.if_placeholder = TextPlaceholder(r' *if\s*', 'if ')
@@ -1141,65 +2452,78 @@ class IfSourceMatcher(SourceMatcher):
     self.is_elif = False
     self.if_indent = 0
 
-  def Match(self, string):
-    self.if_indent = len(string) - len(string.lstrip())
+  def MatchAt(self, text, pos, elif_branch=False):
+    """Matches the if statement at pos in text.
+
+    Args:
+      text: {str} The text to match.
+      pos: {int} The offset in text to start matching at.
+      elif_branch: {bool} True if this node is the orelse of another if
+          statement and text at pos reads "elif" rather than "if". The "el"
+          belongs to the parent, so it is skipped rather than matched.
+
+    Returns:
+      The offset in text just past the match.
+    """
+    self.if_indent = SkipWhitespace(text, pos) - pos
     placeholder_list = [self.if_placeholder,
                         self.test_placeholder,
                         self.if_colon_placeholder,
                         self.body_placeholder]
-    remaining_string = MatchPlaceholderList(
-        string, self.node, placeholder_list)
+    if elif_branch:
+      indent_end = pos + self.if_indent
+      indent = text[pos:indent_end]
+      if indent.strip(' ') or not text.startswith('el', indent_end):
+        raise BadlySpecifiedTemplateError(
+            'Text does not start with an elif', text, pos, node=self.node)
+      pos = MatchPlaceholderListAt(
+          text, indent_end + 2, self.node, placeholder_list[:1])
+      self.if_placeholder.matched_text = (
+          indent + self.if_placeholder.matched_text)
+      placeholder_list = placeholder_list[1:]
+    pos = MatchPlaceholderListAt(text, pos, self.node, placeholder_list)
     if not self.node.orelse:
-      return string[:len(remaining_string)]
-    else:
-      # Handles the case of a blank line before an elif/else statement
-      # Can't pass the "match_after" kwarg to self.body_placeholder,
-      # because we don't want to match after if we don't have an else.
-      while create_node.SyntaxFreeLine.MatchesStart(remaining_string):
-        remaining_string, syntax_free_node = (
-            self.body_placeholder.MatchSyntaxFreeLine(remaining_string))
-        self.node.body.append(syntax_free_node)
-      if remaining_string.lstrip().startswith('elif'):
-        self.is_elif = True
-        indent = len(remaining_string) - len(remaining_string.lstrip())
-        remaining_string = (remaining_string[:indent] +
-                            remaining_string[indent+2:])
-        # This is a hack to handle the fact that elif is a special case
-        # BodyPlaceholder uses the indent of the other child statements
-        # to match SyntaxFreeLines, which breaks in this case, because the
-        # child isn't indented
-        self.orelse_placeholder = ListFieldPlaceholder('orelse')
-      else:
-        remaining_string = MatchPlaceholder(
-            remaining_string, self.node, self.else_placeholder)
-    remaining_string = self.orelse_placeholder.Match(
-        self.node, remaining_string)
-    if not remaining_string:
-      return string
-    return string[:len(remaining_string)]
-
-  def GetSource(self):
+      return pos
+    # Handles the case of a blank line before an elif/else statement
+    # Can't pass the "match_after" kwarg to self.body_placeholder,
+    # because we don't want to match after if we don't have an else.
+    while create_node.SyntaxFreeLine.MatchesStart(text, pos):
+      pos, syntax_free_node = (
+          self.body_placeholder.MatchSyntaxFreeLineAt(text, pos))
+      self.node.body.append(syntax_free_node)
+    if text.startswith('elif', SkipWhitespace(text, pos)):
+      self.is_elif = True
+      # This is a hack to handle the fact that elif is a special case
+      # BodyPlaceholder uses the indent of the other child statements
+      # to match SyntaxFreeLines, which breaks in this case, because the
+      # child isn't indented
+      self.orelse_placeholder = ListFieldPlaceholder('orelse')
+      elif_node = self.node.orelse[0]
+      elif_node.matcher = GetMatcher(elif_node)
+      return elif_node.matcher.MatchAt(text, pos, elif_branch=True)
+    pos = self.else_placeholder.MatchAt(self.node, text, pos)
+    return self.orelse_placeholder.MatchAt(self.node, text, pos)
+
+  def WriteSource(self, write):
     placeholder_list = [self.if_placeholder,
                         self.test_placeholder,
                         self.if_colon_placeholder,
                         self.body_placeholder]
-    source_list = [p.GetSource(self.node) for p in placeholder_list]
+    for placeholder in placeholder_list:
+      placeholder.WriteSource(self.node, write)
     if not self.node.orelse:
-      return ''.join(source_list)
+      return
     if (len(self.node.orelse) == 1 and
         isinstance(self.node.orelse[0], _ast.If) and
         self.is_elif):
-      elif_source = GetSource(self.node.orelse[0])
-      indent = len(elif_source) - len(elif_source.lstrip())
-      source_list.append(elif_source[:indent] + 'el' + elif_source[indent:])
+      _WriteSource(self.node.orelse[0], _ElifWriter(write))
     else:
       if self.else_placeholder:
-        source_list.append(self.else_placeholder.GetSource(self.node))
+        self.else_placeholder.WriteSource(self.node, write)
       else:
-        source_list.append(' '*self.if_indent)
-        source_list.append('else:\n')
-      source_list.append(self.orelse_placeholder.GetSource(self.node))
-    return ''.join(source_list)
+        write(' '*self.if_indent)
+        write('else:\n')
+      self.orelse_placeholder.WriteSource(self.node, write)
 
 
 def get_IfExp_expected_parts():
@@ -1332,27 +2656,35 @@ def get_NotIn_expected_parts():
 class NumSourceMatcher(SourceMatcher):
   """Class to generate the source for an _ast.Num node."""
 
+  __slots__ = ('matched_num', 'matched_as_str', 'suffix')
+
   def __init__(self, node, starting_parens=None):
     super(NumSourceMatcher, self).__init__(node, starting_parens)
     self.matched_num = None
     self.matched_as_str = None
     self.suffix = None
 
-  def Match(self, string):
+  def MatchAt(self, text, pos):
     node_as_str = str(self.node.n)
     if isinstance(self.node.n, int):
       # Handle hex values
-      node_as_str = re.match(r'[+-]?(0x[0-9a-f]*|0[0-7]*|\d+)', string).group(0)
+      node_as_str = re.compile(
+          r'[+-]?(0x[0-9a-f]*|0[0-7]*|\d+)').match(text, pos).group(0)
     elif isinstance(self.node.n, float):
-      node_as_str = re.match(r'[-+]?\d*.\d*', string).group(0)
+      node_as_str = re.compile(r'[-+]?\d*.\d*').match(text, pos).group(0)
     self.matched_num = self.node.n
     self.matched_as_str = node_as_str
 
-    unused_before, after = string.split(node_as_str, 1)
-    if after and after[0] in ('l', 'L', 'j', 'J'):
-      self.suffix = after[0]
-      node_as_str += after[0]
-    return node_as_str
+    num_start = text.find(node_as_str, pos)
+    if num_start == -1:
+      raise BadlySpecifiedTemplateError(
+          'Text does not contain number "{}"'.format(node_as_str),
+          text, pos, node=self.node)
+    pos = num_start + len(node_as_str)
+    if text[pos:pos+1] in ('l', 'L', 'j', 'J'):
+      self.suffix = text[pos]
+      pos += 1
+    return pos
 
   def GetSource(self):
     node_as_str = str(self.node.n)
@@ -1442,43 +2774,34 @@ def get_Slice_expected_parts():
   ]
 
 
-def _IsBackslashEscapedQuote(string, quote_index):
-  """Checks if the quote at the given index is backslash escaped."""
-  num_preceding_backslashes = 0
-  for char in reversed(string[:quote_index]):
-    if char == '\\':
-      num_preceding_backslashes += 1
-    else:
-      break
-  return num_preceding_backslashes % 2 == 1
+_STRING_PART_START_RE = re.compile(r'([uU]?[rR]?)("""|\'\'\'|"|\')')
+
 
+def _FindQuoteEnd(string, quote_type, start=0):
+  """Finds the ending index of a quote.
 
-def _FindQuoteEnd(string, quote_type):
-  """Recursively finds the ending index of a quote.
+  Each candidate quote is found with str.find, and only the run of
+  backslashes right before it is looked at, so the string is scanned once.
 
   Args:
     string: The string to search inside of.
     quote_type: The quote type we're looking for.
+    start: The index in string to start searching from, just after the
+        opening quote.
 
   Returns:
-    The index of the end of the first quote.
-
-  The method works by attempting to find the first instance of the end of
-  the quote, then recursing if it isn't valid. If -1 is returned at any time,
-  we can't find the end, and we return -1.
+    The index of the first quote_type in string which isn't backslash escaped,
+    or -1 if there is none.
   """
-  trial_index = string.find(quote_type)
-  if trial_index == -1:
-    return -1
-  elif not _IsBackslashEscapedQuote(string, trial_index):
-    return trial_index
-  else:
-    new_start = trial_index + 1
-    rest_index = _FindQuoteEnd(string[new_start:], quote_type)
-    if rest_index == -1:
-      return -1
-    else:  # Return the recursive sum
-      return new_start + rest_index
+  quote_index = string.find(quote_type, start)
+  while quote_index != -1:
+    backslash_index = quote_index
+    while backslash_index > start and string[backslash_index - 1] == '\\':
+      backslash_index -= 1
+    if (quote_index - backslash_index) % 2 == 0:
+      return quote_index
+    quote_index = string.find(quote_type, quote_index + 1)
+  return -1
 
 
 class StringPartPlaceholder(Placeholder):
@@ -1488,39 +2811,60 @@ class StringPartPlaceholder(Placeholder):
   multiple parts.
   """
 
+  __slots__ = ('prefix_placeholder', 'quote_match_placeholder',
+               'inner_text_placeholder')
+
   def __init__(self):
     super(StringPartPlaceholder, self).__init__()
     self.prefix_placeholder = TextPlaceholder(r'ur|uR|Ur|UR|u|r|U|R|', '')
     self.quote_match_placeholder = TextPlaceholder(r'"""|\'\'\'|"|\'')
     self.inner_text_placeholder = TextPlaceholder(r'.*', '')
 
-  def Match(self, node, string):
-    elements = [self.prefix_placeholder, self.quote_match_placeholder]
-    remaining_string = StringParser(string, elements).remaining_string
-
-    quote_type = self.quote_match_placeholder.matched_text
-    end_index = _FindQuoteEnd(remaining_string, quote_type)
+  def MatchAt(self, node, text, pos):
+    match = _STRING_PART_START_RE.match(text, pos)
+    if not match:
+      raise BadlySpecifiedTemplateError(
+          'Text does not start with a string literal', text, pos, node=node,
+          placeholder=self)
+    self.prefix_placeholder.matched_text = match.group(1)
+    quote_type = match.group(2)
+    self.quote_match_placeholder.matched_text = quote_type
+    inner_start = match.end()
+
+    end_index = _FindQuoteEnd(text, quote_type, inner_start)
     if end_index == -1:
-      raise ValueError('String {} does not end properly'.format(string))
-    self.inner_text_placeholder.Match(
-        None, remaining_string[:end_index], dotall=True)
-    remaining_string = remaining_string[end_index+len(quote_type):]
-    if not remaining_string:
-      return string
-    return string[:-len(remaining_string)]
+      raise BadlySpecifiedTemplateError(
+          'String does not end properly', text, pos, node=node,
+          placeholder=self)
+    self.inner_text_placeholder.matched_text = GetMatchedText(
+        text, inner_start, end_index)
+    return end_index + len(quote_type)
 
   def GetSource(self, node):
+    source_list = []
+    self.WriteSource(node, source_list.append)
+    return ''.join(source_list)
+
+  def WriteSource(self, node, write):
     placeholder_list = [self.prefix_placeholder,
                         self.quote_match_placeholder,
                         self.inner_text_placeholder,
                         self.quote_match_placeholder]
-    source_list = [p.GetSource(node) for p in placeholder_list]
-    return ''.join(source_list)
+    for placeholder in placeholder_list:
+      write(placeholder.GetSource(node))
+
+
+_STRING_START_RE = re.compile(
+    r'ur"|uR"|Ur"|UR"|u"|U"|r"|R"|"|'
+    r"ur'|uR'|Ur'|UR'|u'|U'|r'|R'|'")
 
 
 class StrSourceMatcher(SourceMatcher):
   """Class to generate the source for an _ast.Str node."""
 
+  __slots__ = ('separator_placeholder', 'quote_parts', 'separators',
+               'quote_type', 'original_quote_type', 'original_s')
+
   def __init__(self, node, starting_parens=None):
     super(StrSourceMatcher, self).__init__(node, starting_parens)
     self.separator_placeholder = TextPlaceholder(r'\s*', '')
@@ -1535,36 +2879,33 @@ class StrSourceMatcher(SourceMatcher):
     return ''.join(p.inner_text_placeholder.GetSource(self.node)
                    for p in self.quote_parts)
 
-  def Match(self, string):
-    remaining_string = self.MatchStartParens(string)
+  def MatchAt(self, text, pos):
+    pos = self.MatchStartParens(text, pos)
     self.original_s = self.node.s
 
     part = StringPartPlaceholder()
-    remaining_string = MatchPlaceholder(remaining_string, None, part)
+    pos = part.MatchAt(None, text, pos)
     self.quote_parts.append(part)
 
     while True:
       separator = self.separator_placeholder.Copy()
-      trial_string = MatchPlaceholder(remaining_string, None, separator)
-      if (not re.match(r'ur"|uR"|Ur"|UR"|u"|U"|r"|R"|"', trial_string) and
-          not re.match(r"ur'|uR'|Ur'|UR'|u'|U'|r'|R'|'", trial_string)):
+      trial_pos = separator.MatchAt(None, text, pos)
+      if not _STRING_START_RE.match(text, trial_pos):
         break
-      remaining_string = trial_string
+      pos = trial_pos
       self.separators.append(separator)
       part = StringPartPlaceholder()
-      remaining_string = MatchPlaceholder(remaining_string, None, part)
+      pos = part.MatchAt(None, text, pos)
       self.quote_parts.append(part)
 
-    self.MatchEndParen(remaining_string)
+    pos = self.MatchEndParen(text, pos)
 
     self.original_quote_type = (
         self.quote_parts[0].quote_match_placeholder.matched_text)
 
-    return (self.GetStartParenText() +
-            string[:-len(remaining_string)] +
-            self.GetEndParenText())
+    return pos
 
-  def GetSource(self):
+  def WriteSource(self, write):
     # We try to preserve the formatting on a best-effort basis
     if self.original_s is not None and self.original_s != self.node.s:
       self.quote_parts = [self.quote_parts[0]]
@@ -1573,24 +2914,24 @@ class StrSourceMatcher(SourceMatcher):
     if self.original_s is None:
       if not self.quote_type:
         self.quote_type = self.original_quote_type or GetDefaultQuoteType()
-      return self.quote_type + self.node.s + self.quote_type
+      write(self.quote_type)
+      write(self.node.s)
+      write(self.quote_type)
+      return
 
     if self.quote_type:
       for part in self.quote_parts:
         part.quote_match_placeholder.matched_text = self.quote_type
 
-    source_list = [self.GetStartParenText()]
-    source_list.append(_GetListDefault(
-        self.quote_parts, 0, None).GetSource(None))
+    write(self.GetStartParenText())
+    _GetListDefault(self.quote_parts, 0, None).WriteSource(None, write)
     for index in xrange(len(self.quote_parts[1:])):
-      source_list.append(_GetListDefault(
+      write(_GetListDefault(
           self.separators, index,
           self.separator_placeholder).GetSource(None))
-      source_list.append(_GetListDefault(
-          self.quote_parts, index+1, None).GetSource(None))
-
-    source_list.append(self.GetEndParenText())
-    return ''.join(source_list)
+      _GetListDefault(
+          self.quote_parts, index+1, None).WriteSource(None, write)
+    write(self.GetEndParenText())
 
 
 def get_Sub_expected_parts():
@@ -1616,6 +2957,8 @@ def get_SyntaxFreeLine_expected_parts():
 class TupleSourceMatcher(DefaultSourceMatcher):
   """Source matcher for _ast.Tuple nodes."""
 
+  __slots__ = ()
+
   def __init__(self, node, starting_parens=None):
     expected_parts = [
         TextPlaceholder(r'\s*', '('),
@@ -1626,11 +2969,25 @@ class TupleSourceMatcher(DefaultSourceMatcher):
     super(TupleSourceMatcher, self).__init__(
         node, expected_parts, starting_parens)
 
-  def Match(self, string):
-    matched_text = super(TupleSourceMatcher, self).Match(string)
-    if not self.paren_wrapped:
-      matched_text = matched_text.rstrip()
-      return super(TupleSourceMatcher, self).Match(matched_text)
+  def MatchAt(self, text, pos):
+    pos = self.MatchStartParens(text, pos)
+    pos = MatchPlaceholderListAt(
+        text, pos, self.node, self.expected_parts[:-1],
+        self.start_paren_matchers)
+    end_placeholder = self.expected_parts[-1]
+    end_placeholder_pos = pos
+    pos = end_placeholder.MatchAt(None, text, pos)
+    pos = self.MatchEndParen(text, pos)
+    if self.paren_wrapped:
+      return pos
+    # Without parens, the tuple ends at its last non-whitespace character, so
+    # the end placeholder is matched again without the whitespace it took.
+    trailing_text = text[end_placeholder_pos:pos]
+    stripped_text = trailing_text.rstrip()
+    if len(stripped_text) == len(trailing_text):
+      return pos
+    return end_placeholder_pos + end_placeholder.MatchAt(
+        None, stripped_text, 0)
 
 
 def get_TryExcept_expected_parts():
@@ -1647,6 +3004,8 @@ def get_TryExcept_expected_parts():
 class TryFinallySourceMatcher(DefaultSourceMatcher):
   """Source matcher for _ast.Tuple nodes."""
 
+  __slots__ = ('optional_try',)
+
   def __init__(self, node, starting_parens=None):
     expected_parts = [
         BodyPlaceholder('body', match_after=True),
@@ -1657,18 +3016,15 @@ class TryFinallySourceMatcher(DefaultSourceMatcher):
         node, expected_parts, starting_parens)
     self.optional_try = TextPlaceholder(r'[ \t]*try:[ \t]*\n', 'try:\n')
 
-  def Match(self, string):
-    remaining_string = string
+  def MatchAt(self, text, pos):
     if not isinstance(self.node.body[0], _ast.TryExcept):
-      remaining_string = MatchPlaceholder(
-          remaining_string, None, self.optional_try)
-    return super(TryFinallySourceMatcher, self).Match(remaining_string)
+      pos = self.optional_try.MatchAt(None, text, pos)
+    return super(TryFinallySourceMatcher, self).MatchAt(text, pos)
 
-  def GetSource(self):
-    source_start = ''
+  def WriteSource(self, write):
     if not isinstance(self.node.body[0], _ast.TryExcept):
-      source_start = self.optional_try.GetSource(None)
-    return source_start + super(TryFinallySourceMatcher, self).GetSource()
+      write(self.optional_try.GetSource(None))
+    super(TryFinallySourceMatcher, self).WriteSource(write)
 
 
 def get_UAdd_expected_parts():
@@ -1703,6 +3059,10 @@ def get_While_expected_parts():
 class WithSourceMatcher(SourceMatcher):
   """Class to generate the source for an _ast.With node."""
 
+  __slots__ = ('with_placeholder', 'context_expr', 'optional_vars',
+               'compound_separator', 'colon_placeholder', 'body_placeholder',
+               'is_compound_with', 'starting_with')
+
   def __init__(self, node, starting_parens=None):
     super(WithSourceMatcher, self).__init__(node, starting_parens)
     self.with_placeholder = TextPlaceholder(r' *(with)? *', 'with ')
@@ -1716,31 +3076,23 @@ class WithSourceMatcher(SourceMatcher):
     self.is_compound_with = False
     self.starting_with = True
 
-  def Match(self, string):
-    if string.lstrip().startswith('with'):
+  def MatchAt(self, text, pos):
+    if text.startswith('with', SkipWhitespace(text, pos)):
       self.starting_with = True
     placeholder_list = [self.with_placeholder,
                         self.context_expr,
                         self.optional_vars]
-    remaining_string = MatchPlaceholderList(
-        string, self.node, placeholder_list)
-    if remaining_string.lstrip().startswith(','):
+    pos = MatchPlaceholderListAt(text, pos, self.node, placeholder_list)
+    if text.startswith(',', SkipWhitespace(text, pos)):
       self.is_compound_with = True
       placeholder_list = [self.compound_separator,
                           self.body_placeholder]
-      remaining_string = MatchPlaceholderList(
-          remaining_string, self.node, placeholder_list)
     else:
       placeholder_list = [self.colon_placeholder,
                           self.body_placeholder]
-      remaining_string = MatchPlaceholderList(
-          remaining_string, self.node, placeholder_list)
+    return MatchPlaceholderListAt(text, pos, self.node, placeholder_list)
 
-    if not remaining_string:
-      return string
-    return string[:len(remaining_string)]
-
-  def GetSource(self):
+  def WriteSource(self, write):
     placeholder_list = []
     if self.starting_with:
       placeholder_list.append(self.with_placeholder)
@@ -1761,8 +3113,8 @@ class WithSourceMatcher(SourceMatcher):
       placeholder_list.append(self.colon_placeholder)
     placeholder_list.append(self.body_placeholder)
 
-    source_list = [p.GetSource(self.node) for p in placeholder_list]
-    return ''.join(source_list)
+    for placeholder in placeholder_list:
+      placeholder.WriteSource(self.node, write)
 
 
 def get_Yield_expected_parts():
@@ -1772,86 +3124,180 @@ def get_Yield_expected_parts():
   ]
 
 
-# A mapping of node_type: expected_parts
-_matchers = {
-    _ast.Add: get_Add_expected_parts,
-    _ast.alias: get_alias_expected_parts,
-    _ast.And: get_And_expected_parts,
-    _ast.Assert: get_Assert_expected_parts,
-    _ast.Assign: get_Assign_expected_parts,
-    _ast.Attribute: get_Attribute_expected_parts,
-    _ast.AugAssign: get_AugAssign_expected_parts,
-    _ast.arguments: get_arguments_expected_parts,
-    _ast.BinOp: get_BinOp_expected_parts,
-    _ast.BitAnd: get_BitAnd_expected_parts,
-    _ast.BitOr: get_BitOr_expected_parts,
-    _ast.BitXor: get_BitXor_expected_parts,
-    _ast.BoolOp: BoolOpSourceMatcher,
-    _ast.Break: get_Break_expected_parts,
-    _ast.Call: get_Call_expected_parts,
-    _ast.ClassDef: get_ClassDef_expected_parts,
-    _ast.Compare: get_Compare_expected_parts,
-    _ast.comprehension: get_comprehension_expected_parts,
-    _ast.Continue: get_Continue_expected_parts,
-    _ast.Delete: get_Delete_expected_parts,
-    _ast.Dict: get_Dict_expected_parts,
-    _ast.DictComp: get_DictComp_expected_parts,
-    _ast.Div: get_Div_expected_parts,
-    _ast.Eq: get_Eq_expected_parts,
-    _ast.Expr: get_Expr_expected_parts,
-    _ast.ExceptHandler: get_ExceptHandler_expected_parts,
-    _ast.FloorDiv: get_FloorDiv_expected_parts,
-    _ast.For: get_For_expected_parts,
-    _ast.FunctionDef: get_FunctionDef_expected_parts,
-    _ast.GeneratorExp: get_GeneratorExp_expected_parts,
-    _ast.Global: get_Global_expected_parts,
-    _ast.Gt: get_Gt_expected_parts,
-    _ast.GtE: get_GtE_expected_parts,
-    _ast.If: IfSourceMatcher,
-    _ast.IfExp: get_IfExp_expected_parts,
-    _ast.Import: get_Import_expected_parts,
-    _ast.ImportFrom: get_ImportFrom_expected_parts,
-    _ast.In: get_In_expected_parts,
-    _ast.Index: get_Index_expected_parts,
-    _ast.Invert: get_Invert_expected_parts,
-    _ast.Is: get_Is_expected_parts,
-    _ast.IsNot: get_IsNot_expected_parts,
-    _ast.keyword: get_keyword_expected_parts,
-    _ast.Lambda: get_Lambda_expected_parts,
-    _ast.List: get_List_expected_parts,
-    _ast.ListComp: get_ListComp_expected_parts,
-    _ast.LShift: get_LShift_expected_parts,
-    _ast.Lt: get_Lt_expected_parts,
-    _ast.LtE: get_LtE_expected_parts,
-    _ast.Mod: get_Mod_expected_parts,
-    _ast.Module: get_Module_expected_parts,
-    _ast.Mult: get_Mult_expected_parts,
-    _ast.Name: get_Name_expected_parts,
-    _ast.Not: get_Not_expected_parts,
-    _ast.NotIn: get_NotIn_expected_parts,
-    _ast.NotEq: get_NotEq_expected_parts,
-    _ast.Num: NumSourceMatcher,
-    _ast.Or: get_Or_expected_parts,
-    _ast.Pass: get_Pass_expected_parts,
-    _ast.Pow: get_Pow_expected_parts,
-    _ast.Print: get_Print_expected_parts,
-    _ast.Raise: get_Raise_expected_parts,
-    _ast.Return: get_Return_expected_parts,
-    _ast.RShift: get_RShift_expected_parts,
-    _ast.Slice: get_Slice_expected_parts,
-    _ast.Sub: get_Sub_expected_parts,
-    _ast.Set: get_Set_expected_parts,
-    _ast.SetComp: get_SetComp_expected_parts,
-    _ast.Subscript: get_Subscript_expected_parts,
-    _ast.Str: StrSourceMatcher,
-    create_node.SyntaxFreeLine: get_SyntaxFreeLine_expected_parts,
-    _ast.Tuple: TupleSourceMatcher,
-    _ast.TryExcept: get_TryExcept_expected_parts,
-    _ast.TryFinally: TryFinallySourceMatcher,
-    _ast.UAdd: get_UAdd_expected_parts,
-    _ast.UnaryOp: get_UnaryOp_expected_parts,
-    _ast.USub: get_USub_expected_parts,
-    _ast.While: get_While_expected_parts,
-    _ast.With: WithSourceMatcher,
-    _ast.Yield: get_Yield_expected_parts,
-}
+def _RegisterMatchers():
+  """Registers the matchers of the node types the library supports.
+
+  Matchers for other node types, or replacing these, are registered with
+  RegisterMatcherClass or RegisterExpectedParts.
+  """
+  # A mapping of node_type: a get_*_expected_parts function, or a
+  # SourceMatcher subclass.
+  matchers = {
+      _ast.Add: get_Add_expected_parts,
+      _ast.alias: get_alias_expected_parts,
+      _ast.And: get_And_expected_parts,
+      _ast.Assert: get_Assert_expected_parts,
+      _ast.Assign: get_Assign_expected_parts,
+      _ast.Attribute: get_Attribute_expected_parts,
+      _ast.AugAssign: get_AugAssign_expected_parts,
+      _ast.arguments: get_arguments_expected_parts,
+      _ast.BinOp: get_BinOp_expected_parts,
+      _ast.BitAnd: get_BitAnd_expected_parts,
+      _ast.BitOr: get_BitOr_expected_parts,
+      _ast.BitXor: get_BitXor_expected_parts,
+      _ast.BoolOp: BoolOpSourceMatcher,
+      _ast.Break: get_Break_expected_parts,
+      _ast.Call: get_Call_expected_parts,
+      _ast.ClassDef: get_ClassDef_expected_parts,
+      _ast.Compare: get_Compare_expected_parts,
+      _ast.comprehension: get_comprehension_expected_parts,
+      _ast.Continue: get_Continue_expected_parts,
+      _ast.Delete: get_Delete_expected_parts,
+      _ast.Dict: get_Dict_expected_parts,
+      _ast.DictComp: get_DictComp_expected_parts,
+      _ast.Div: get_Div_expected_parts,
+      _ast.Eq: get_Eq_expected_parts,
+      _ast.Expr: get_Expr_expected_parts,
+      _ast.ExceptHandler: get_ExceptHandler_expected_parts,
+      _ast.FloorDiv: get_FloorDiv_expected_parts,
+      _ast.For: get_For_expected_parts,
+      _ast.FunctionDef: get_FunctionDef_expected_parts,
+      _ast.GeneratorExp: get_GeneratorExp_expected_parts,
+      _ast.Global: get_Global_expected_parts,
+      _ast.Gt: get_Gt_expected_parts,
+      _ast.GtE: get_GtE_expected_parts,
+      _ast.If: IfSourceMatcher,
+      _ast.IfExp: get_IfExp_expected_parts,
+      _ast.Import: get_Import_expected_parts,
+      _ast.ImportFrom: get_ImportFrom_expected_parts,
+      _ast.In: get_In_expected_parts,
+      _ast.Index: get_Index_expected_parts,
+      _ast.Invert: get_Invert_expected_parts,
+      _ast.Is: get_Is_expected_parts,
+      _ast.IsNot: get_IsNot_expected_parts,
+      _ast.keyword: get_keyword_expected_parts,
+      _ast.Lambda: get_Lambda_expected_parts,
+      _ast.List: get_List_expected_parts,
+      _ast.ListComp: get_ListComp_expected_parts,
+      _ast.LShift: get_LShift_expected_parts,
+      _ast.Lt: get_Lt_expected_parts,
+      _ast.LtE: get_LtE_expected_parts,
+      _ast.Mod: get_Mod_expected_parts,
+      _ast.Module: get_Module_expected_parts,
+      _ast.Mult: get_Mult_expected_parts,
+      _ast.Name: get_Name_expected_parts,
+      _ast.Not: get_Not_expected_parts,
+      _ast.NotIn: get_NotIn_expected_parts,
+      _ast.NotEq: get_NotEq_expected_parts,
+      _ast.Num: NumSourceMatcher,
+      _ast.Or: get_Or_expected_parts,
+      _ast.Pass: get_Pass_expected_parts,
+      _ast.Pow: get_Pow_expected_parts,
+      _ast.Print: get_Print_expected_parts,
+      _ast.Raise: get_Raise_expected_parts,
+      _ast.Return: get_Return_expected_parts,
+      _ast.RShift: get_RShift_expected_parts,
+      _ast.Slice: get_Slice_expected_parts,
+      _ast.Sub: get_Sub_expected_parts,
+      _ast.Set: get_Set_expected_parts,
+      _ast.SetComp: get_SetComp_expected_parts,
+      _ast.Subscript: get_Subscript_expected_parts,
+      _ast.Str: StrSourceMatcher,
+      create_node.SyntaxFreeLine: get_SyntaxFreeLine_expected_parts,
+      _ast.Tuple: TupleSourceMatcher,
+      _ast.TryExcept: get_TryExcept_expected_parts,
+      _ast.TryFinally: TryFinallySourceMatcher,
+      _ast.UAdd: get_UAdd_expected_parts,
+      _ast.UnaryOp: get_UnaryOp_expected_parts,
+      _ast.USub: get_USub_expected_parts,
+      _ast.While: get_While_expected_parts,
+      _ast.With: WithSourceMatcher,
+      _ast.Yield: get_Yield_expected_parts,
+  }
+  for node_type, parts_or_matcher in matchers.iteritems():
+    if isinstance(parts_or_matcher, type):
+      RegisterMatcherClass(node_type, parts_or_matcher)
+    else:
+      RegisterExpectedParts(node_type, parts_or_matcher)
+
+
+_RegisterMatchers()
+
+
+def _FindPythonFiles(paths):
+  """Yields the paths of files, and of .py files in directories, lazily."""
+  for path in paths:
+    if not os.path.isdir(path):
+      yield path
+      continue
+    for dirpath, dirnames, filenames in os.walk(path):
+      dirnames.sort()
+      for filename in sorted(filenames):
+        if filename.endswith('.py'):
+          yield os.path.join(dirpath, filename)
+
+
+def _GetLinesPerSecond(num_lines, seconds):
+  return num_lines / seconds if seconds else 0.0
+
+
+def Verify(paths, processes=None, verbose=False, out=None):
+  """Checks that the source of files round trips through GetSource.
+
+  Args:
+    paths: {[str]} Files, and directories to look for .py files in.
+    processes: {int} The number of worker processes, or None for one per CPU.
+    verbose: {bool} Whether to report files that round trip, too.
+    out: {file} Where to write the report. Defaults to sys.stdout.
+
+  Returns:
+    The number of files that didn't round trip.
+  """
+  out = out or sys.stdout
+  num_files = num_failed = num_lines = 0
+  start_time = time.time()
+  for result in AnnotateFiles(_FindPythonFiles(paths), processes):
+    num_files += 1
+    num_lines += result.num_lines
+    if result.error:
+      status = 'ERROR'
+    elif not result.round_trip_ok:
+      status = 'MISMATCH'
+    else:
+      status = 'OK'
+    if status != 'OK':
+      num_failed += 1
+    if status != 'OK' or verbose:
+      out.write('{} {} ({} lines, {:.3f}s, {:.0f} lines/s)\n'.format(
+          status, result.path, result.num_lines, result.seconds,
+          _GetLinesPerSecond(result.num_lines, result.seconds)))
+      if result.error:
+        out.write('  {}\n'.format(result.error))
+  seconds = time.time() - start_time
+  out.write('{} files, {} failed, {} lines in {:.1f}s ({:.0f} lines/s)\n'
+            .format(num_files, num_failed, num_lines, seconds,
+                    _GetLinesPerSecond(num_lines, seconds)))
+  return num_failed
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(prog='python -m source_match')
+  subparsers = parser.add_subparsers(dest='command')
+  verify_parser = subparsers.add_parser(
+      'verify', help='Check that files round trip through GetSource.')
+  verify_parser.add_argument(
+      'paths', nargs='+', metavar='path',
+      help='A file, or a directory to check the .py files in.')
+  verify_parser.add_argument(
+      '-j', '--jobs', type=int, default=None,
+      help='The number of worker processes. Defaults to one per CPU.')
+  verify_parser.add_argument(
+      '-v', '--verbose', action='store_true',
+      help='Report files that round trip, too.')
+  args = parser.parse_args(argv)
+  num_failed = Verify(args.paths, processes=args.jobs, verbose=args.verbose)
+  return 1 if num_failed else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
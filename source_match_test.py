@@ -16,6 +16,14 @@ limitations under the License.
 Tests for source_match.py
 """
 
+import _ast
+import ast
+import cPickle
+import cStringIO
+import os
+import shutil
+import sys
+import tempfile
 import unittest
 
 import create_node
@@ -50,6 +58,25 @@ class TextPlaceholderTest(unittest.TestCase):
     with self.assertRaises(source_match.BadlySpecifiedTemplateError):
       placeholder.Match(None, 'to match')
 
+  def testErrorMessageIsTruncated(self):
+    placeholder = source_match.TextPlaceholder('doesnt match', DEFAULT_TEXT)
+    text = 'a = 1\nto match' + 'x' * 1000
+    with self.assertRaises(source_match.BadlySpecifiedTemplateError) as cm:
+      placeholder.MatchAt(None, text, 6)
+    self.assertIs(text, cm.exception.text)
+    self.assertEqual(6, cm.exception.pos)
+    self.assertIs(placeholder, cm.exception.placeholder)
+    message = str(cm.exception)
+    self.assertIn('At line 2, column 0: "to match', message)
+    self.assertLess(len(message), 500)
+
+  def testTryMatchAt(self):
+    placeholder = source_match.TextPlaceholder(r'\s*\)', DEFAULT_TEXT)
+    self.assertEqual(-1, placeholder.TryMatchAt(None, 'a )', 0))
+    self.assertEqual(DEFAULT_TEXT, placeholder.GetSource(None))
+    self.assertEqual(3, placeholder.TryMatchAt(None, 'a )', 1))
+    self.assertEqual(' )', placeholder.GetSource(None))
+
   def testMatchWhitespace(self):
     whitespace_text = '  \t \n  '
     placeholder = source_match.TextPlaceholder(r'\s*')
@@ -90,6 +117,21 @@ class TextPlaceholderTest(unittest.TestCase):
     test_output = placeholder.GetSource(None)
     self.assertEqual(test_output, whitespace_text)
 
+  def testCopySharesCompiledRegex(self):
+    placeholder = source_match.TextPlaceholder(r'\s*,\s*', ', ')
+    copy = placeholder.Copy()
+    self.assertEqual(copy.original_regex, placeholder.original_regex)
+    self.assertIs(copy.pattern, placeholder.pattern)
+    self.assertEqual(copy.Match(None, ' ,  # comment\n b'), ' ,  # comment\n ')
+
+  def testRegexCacheCountsHitsAndMisses(self):
+    source_match.ClearRegexCache()
+    source_match.TextPlaceholder(r'\s*;\s*', ';')
+    source_match.TextPlaceholder(r'\s*;\s*', '; ')
+    source_match.TextPlaceholder(r'\s*:\s*', ':')
+    self.assertEqual(source_match.GetRegexCacheInfo(),
+                     source_match.RegexCacheInfo(hits=1, misses=2, size=2))
+
 
 class FieldPlaceholderTest(unittest.TestCase):
 
@@ -395,6 +437,823 @@ class TestGetMatcher(unittest.TestCase):
     node.attr = 'hello'
     self.assertEqual(matcher.GetSource(), 'foo.hello')
 
+  def testMatcherClass(self):
+    matcher = source_match.GetMatcher(create_node.Str('a'))
+    self.assertIsInstance(matcher, source_match.StrSourceMatcher)
+
+  def testSubclassOfRegisteredType(self):
+    class CommentLine(create_node.SyntaxFreeLine):
+      pass
+    node = CommentLine(comment='hello')
+    matcher = source_match.GetMatcher(node)
+    self.assertEqual(matcher.GetSource(), '# hello\n')
+
+  def testUnregisteredType(self):
+    class Unregistered(_ast.AST):
+      pass
+    with self.assertRaises(KeyError):
+      source_match.GetMatcher(Unregistered())
+
+  def testRegisterExpectedParts(self):
+    class Ellipsis(_ast.AST):
+      _fields = ()
+    class Base(_ast.AST):
+      _fields = ()
+    class Derived(Base):
+      _fields = ()
+    source_match.RegisterExpectedParts(
+        Ellipsis, lambda: [source_match.TextPlaceholder(r'\.\.\.', '...')])
+    source_match.RegisterExpectedParts(
+        Base, lambda: [source_match.TextPlaceholder(r'base', 'base')])
+    self.assertEqual('...', source_match.GetSource(Ellipsis(), '...'))
+    self.assertEqual('base', source_match.GetSource(Derived(), 'base'))
+    source_match.RegisterExpectedParts(
+        Derived, lambda: [source_match.TextPlaceholder(r'derived', 'derived')])
+    self.assertEqual('derived', source_match.GetSource(Derived()))
+
+  def testRegisterMatcherClass(self):
+    class Custom(_ast.AST):
+      _fields = ()
+    class CustomSourceMatcher(source_match.SourceMatcher):
+
+      def MatchAt(self, text, pos):
+        raise TypeError('Raised while matching')
+
+      def GetSource(self):
+        return 'custom'
+    source_match.RegisterMatcherClass(Custom, CustomSourceMatcher)
+    self.assertEqual('custom', source_match.GetSource(Custom()))
+    with self.assertRaises(TypeError):
+      source_match.GetSource(Custom(), 'custom')
+
+  def testRegisterMatcherClassThatIsntOne(self):
+    with self.assertRaises(ValueError):
+      source_match.RegisterMatcherClass(
+          _ast.AST, source_match.get_Add_expected_parts)
+
+
+class BadlySpecifiedTemplateErrorTest(unittest.TestCase):
+
+  def testRecordsMatchers(self):
+    module_node = ast.parse('def f():\n  return a + b\n')
+    with self.assertRaises(source_match.BadlySpecifiedTemplateError) as cm:
+      source_match.GetSource(module_node, 'def f():\n  return a + c\n')
+    error = cm.exception
+    self.assertEqual(
+        [_ast.Name, _ast.BinOp, _ast.Return, _ast.FunctionDef, _ast.Module],
+        [type(matcher.node) for matcher, _ in error.matchers])
+    self.assertEqual(22, error.pos)
+    self.assertEqual(
+        'Text should have started with "b"\n'
+        'At line 2, column 13: "c\n"\n'
+        'While matching Name from offset 22\n'
+        'While matching BinOp from offset 18\n'
+        'While matching Return from offset 9\n'
+        'While matching FunctionDef from offset 0\n'
+        'While matching Module from offset 0',
+        str(error))
+
+  def testRepr(self):
+    error = source_match.BadlySpecifiedTemplateError('Bad', 'abc', 1)
+    self.assertEqual(
+        'BadlySpecifiedTemplateError(\'Bad\\nAt line 1, column 1: "bc"\')',
+        repr(error))
+
+
+class ExpectedPartsTemplateTest(unittest.TestCase):
+
+  def testInstantiateDoesntShareMatchedState(self):
+    template = source_match.ExpectedPartsTemplate(
+        source_match.get_Attribute_expected_parts)
+    first_parts = template.Instantiate()
+    second_parts = template.Instantiate()
+    first_parts[1].Match(None, ' . ')
+    self.assertEqual(first_parts[1].GetSource(None), ' . ')
+    self.assertEqual(second_parts[1].GetSource(None), '.')
+    self.assertIsNone(template.parts[1].matched_text)
+
+  def testInstantiateSharesSeparatorPrototypes(self):
+    template = source_match.ExpectedPartsTemplate(
+        source_match.get_List_expected_parts)
+    first_elts, second_elts = (
+        template.Instantiate()[1], template.Instantiate()[1])
+    self.assertIsNot(first_elts, second_elts)
+    self.assertIs(first_elts.before_placeholder,
+                  second_elts.before_placeholder)
+
+  def testMatchersFromTemplateAreIndependent(self):
+    first_node = create_node.List('a', 'b')
+    second_node = create_node.List('a', 'b')
+    first_matcher = source_match.GetMatcher(first_node)
+    first_matcher.Match('[ a ,  b]')
+    second_matcher = source_match.GetMatcher(second_node)
+    self.assertEqual('[ a ,  b]', first_matcher.GetSource())
+    self.assertEqual('[a, b]', second_matcher.GetSource())
+
+
+class MatchAtTest(unittest.TestCase):
+
+  def testTextPlaceholderMatchesAtOffset(self):
+    placeholder = source_match.TextPlaceholder(r'def ', DEFAULT_TEXT)
+    end = placeholder.MatchAt(None, 'xx def foo', 3)
+    self.assertEqual(end, 7)
+    self.assertEqual(placeholder.GetSource(None), 'def ')
+
+  def testTextPlaceholderDoesntMatchBeforeOffset(self):
+    placeholder = source_match.TextPlaceholder(r'def ', DEFAULT_TEXT)
+    with self.assertRaises(source_match.BadlySpecifiedTemplateError):
+      placeholder.MatchAt(None, 'def foo', 1)
+
+  def testMatcherMatchesAtOffset(self):
+    node = create_node.VarReference('foo', 'bar')
+    matcher = source_match.GetMatcher(node)
+    text = 'a = foo.bar\n'
+    self.assertEqual(matcher.MatchAt(text, 4), 11)
+    self.assertEqual(matcher.GetSource(), 'foo.bar')
+
+  def testMatcherEndIncludesParens(self):
+    node = create_node.Name('a')
+    matcher = source_match.GetMatcher(node)
+    text = 'b((a))\n'
+    self.assertEqual(matcher.MatchAt(text, 1), 6)
+    self.assertEqual(matcher.GetSource(), '((a))')
+
+  def testMatchFieldAtString(self):
+    self.assertEqual(source_match.MatchFieldAt('bar', 'foo(bar)', 3), 7)
+
+  def testMatchReturnsMatchedText(self):
+    node = create_node.If(create_node.Name('a'))
+    matcher = source_match.GetMatcher(node)
+    matched_text = matcher.Match('if a:\n  pass\nb\n')
+    self.assertEqual(matched_text, 'if a:\n  pass\n')
+
+  def testElifMatchesAtOffset(self):
+    string = 'x\nif a:\n  pass\nelif b:\n  pass\nelse:\n  pass\ny\n'
+    module_node = create_node.Module(
+        create_node.Expr(create_node.Name('x')),
+        create_node.If(
+            create_node.Name('a'),
+            orelse=[create_node.If(create_node.Name('b'),
+                                   orelse=[create_node.Pass()])]),
+        create_node.Expr(create_node.Name('y')))
+    source_match.GetSource(module_node, string)
+    self.assertEqual(string, module_node.matcher.GetSource())
+
+
+class SourceBufferTest(unittest.TestCase):
+
+  def testShortMatchIsCopied(self):
+    text = source_match.SourceBuffer('a = 1\n')
+    self.assertEqual(source_match.GetMatchedText(text, 1, 4), ' = ')
+
+  def testLongMatchIsSpan(self):
+    text = source_match.SourceBuffer('a' * 200)
+    span = source_match.GetMatchedText(text, 10, 110)
+    self.assertIsInstance(span, source_match.SourceSpan)
+    self.assertIs(span.buffer, text)
+    self.assertEqual(span.GetText(), 'a' * 100)
+
+  def testLongMatchInStrIsCopied(self):
+    text = 'a' * 200
+    self.assertEqual(source_match.GetMatchedText(text, 10, 110), 'a' * 100)
+
+  def testTextPlaceholderMaterializesSpan(self):
+    text = source_match.SourceBuffer('x' + 'a' * 100 + 'x')
+    placeholder = source_match.TextPlaceholder('a*', DEFAULT_TEXT)
+    self.assertEqual(placeholder.MatchAt(None, text, 1), 101)
+    self.assertEqual(placeholder.matched_text, 'a' * 100)
+    self.assertEqual(placeholder.GetSource(None), 'a' * 100)
+
+  def testModuleRoundTrip(self):
+    string = ('"""' + 'Long docstring. ' * 10 + '"""\n'
+              'a = (1 +  # ' + 'long comment ' * 10 + '\n'
+              '     2)\n')
+    text = source_match.SourceBuffer(string)
+    module_node = ast.parse(string)
+    self.assertEqual(string, source_match.GetSource(module_node, text))
+    self.assertIs(module_node.source_buffer, text)
+    docstring_node = module_node.body[0].value
+    inner_text_placeholder = (
+        docstring_node.matcher.quote_parts[0].inner_text_placeholder)
+    self.assertEqual(inner_text_placeholder.matched_text,
+                     'Long docstring. ' * 10)
+
+
+class MappedTextTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.string = ('"""' + 'Long docstring. ' * 10 + '"""\n'
+                   'a = (1 +  # ' + 'long comment ' * 10 + '\n'
+                   '     2)\n')
+    self.path = os.path.join(self.directory, 'module.py')
+    with open(self.path, 'w') as module_file:
+      module_file.write(self.string)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def testModuleRoundTrip(self):
+    text = source_match.MappedText(self.path)
+    module_node = ast.parse(text)
+    self.assertEqual(self.string, source_match.GetSource(module_node, text))
+    self.assertIs(module_node.source_buffer, text)
+    docstring_node = module_node.body[0].value
+    inner_text_placeholder = (
+        docstring_node.matcher.quote_parts[0].inner_text_placeholder)
+    self.assertIs(text, inner_text_placeholder._matched_text.buffer)
+    self.assertEqual(inner_text_placeholder.matched_text,
+                     'Long docstring. ' * 10)
+
+  def testStrMethods(self):
+    text = source_match.MappedText(self.path)
+    self.assertEqual(len(self.string), len(text))
+    pos = self.string.index('a = ')
+    self.assertTrue(text.startswith('a = ', pos))
+    self.assertFalse(text.startswith('a = ', pos - 1))
+    self.assertEqual(self.string.index('\n', 10), text.index('\n', 10))
+    with self.assertRaises(ValueError):
+      text.index('b')
+    self.assertEqual(self.string.count('\n', 100), text.count('\n', 100))
+    self.assertEqual(self.string.rfind('\n', 0, 200),
+                     text.rfind('\n', 0, 200))
+
+  def testPicklesAsSourceBuffer(self):
+    text = source_match.MappedText(self.path)
+    unpickled_text = cPickle.loads(cPickle.dumps(text, 2))
+    self.assertIsInstance(unpickled_text, source_match.SourceBuffer)
+    self.assertEqual(self.string, unpickled_text)
+
+  def testEmptyFile(self):
+    with open(self.path, 'w'):
+      pass
+    with self.assertRaises(ValueError):
+      source_match.MappedText(self.path)
+
+
+class TokenizedTextTest(unittest.TestCase):
+
+  def testSkipTrivia(self):
+    text = source_match.TokenizedText('a = (1,  # c\n     \\\n  22)\n')
+    self.assertEqual(text.SkipTrivia(7), text.index('22'))
+    self.assertEqual(text.SkipTrivia(text.index('22') + 1),
+                     text.index('22') + 1)
+    self.assertEqual(text.SkipTrivia(text.index(')') + 1), len(text))
+
+  def testTokenParts(self):
+    self.assertEqual(
+        3, len(source_match._GetTokenParts(r'\s*,?\s*\)')))
+    self.assertIsNone(source_match._GetTokenParts(r'[ \t]*yield[ \t]*'))
+    self.assertIsNone(source_match._GetTokenParts(r':\n?'))
+    self.assertIsNone(source_match._GetTokenParts(r'(\s*\(|\s*)'))
+
+  def testTextPlaceholder(self):
+    text = source_match.TokenizedText('f(a  # c\n  )\n')
+    placeholder = source_match.TextPlaceholder(r'\s*\)', ')')
+    self.assertEqual(placeholder.MatchAt(None, text, 3), text.index(')') + 1)
+    self.assertEqual(placeholder.matched_text, '  # c\n  )')
+    with self.assertRaises(source_match.BadlySpecifiedTemplateError):
+      placeholder.MatchAt(None, text, 1)
+
+  def testModuleRoundTrip(self):
+    string = ('@decorator  # c\n'
+              'def f(a, b=1,\n'
+              '      *args):  # c\n'
+              '  x = [a, \\\n'
+              '       b]  ;  y = {a: b}\n'
+              '  return (x)\n')
+    module_node = ast.parse(string)
+    self.assertEqual(string, source_match.GetSource(
+        module_node, source_match.TokenizedText(string)))
+
+  def testCommentOfHashes(self):
+    string = 'x = (a\n     #' + '#' * 40 + '\n     or b)\n'
+    module_node = ast.parse(string)
+    self.assertEqual(string, source_match.GetSource(
+        module_node, source_match.TokenizedText(string)))
+
+
+class SourceCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.string = 'def f(a):\n  return a\n\ndef g(b):\n  return b + 1\n'
+    self.module_node = ast.parse(self.string)
+    source_match.GetSource(self.module_node, self.string)
+    self.cache = source_match.SourceCache(self.module_node)
+
+  def testGetSource(self):
+    self.assertEqual(self.string, self.cache.GetSource())
+    self.assertEqual(self.string, self.cache.GetSource())
+
+  def testUnmarkedChangeIsNotSeen(self):
+    self.cache.GetSource()
+    self.module_node.body[0].name = 'h'
+    self.assertEqual(self.string, self.cache.GetSource())
+
+  def testMarkedChangePropagatesToParents(self):
+    self.cache.GetSource()
+    name_node = self.module_node.body[2].body[0].value.left
+    name_node.id = 'c'
+    self.cache.MarkChanged(name_node)
+    self.assertEqual('def f(a):\n  return a\n\ndef g(b):\n  return c + 1\n',
+                     self.cache.GetSource())
+
+  def testReplacedChild(self):
+    self.cache.GetSource()
+    return_node = self.module_node.body[0].body[0]
+    return_node.value = create_node.Num(2)
+    self.cache.MarkChanged(return_node)
+    self.assertEqual('def f(a):\n  return 2\n\ndef g(b):\n  return b + 1\n',
+                     self.cache.GetSource())
+    return_node.value.n = 3
+    self.cache.MarkChanged(return_node.value)
+    self.assertEqual('def f(a):\n  return 3\n\ndef g(b):\n  return b + 1\n',
+                     self.cache.GetSource())
+
+  def testWriteSource(self):
+    self.cache.GetSource()
+    self.module_node.body[0].name = 'h'
+    self.cache.MarkChanged(self.module_node.body[0])
+    output = cStringIO.StringIO()
+    source_match.WriteSource(self.module_node, output)
+    self.assertEqual(self.cache.GetSource(), output.getvalue())
+    self.assertEqual('def h(a):', output.getvalue()[:9])
+
+
+class WriteSourceTest(unittest.TestCase):
+
+  def _WriteSource(self, field, **kwargs):
+    output = cStringIO.StringIO()
+    source_match.WriteSource(field, output, **kwargs)
+    return output.getvalue()
+
+  def testMatchesGetSource(self):
+    string = ('"""Doc."""\n'
+              '\n'
+              'if (a and\n'
+              '    b):  # comment\n'
+              '  c = ("d"\n'
+              '       r\'e\')\n'
+              'elif f:\n'
+              '  pass\n'
+              'elif (g):\n'
+              '  pass\n'
+              'else:\n'
+              '  try:\n'
+              '    with h as i, j:\n'
+              '      pass\n'
+              '  finally:\n'
+              '    pass\n')
+    module_node = ast.parse(string)
+    self.assertEqual(string, self._WriteSource(module_node, text=string))
+    self.assertEqual(string, self._WriteSource(module_node))
+    self.assertEqual(string, module_node.matcher.GetSource())
+
+  def testChangedNodes(self):
+    string = 'if a:\n  pass\nelif b:\n  c = "d"\n'
+    module_node = ast.parse(string)
+    source_match.GetSource(module_node, string)
+    module_node.body[0].orelse[0].test = create_node.Name('e')
+    module_node.body[0].orelse[0].body[0].value.s = 'f'
+    self.assertEqual('if a:\n  pass\nelif e:\n  c = "f"\n',
+                     self._WriteSource(module_node))
+
+  def testFieldsWithoutMatchers(self):
+    self.assertEqual('a', self._WriteSource('a'))
+    self.assertEqual('1', self._WriteSource(1))
+    self.assertEqual('', self._WriteSource(None))
+    self.assertEqual('a + 1', self._WriteSource(
+        create_node.BinOp(create_node.Name('a'), _ast.Add(),
+                          create_node.Num(1))))
+
+  def testWritesToFile(self):
+    string = 'a = (1 +\n     2)\n'
+    path = os.path.join(tempfile.mkdtemp(), 'output.py')
+    try:
+      with open(path, 'w') as output:
+        source_match.WriteSource(ast.parse(string), output, text=string)
+      with open(path) as output:
+        self.assertEqual(string, output.read())
+    finally:
+      shutil.rmtree(os.path.dirname(path))
+
+
+class ApplyTextEditTest(unittest.TestCase):
+
+  def _Match(self, string):
+    module_node = ast.parse(string)
+    source_match.GetSource(module_node, string)
+    return module_node
+
+  def _Edit(self, module_node, old, new, source_cache=None):
+    string = module_node.matcher.GetSource()
+    start = string.index(old)
+    return source_match.ApplyTextEdit(
+        module_node, start, start + len(old), new, source_cache)
+
+  def testEditInStatement(self):
+    module_node = self._Match('a = 1\n\ndef f():\n  return 2\n')
+    assign_node = module_node.body[0]
+    new_nodes = self._Edit(module_node, '2', '3')
+    self.assertEqual('a = 1\n\ndef f():\n  return 3\n',
+                     module_node.matcher.GetSource())
+    self.assertEqual(1, len(new_nodes))
+    self.assertIs(new_nodes[0], module_node.body[2])
+    self.assertEqual(3, module_node.body[2].body[0].value.n)
+    self.assertEqual(4, module_node.body[2].body[0].lineno)
+    self.assertIs(assign_node, module_node.body[0])
+
+  def testInsertStatement(self):
+    module_node = self._Match('a = 1\nb = 2\n')
+    self._Edit(module_node, 'b', 'c = 3\nb')
+    self.assertEqual('a = 1\nc = 3\nb = 2\n', module_node.matcher.GetSource())
+    self.assertEqual(['a', 'c', 'b'],
+                     [node.targets[0].id for node in module_node.body])
+
+  def testDeleteStatementKeepingLine(self):
+    module_node = self._Match('a = 1\nb = 2\nc = 3\n')
+    self._Edit(module_node, 'b = 2', '')
+    self.assertEqual('a = 1\n\nc = 3\n', module_node.matcher.GetSource())
+    self.assertIsInstance(module_node.body[1], create_node.SyntaxFreeLine)
+
+  def testIndentIntoPreviousStatement(self):
+    module_node = self._Match('def f():\n  pass\nx = 1\n')
+    self._Edit(module_node, 'x', '  x')
+    self.assertEqual('def f():\n  pass\n  x = 1\n',
+                     module_node.matcher.GetSource())
+    self.assertEqual(1, len(module_node.body))
+    self.assertEqual(2, len(module_node.body[0].body))
+
+  def testJoinWithNextStatement(self):
+    module_node = self._Match('x = 1\n-y\n')
+    self._Edit(module_node, '1\n', '1 \\\n')
+    self.assertEqual('x = 1 \\\n-y\n', module_node.matcher.GetSource())
+    self.assertEqual(1, len(module_node.body))
+    self.assertIsInstance(module_node.body[0].value, ast.BinOp)
+
+  def testEditThatDoesntParse(self):
+    string = 'x = 1\ny = 2\n'
+    module_node = self._Match(string)
+    with self.assertRaises(SyntaxError):
+      self._Edit(module_node, '\ny', ' + y')
+    self.assertEqual(string, module_node.matcher.GetSource())
+
+  def testFutureImportsApply(self):
+    module_node = self._Match(
+        'from __future__ import print_function\nprint(1, end="")\n')
+    self._Edit(module_node, '1', '2')
+    self.assertEqual(
+        'from __future__ import print_function\nprint(2, end="")\n',
+        module_node.matcher.GetSource())
+    self.assertIsInstance(module_node.body[1].value, ast.Call)
+
+  def testRangeOutsideSource(self):
+    module_node = self._Match('a = 1\n')
+    with self.assertRaises(ValueError):
+      source_match.ApplyTextEdit(module_node, 3, 7, '')
+
+  def testSourceCacheIsUpdated(self):
+    module_node = self._Match('a = 1\nb = [2]\n')
+    cache = source_match.SourceCache(module_node)
+    cache.GetSource()
+    new_nodes = self._Edit(module_node, ']', ', 3]', cache)
+    self.assertEqual('a = 1\nb = [2, 3]\n', cache.GetSource())
+    num_node = new_nodes[0].value.elts[1]
+    num_node.n = 4
+    cache.MarkChanged(num_node)
+    self.assertEqual('a = 1\nb = [2, 4]\n', cache.GetSource())
+
+  def testSourceCacheIsUpdatedWhenMatchingEverything(self):
+    module_node = self._Match('def f():\n  pass\nx = 1\n')
+    cache = source_match.SourceCache(module_node)
+    cache.GetSource()
+    self._Edit(module_node, 'x', '  x', cache)
+    self.assertEqual('def f():\n  pass\n  x = 1\n', cache.GetSource())
+    name_node = module_node.body[0].body[1].targets[0]
+    name_node.id = 'y'
+    cache.MarkChanged(name_node)
+    self.assertEqual('def f():\n  pass\n  y = 1\n', cache.GetSource())
+
+
+class LazyMatchTest(unittest.TestCase):
+
+  def setUp(self):
+    self.string = ('"""Doc\n'
+                   'string."""\n'
+                   'a = 1; b = 2\n'
+                   '\n'
+                   '@dec\n'
+                   'def f():\n'
+                   '  return a\n'
+                   '# comment\n'
+                   'if a:\n'
+                   '  pass\n'
+                   'else:\n'
+                   '  pass\n')
+    self.module_node = ast.parse(self.string)
+
+  def testSourceIsText(self):
+    self.assertEqual(self.string, source_match.GetSource(
+        self.module_node, self.string, lazy=True))
+    for node in self.module_node.body:
+      self.assertIsInstance(node.matcher, source_match.LazyStatementMatcher)
+    self.assertFalse(hasattr(self.module_node.body[1].value, 'matcher'))
+    self.assertEqual(self.string, self.module_node.matcher.GetSource())
+
+  def testGetSourceOfStatement(self):
+    string = 'x = 1; y = 2\n# c\nz = 3\n'
+    module_node = ast.parse(string)
+    source_match.GetSource(module_node, string, lazy=True)
+    x_node, y_node, z_node = module_node.body
+    self.assertEqual('x = 1;', source_match.GetSource(x_node))
+    self.assertEqual(' y = 2\n', source_match.GetSource(y_node))
+    self.assertIsInstance(y_node.matcher, source_match.DefaultSourceMatcher)
+    self.assertIsInstance(z_node.matcher, source_match.LazyStatementMatcher)
+    self.assertIsInstance(module_node.body[2], create_node.SyntaxFreeLine)
+    self.assertEqual(string, module_node.matcher.GetSource())
+
+  def testWriteSourceOfStatement(self):
+    source_match.GetSource(self.module_node, self.string, lazy=True)
+    output = cStringIO.StringIO()
+    source_match.WriteSource(self.module_node.body[2], output)
+    self.assertEqual(' b = 2\n', output.getvalue())
+
+  def testChangedStatementIsNotWritten(self):
+    string = 'x = 1; y = 2\n# c\nz = 3\n'
+    module_node = ast.parse(string)
+    source_match.GetSource(module_node, string, lazy=True)
+    z_node = module_node.body[2]
+    name_node = z_node.targets[0]
+    z_node.targets[0] = ast.Name('w', ast.Store())
+    with self.assertRaises(source_match.Error):
+      module_node.matcher.GetSource()
+    with self.assertRaises(source_match.Error):
+      source_match.MatchLazyStatement(z_node)
+    z_node.targets.append(name_node)
+    with self.assertRaises(source_match.Error):
+      module_node.matcher.GetSource()
+    z_node.targets = [name_node]
+    source_match.MatchLazyStatement(z_node)
+    module_node.body[2].targets[0].id = 'w'
+    self.assertEqual('x = 1; y = 2\n# c\nw = 3\n',
+                     module_node.matcher.GetSource())
+
+  def testDeepStatement(self):
+    string = 'x = ' + ' + '.join(['a'] * 3000) + '\ny = 1\n'
+    module_node = ast.parse(string)
+    self.assertEqual(string, source_match.GetSource(
+        module_node, string, lazy=True))
+    source_match.MatchLazyStatement(module_node.body[1])
+    self.assertEqual(string, module_node.matcher.GetSource())
+
+  def testMovedStatementIsNotWritten(self):
+    source_match.GetSource(self.module_node, self.string, lazy=True)
+    del self.module_node.body[1]
+    with self.assertRaises(source_match.Error):
+      self.module_node.matcher.GetSource()
+
+  def testRemovedGroup(self):
+    source_match.GetSource(self.module_node, self.string, lazy=True)
+    del self.module_node.body[1:3]
+    self.assertEqual(self.string.replace('a = 1; b = 2\n\n', ''),
+                     self.module_node.matcher.GetSource())
+
+  def testMatchLazyStatement(self):
+    source_match.GetSource(self.module_node, self.string, lazy=True)
+    function_node = self.module_node.body[3]
+    source_match.MatchLazyStatement(function_node)
+    self.assertIsInstance(
+        self.module_node.body[4], create_node.SyntaxFreeLine)
+    function_node.body[0].value.id = 'b'
+    self.assertEqual(self.string.replace('return a', 'return b'),
+                     self.module_node.matcher.GetSource())
+    self.assertIsInstance(self.module_node.body[5].matcher,
+                          source_match.LazyStatementMatcher)
+
+  def testMatchingEveryStatementIsLikeGetSource(self):
+    source_match.GetSource(self.module_node, self.string, lazy=True)
+    for node in list(self.module_node.body):
+      source_match.MatchLazyStatement(node)
+    eager_module_node = ast.parse(self.string)
+    source_match.GetSource(eager_module_node, self.string)
+    self.assertEqual(
+        [type(node) for node in eager_module_node.body],
+        [type(node) for node in self.module_node.body])
+    self.assertEqual(self.string, self.module_node.matcher.GetSource())
+    self.assertEqual('a = 1;', source_match.GetSource(
+        self.module_node.body[1]))
+
+  def testStatementsOnOneLineAreMatchedTogether(self):
+    source_match.GetSource(self.module_node, self.string, lazy=True)
+    assign_node = self.module_node.body[2]
+    source_match.MatchLazyStatement(assign_node)
+    self.assertIsInstance(self.module_node.body[1].matcher,
+                          source_match.DefaultSourceMatcher)
+    self.assertEqual(' b = 2\n', source_match.GetSource(assign_node))
+
+  def testSourceCacheIsUpdated(self):
+    source_match.GetSource(self.module_node, self.string, lazy=True)
+    cache = source_match.SourceCache(self.module_node)
+    self.assertEqual(self.string, cache.GetSource())
+    function_node = self.module_node.body[3]
+    source_match.MatchLazyStatement(function_node, cache)
+    function_node.name = 'g'
+    cache.MarkChanged(function_node)
+    self.assertEqual(self.string.replace('def f', 'def g'), cache.GetSource())
+
+  def testApplyTextEdit(self):
+    source_match.GetSource(self.module_node, self.string, lazy=True)
+    string = self.module_node.matcher.GetSource()
+    start = string.index('return a')
+    new_nodes = source_match.ApplyTextEdit(
+        self.module_node, start, start + len('return a'), 'return 3')
+    self.assertEqual(self.string.replace('return a', 'return 3'),
+                     self.module_node.matcher.GetSource())
+    self.assertIsInstance(new_nodes[0], ast.FunctionDef)
+    self.assertIsInstance(self.module_node.body[0].matcher,
+                          source_match.LazyStatementMatcher)
+
+  def testMappedText(self):
+    path = os.path.join(tempfile.mkdtemp(), 'module.py')
+    try:
+      with open(path, 'w') as module_file:
+        module_file.write(self.string)
+      text = source_match.MappedText(path)
+      module_node = ast.parse(text)
+      source_match.GetSource(module_node, text, lazy=True)
+      source_match.MatchLazyStatement(module_node.body[3])
+      self.assertEqual(self.string, module_node.matcher.GetSource())
+    finally:
+      shutil.rmtree(os.path.dirname(path))
+
+  def testOnlyModulesWithText(self):
+    with self.assertRaises(ValueError):
+      source_match.GetSource(self.module_node, lazy=True)
+    with self.assertRaises(ValueError):
+      source_match.GetSource(self.module_node.body[1], 'a = 1;', lazy=True)
+
+
+class AnnotateFilesTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.paths = []
+    for name, text in (('a.py', 'def f(a,  b):\n  return a  # c\n'),
+                       ('b.py', 'x = [1,\n     2]\n'),
+                       ('c.py', 'def f(:\n')):
+      path = os.path.join(self.directory, name)
+      with open(path, 'w') as source_file:
+        source_file.write(text)
+      self.paths.append(path)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def _CheckResults(self, results):
+    results = sorted(results)
+    self.assertEqual(self.paths, [result.path for result in results])
+    self.assertEqual([True, True, False],
+                     [result.round_trip_ok for result in results])
+    self.assertEqual([2, 2, 1], [result.num_lines for result in results])
+    self.assertIsNone(results[0].error)
+    self.assertIn('SyntaxError', results[2].error)
+
+  def testInProcess(self):
+    self._CheckResults(source_match.AnnotateFiles(
+        iter(self.paths), processes=1))
+
+  def testWorkerProcesses(self):
+    self._CheckResults(source_match.AnnotateFiles(
+        iter(self.paths), processes=2, chunksize=1))
+
+  def testPathsAreReadLazily(self):
+    num_paths_read = [0]
+
+    def Paths():
+      for _ in xrange(100):
+        num_paths_read[0] += 1
+        yield self.paths[0]
+    results = source_match.AnnotateFiles(Paths(), processes=2, chunksize=1)
+    next(results)
+    self.assertLessEqual(num_paths_read[0], 6)
+    self.assertEqual(99, len(list(results)))
+    self.assertEqual(100, num_paths_read[0])
+
+  def testMissingFile(self):
+    results = list(source_match.AnnotateFiles(
+        [os.path.join(self.directory, 'missing.py')], processes=1))
+    self.assertFalse(results[0].round_trip_ok)
+    self.assertIn('IOError', results[0].error)
+
+
+class VerifyTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    os.mkdir(os.path.join(self.directory, 'package'))
+    for name, text in (('package/a.py', 'a = 1\n'),
+                       ('package/b.txt', 'def (:\n'),
+                       ('c.py', 'b = [1,\n     2]\n')):
+      with open(os.path.join(self.directory, name), 'w') as source_file:
+        source_file.write(text)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def testVerify(self):
+    out = cStringIO.StringIO()
+    self.assertEqual(0, source_match.Verify(
+        [self.directory], processes=1, verbose=True, out=out))
+    lines = out.getvalue().splitlines()
+    self.assertEqual(3, len(lines))
+    self.assertTrue(lines[0].startswith(
+        'OK ' + os.path.join(self.directory, 'c.py') + ' (2 lines, '))
+    self.assertTrue(lines[1].startswith(
+        'OK ' + os.path.join(self.directory, 'package', 'a.py')))
+    self.assertTrue(lines[2].startswith('2 files, 0 failed, 3 lines in '))
+
+  def testVerifyReportsFailures(self):
+    path = os.path.join(self.directory, 'package', 'b.txt')
+    out = cStringIO.StringIO()
+    self.assertEqual(1, source_match.Verify(
+        [self.directory, path], processes=1, out=out))
+    lines = out.getvalue().splitlines()
+    self.assertTrue(lines[0].startswith('ERROR ' + path))
+    self.assertIn('SyntaxError', lines[1])
+    self.assertTrue(lines[2].startswith('3 files, 1 failed, '))
+
+  def testMain(self):
+    stdout = sys.stdout
+    sys.stdout = cStringIO.StringIO()
+    try:
+      self.assertEqual(0, source_match.main(
+          ['verify', '-j', '2', self.directory]))
+    finally:
+      sys.stdout = stdout
+
+
+FOOTPRINT_SAMPLE = """\
+import os
+
+
+@decorator
+def Foo(a, b=1, *args, **kwargs):
+  \"\"\"Docstring.\"\"\"
+  if a and (b or c):
+    return [x * 2 for x in args]  # comment
+  elif a:
+    with open(a) as f:
+      return f.read(), {'a': 1, 'b': 2}
+  try:
+    print a[1:2], os.path.join(a, 'b' 'c')
+  finally:
+    pass
+"""
+
+
+def _GetMatcherFootprint(obj, seen):
+  """Returns the bytes used by obj and the matchers reachable from it."""
+  if id(obj) in seen:
+    return 0
+  if isinstance(obj, (list, tuple)):
+    seen.add(id(obj))
+    return sys.getsizeof(obj) + sum(_GetMatcherFootprint(item, seen)
+                                    for item in obj)
+  if not isinstance(obj, (source_match.Placeholder,
+                          source_match.SourceMatcher)):
+    return 0
+  seen.add(id(obj))
+  size = sys.getsizeof(obj)
+  for cls in type(obj).__mro__:
+    for slot in getattr(cls, '__slots__', ()):
+      size += _GetMatcherFootprint(getattr(obj, slot, None), seen)
+  return size
+
+
+class MatcherFootprintTest(unittest.TestCase):
+
+  def setUp(self):
+    self.module_node = ast.parse(FOOTPRINT_SAMPLE)
+    source_match.GetSource(self.module_node, FOOTPRINT_SAMPLE)
+
+  def testMatchersHaveNoInstanceDict(self):
+    for node in ast.walk(self.module_node):
+      matcher = getattr(node, 'matcher', None)
+      if matcher is not None:
+        self.assertFalse(hasattr(matcher, '__dict__'), type(matcher))
+
+  def testBytesPerNode(self):
+    seen = set()
+    num_nodes = 0
+    total_size = 0
+    for node in ast.walk(self.module_node):
+      num_nodes += 1
+      total_size += _GetMatcherFootprint(getattr(node, 'matcher', None), seen)
+    self.assertEqual(FOOTPRINT_SAMPLE, self.module_node.matcher.GetSource())
+    # Around 330 bytes per node on a 64-bit build; with an instance dict on
+    # every placeholder this was over 1800.
+    self.assertLess(total_size / num_nodes, 600)
+
 
 class ParenWrappedTest(unittest.TestCase):
 
@@ -427,6 +1286,25 @@ class ParenWrappedTest(unittest.TestCase):
     matcher.Match(string)
     self.assertEqual(string, matcher.GetSource())
 
+  def testMoreStartParensThanEndParens(self):
+    node = create_node.Name('a')
+    matcher = source_match.GetMatcher(node)
+    self.assertEqual('((a)', matcher.Match('((a)'))
+    self.assertEqual(1, len(matcher.start_paren_matchers))
+    self.assertEqual('(a)', matcher.GetSource())
+
+  def testWithComments(self):
+    node = create_node.Name('a')
+    string = '(  # comment\n a  # comment\n )'
+    matcher = source_match.GetMatcher(node)
+    matcher.Match(string)
+    self.assertEqual(string, matcher.GetSource())
+
+  def testSkipStartParens(self):
+    self.assertEqual(5, source_match.SkipStartParens('a(( (b', 1))
+    self.assertEqual(0, source_match.SkipStartParens('a(( (b', 0))
+    self.assertEqual('b)', source_match.StripStartParens('(\n(b)'))
+
 
 class ArgumentsMatcherTest(unittest.TestCase):
 
@@ -1124,6 +2002,20 @@ class FunctionDefMatcherTest(unittest.TestCase):
     matcher.Match(string)
     self.assertEqual(string, matcher.GetSource())
 
+  def testIndentedCommentInDecoratorList(self):
+    string = ('class A:\n'
+              '    @a\n'
+              '    # comment\n'
+              '    @b\n'
+              '    def g(self):\n'
+              '        pass\n')
+    module_node = ast.parse(string)
+    self.assertEqual(string, source_match.GetSource(module_node, string))
+    # Matching again, with the comment in the decorator list, gives the same.
+    function_node = module_node.body[0].body[0]
+    self.assertEqual(
+        string[9:], source_match.GetSource(function_node, string[9:]))
+
   def testBody(self):
     node = create_node.FunctionDef(
         'test_fun',
@@ -1422,13 +2314,44 @@ class StrMatcherTest(unittest.TestCase):
     matcher.Match(string)
     self.assertEqual('"""foobar\n\nbaz"""', matcher.GetSource())
 
+  def testEscapedQuotes(self):
+    node = create_node.Str('foo"bar\\')
+    string = '"foo\\"bar\\\\" + 1'
+    matcher = source_match.GetMatcher(node)
+    self.assertEqual('"foo\\"bar\\\\"', matcher.Match(string))
+
+  def testTripleQuoteContainingQuotes(self):
+    node = create_node.Str('a""b"')
+    string = '"""a""b\\"""" + 1'
+    matcher = source_match.GetMatcher(node)
+    self.assertEqual('"""a""b\\""""', matcher.Match(string))
+
+  def testManyEscapedQuotes(self):
+    string = '"' + '\\"' * 10000 + '"'
+    node = create_node.Str('"' * 10000)
+    matcher = source_match.GetMatcher(node)
+    matcher.Match(string)
+    self.assertEqual(string, matcher.GetSource())
+
   def testQuoteTypeMismatch(self):
     node = create_node.Str('foobar')
     string = '"foobar\''
     matcher = source_match.GetMatcher(node)
-    with self.assertRaises(ValueError):
+    with self.assertRaises(source_match.BadlySpecifiedTemplateError):
       matcher.Match(string)
 
+  def testUnterminatedStringErrorQuotesLittleText(self):
+    module_node = ast.parse('x = "a"\n')
+    string = 'x = "a' + ' ' * 1000000
+    with self.assertRaises(source_match.BadlySpecifiedTemplateError) as cm:
+      source_match.GetSource(module_node, string)
+    error = cm.exception
+    self.assertEqual(4, error.pos)
+    self.assertEqual(
+        [_ast.Str, _ast.Assign, _ast.Module],
+        [type(matcher.node) for matcher, _ in error.matchers])
+    self.assertLess(len(str(error)), 1000)
+
   def testSChange(self):
     node = create_node.Str('foobar')
     string = '"foobar"'
@@ -1660,6 +2583,35 @@ finally:
     self.assertEqual(string, matcher.GetSource())
 
 
+class TupleMatcherTest(unittest.TestCase):
+
+  def testUnparenthesizedTupleEndsAtLastElement(self):
+    node = create_node.Tuple('a', 'b')
+    matcher = source_match.GetMatcher(node)
+    self.assertEqual('a, b', matcher.Match('a, b  \n'))
+    self.assertEqual('a, b', matcher.GetSource())
+
+  def testUnparenthesizedTupleWithTrailingComma(self):
+    node = create_node.Tuple('a', 'b')
+    matcher = source_match.GetMatcher(node)
+    self.assertEqual('a,  b ,', matcher.Match('a,  b ,  \n'))
+    self.assertEqual('a,  b ,', matcher.GetSource())
+
+  def testParenthesizedTuple(self):
+    node = create_node.Tuple('a', 'b')
+    matcher = source_match.GetMatcher(node)
+    self.assertEqual('( a, b, )', matcher.Match('( a, b, )  \n'))
+    self.assertEqual('( a, b, )', matcher.GetSource())
+
+  def testNestedTuples(self):
+    string = 'x = a, (b, (c, d ), ),  # comment\nreturn_value = x\n'
+    module_node = ast.parse(string)
+    self.assertEqual(string, source_match.GetSource(module_node, string))
+    tuple_node = module_node.body[0].value
+    self.assertEqual('a, (b, (c, d ), ),  # comment',
+                     tuple_node.matcher.GetSource())
+
+
 class UnaryOpMatcherTest(unittest.TestCase):
 
   def testUAddUnaryOp(self):